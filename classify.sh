@@ -11,10 +11,9 @@ labels=(
     lh.superiortemporal.label
 )
 
-for label in "${labels[@]}"; do
-    echo "Running $label"
-    python src/classify.py -label "$label"
-done
+# all labels are classified in a single process (preprocessing and inverse operators are shared)
+echo "Running ${labels[@]}"
+python src/classify.py -label "${labels[@]}"
 
 
 
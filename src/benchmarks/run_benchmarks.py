@@ -0,0 +1,198 @@
+'''
+Benchmark the pipeline on synthetic data (see synthetic.py), stage by stage:
+    preprocess, epoching, inverse (noise covariance + inverse operator), source_space (get_source_space_data),
+    classification (simple_classification) and plot (plot_classification)
+
+Wall time, CPU time and memory of every stage are appended as one JSON line per run to results/benchmarks/history.jsonl
+(with the git commit), and compared with the last run of the same configuration so that regressions show up between commits.
+Runs offline and on CPU only. The synthetic dataset is generated once in data/benchmarks.
+
+Run in terminal:
+    python src/benchmarks/run_benchmarks.py -size small
+'''
+# utils
+import pathlib, argparse, sys, json, time, platform, os, subprocess, tempfile
+from datetime import datetime, timezone
+from contextlib import contextmanager
+sys.path.append(str(pathlib.Path(__file__).parents[2]))
+
+# plotting without a display
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+# MEG package
+import mne
+
+import numpy as np
+
+# custom modules
+from src.utils.general_preprocess import preprocess_all, ica_dict, epoching
+from src.utils.rejection import DEFAULT_REJECT
+from src.utils.classify_fns import get_source_space_data, simple_classification, plot_classification
+from src.utils.source_fns import get_inverse_operator, _memory_cache
+from src.utils.profiling import current_rss, reset_peak_rss, peak_rss
+from src.benchmarks.synthetic import make_dataset
+
+# dataset and pipeline settings per benchmark size ("full" matches the real recordings)
+SIZES = {
+    "small": dict(recording_names=['001.self_block1', '002.other_block1'], duration=60., grade=4, spacing="ico3", tmax=55),
+    "full": dict(recording_names=['001.self_block1', '002.other_block1', '003.self_block2', '004.other_block2',
+                                  '005.self_block3', '006.other_block3'], duration=375., grade=5, spacing="ico4", tmax=365),
+}
+
+def input_parse():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-size", "--size", type=str, choices=list(SIZES), help="size of the synthetic dataset", default="small")
+    parser.add_argument("-n_permutations", "--n_permutations", type=int, help="number of permutations in simple_classification", default=100)
+    parser.add_argument("-history", "--history", type=str, help="JSON lines file the results are appended to", default=None)
+    parser.add_argument("-regression_threshold", "--regression_threshold", type=float, help="flag stages slower than this ratio to the last run", default=1.25)
+    args = parser.parse_args()
+
+    return args
+
+def git_commit(repo_path):
+    '''
+    Current commit of the repository and whether the working tree has changes (None if git is not available)
+    '''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_path, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_path, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, bool(status.strip())
+
+@contextmanager
+def benchmark_stage(stage, stages, **sizes):
+    '''
+    Record wall time, CPU time and memory (resident set size at the end and peak during the stage) of a stage in stages.
+    Allocations are not traced (tracemalloc would slow down the timed code).
+
+    Args
+        stage (str): name of the stage
+        stages (list): list to append a dict per stage to
+        sizes: sizes to record with the stage (e.g., n_epochs)
+    '''
+    reset_peak_rss()
+    start_rss = current_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+
+    yield
+
+    stages.append(dict(stage=stage, wall_s=time.perf_counter() - wall, cpu_s=time.process_time() - cpu,
+                       start_rss_bytes=start_rss, rss_bytes=current_rss(), peak_rss_bytes=peak_rss(), **sizes))
+
+def compare(stages, previous, threshold):
+    '''
+    Print the ratio of wall time and peak memory to a previous run, flagging stages slower than threshold
+    '''
+    previous = {stage["stage"]: stage for stage in previous["stages"]}
+
+    print(f"{'stage':<16}{'wall (s)':>10}{'ratio':>8}{'peak rss (MB)':>15}{'ratio':>8}")
+    for stage in stages:
+        before = previous.get(stage["stage"])
+        wall_ratio = stage["wall_s"] / before["wall_s"] if before else float("nan")
+        memory_ratio = stage["peak_rss_bytes"] / before["peak_rss_bytes"] if before else float("nan")
+        flag = "  <-- slower" if wall_ratio > threshold else ""
+
+        print(f"{stage['stage']:<16}{stage['wall_s']:>10.2f}{wall_ratio:>8.2f}{stage['peak_rss_bytes'] / 1e6:>15.1f}{memory_ratio:>8.2f}{flag}")
+
+def main():
+    args = input_parse()
+
+    ## PATHS and FILES ##
+    path = pathlib.Path(__file__)
+    repo_path = path.parents[2]
+    data_path = repo_path / "data" / "benchmarks" / args.size
+    history_path = pathlib.Path(args.history) if args.history else repo_path / "results" / "benchmarks" / "history.jsonl"
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+
+    mne.set_log_level("WARNING")
+    size = SIZES[args.size]
+
+    ## SYNTHETIC DATA ## (generated once, not benchmarked)
+    print(f"[INFO:] Preparing the {args.size} synthetic dataset in {data_path}")
+    paths = make_dataset(data_path, size["recording_names"], duration=size["duration"], grade=size["grade"], spacing=size["spacing"])
+
+    stages = []
+
+    ## PIPELINE ##
+    with benchmark_stage("preprocess", stages, n_recordings=len(size["recording_names"])):
+        processed_raws = preprocess_all(paths["meg_path"], size["recording_names"], paths["ica_path"], ica_dict(), tmax=size["tmax"])
+
+    with benchmark_stage("epoching", stages):
+        epochs_dict = {}
+        reject_criterion = DEFAULT_REJECT
+
+        for recording_name, raw in processed_raws.items():
+            if "self" in recording_name:
+                event_id = dict(self_positive=11, self_negative=12, button_img=23)
+            else:
+                event_id = dict(other_positive=21, other_negative=22, button_img=23)
+
+            events = mne.find_events(raw, min_duration=2/raw.info["sfreq"])
+            epochs_dict[recording_name] = epoching(raw, events, tmin=-0.200, tmax=1.500, event_id=event_id, reject_criterion=reject_criterion)
+
+    n_epochs = sum(len(epochs) for epochs in epochs_dict.values())
+    del processed_raws
+
+    # start without operators from an earlier run in this process
+    _memory_cache.clear()
+
+    with benchmark_stage("inverse", stages, n_epochs=n_epochs):
+        for recording_name, epochs in epochs_dict.items():
+            get_inverse_operator(epochs, recording_name, paths["subjects_dir"], subject=paths["subject"])
+
+    with benchmark_stage("source_space", stages, n_epochs=n_epochs):
+        X, y = get_source_space_data(epochs_dict, paths["subjects_dir"], subject=paths["subject"], label=paths["label"])
+    stages[-1].update(X_shape=list(X.shape), X_bytes=X.nbytes)
+
+    times = list(epochs_dict.values())[0].times
+    triggers = [11, 21, 12, 22]
+
+    # same class balancing draws in every run
+    np.random.seed(0)
+
+    with benchmark_stage("classification", stages, n_permutations=args.n_permutations):
+        mean_scores, _, _, permutation_scores, permutation_info = simple_classification(X, y, triggers, engine="batched",
+                                                                                        n_permutations=args.n_permutations,
+                                                                                        combine=[[11, 21], [12, 22]])
+
+    with tempfile.TemporaryDirectory() as tmp_dir, benchmark_stage("plot", stages):
+        plot_classification(times, mean_scores, permutation_scores, title="Synthetic benchmark", savepath=pathlib.Path(tmp_dir) / "benchmark.png")
+        plt.close("all")
+
+    ## HISTORY ##
+    commit, dirty = git_commit(repo_path)
+    record = dict(
+        timestamp=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        commit=commit, dirty=dirty, size=args.size, config=dict(size, n_permutations=args.n_permutations),
+        platform=platform.platform(), cpu_count=os.cpu_count(),
+        versions=dict(python=platform.python_version(), mne=mne.__version__, numpy=np.__version__),
+        peak_accuracy=float(mean_scores.max()),
+        stages=stages,
+        )
+
+    # last run with the same configuration
+    previous = None
+    if history_path.exists():
+        for line in history_path.read_text().splitlines():
+            past = json.loads(line)
+            if past["config"] == record["config"]:
+                previous = past
+
+    with open(history_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    print(f"[INFO:] Results appended to {history_path}")
+
+    if previous is not None:
+        print(f"[INFO:] Compared with {previous['commit']} ({previous['timestamp']}):")
+        compare(stages, previous, args.regression_threshold)
+    else:
+        compare(stages, dict(stages=[]), args.regression_threshold)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+'''
+Synthetic MEG dataset for benchmarking the pipeline offline (the real data cannot be shared).
+
+Builds everything the scripts expect, laid out as on UCloud:
+    MEG/{recording}/files/{recording[4:]}.fif      raw recordings simulated with mne.simulation (306 Vectorview channels + STI101)
+    ICA/{recording}-ica.fif                        ICA fits (1 Hz high-passed, as in run_ica.py)
+    subjects/{subject}/bem/...-fwd.fif              forward solutions (spherical head model)
+    subjects/{subject}/label/{label}                label with the simulated activity
+
+The subject is a pair of spherical "hemispheres" (no freesurfer reconstruction needed), and the sensor positions are the
+Vectorview layout projected onto a helmet-shaped hemisphere, so the channel names and types are those of the real recordings.
+'''
+import json, pathlib
+
+import numpy as np
+import mne
+from mne.io.constants import FIFF
+
+# triggers of the self and other recordings (see README, Event Triggers)
+SELF_TRIGGERS = [11, 12, 23]
+OTHER_TRIGGERS = [21, 22, 23]
+
+def helmet_info(sfreq=1000.):
+    '''
+    Measurement info with the 306 Vectorview MEG channels (102 magnetometers, 204 planar gradiometers) and a stim channel (STI101)
+    '''
+    layout = mne.channels.read_layout("Vectorview-all")
+    names = [name.replace(" ", "") for name in layout.names]
+
+    # sensor sites (triplets of one magnetometer and two gradiometers) on a hemisphere of radius 12 cm
+    sites = {}
+    for name, pos in zip(names, layout.pos):
+        sites.setdefault(name[:6], []).append(pos[:2] + pos[2:] / 2)
+    centres = {site: np.mean(positions, axis=0) for site, positions in sites.items()}
+    middle = np.mean(list(centres.values()), axis=0)
+    radius = max(np.linalg.norm(centre - middle) for centre in centres.values())
+
+    locs = {}
+    for site, centre in centres.items():
+        x, y = (centre - middle) / radius
+        polar, azimuth = np.hypot(x, y) * np.pi / 2 * 0.95, np.arctan2(y, x)
+        ez = np.array([np.sin(polar) * np.cos(azimuth), np.sin(polar) * np.sin(azimuth), np.cos(polar)])
+        ex = np.cross([0., 0., 1.], ez) if polar > 1e-6 else np.array([1., 0., 0.])
+        ex /= np.linalg.norm(ex)
+        ey = np.cross(ez, ex)
+        locs[site] = (ez * 0.12 + np.array([0., 0., 0.04]), ex, ey, ez)
+
+    types = ["mag" if name.endswith("1") else "grad" for name in names]
+    info = mne.create_info(names + ["STI101"], sfreq, types + ["stim"])
+
+    with info._unlock():
+        for ch in info["chs"][:len(names)]:
+            pos, ex, ey, ez = locs[ch["ch_name"][:6]]
+            # the two gradiometers of a site measure orthogonal gradients
+            if ch["ch_name"].endswith("3"):
+                ex, ey = ey, -ex
+            ch["loc"] = np.concatenate([pos, ex, ey, ez])
+            ch["coord_frame"] = FIFF.FIFFV_COORD_DEVICE
+        info["dev_head_t"] = mne.transforms.Transform("meg", "head", np.eye(4))
+
+    return info
+
+def icosphere(grade):
+    '''
+    Vertices and triangles of a unit icosphere subdivided grade times
+    '''
+    t = (1 + 5 ** 0.5) / 2
+    vertices = [[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0], [0, -1, t], [0, 1, t],
+                [0, -1, -t], [0, 1, -t], [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]]
+    vertices = [np.array(vertex, float) / np.linalg.norm(vertex) for vertex in vertices]
+    triangles = [[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11], [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                 [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9], [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]]
+
+    for _ in range(grade):
+        midpoints, subdivided = {}, []
+
+        def midpoint(a, b):
+            key = (min(a, b), max(a, b))
+            if key not in midpoints:
+                vertex = vertices[a] + vertices[b]
+                vertices.append(vertex / np.linalg.norm(vertex))
+                midpoints[key] = len(vertices) - 1
+            return midpoints[key]
+
+        for a, b, c in triangles:
+            ab, bc, ca = midpoint(a, b), midpoint(b, c), midpoint(c, a)
+            subdivided += [[a, ab, ca], [b, bc, ab], [c, ca, bc], [ab, bc, ca]]
+
+        triangles = subdivided
+
+    return np.array(vertices), np.array(triangles)
+
+def make_subject(subjects_dir, subject="synthetic", grade=4, spacing="ico3"):
+    '''
+    Write white and sphere surfaces of two spherical hemispheres and set up a surface source space on them
+    '''
+    surf_dir = pathlib.Path(subjects_dir) / subject / "surf"
+    surf_dir.mkdir(parents=True, exist_ok=True)
+
+    vertices, triangles = icosphere(grade)
+    for hemi, x in [("lh", -30.), ("rh", 30.)]:
+        mne.write_surface(surf_dir / f"{hemi}.white", vertices * 25 + np.array([x, 0, 40]), triangles, overwrite=True)
+        mne.write_surface(surf_dir / f"{hemi}.sphere", vertices * 100, triangles, overwrite=True)
+
+    return mne.setup_source_space(subject, spacing=spacing, subjects_dir=subjects_dir, add_dist=False, verbose=False)
+
+def make_events(recording_name, n_samples, sfreq, first=11., isi=2.0, jitter=0.25, rng=None):
+    '''
+    Events cycling through the triggers of the recording (self or other), one every isi +- jitter seconds after first seconds
+    '''
+    rng = np.random.default_rng(rng)
+    triggers = SELF_TRIGGERS if "self" in recording_name else OTHER_TRIGGERS
+
+    onsets = []
+    onset = first
+    while (onset + isi) * sfreq < n_samples:
+        onsets.append(int(onset * sfreq))
+        onset += isi + rng.uniform(-jitter, jitter)
+
+    codes = np.array(triggers)[rng.permutation(np.arange(len(onsets)) % len(triggers))]
+
+    return np.column_stack([onsets, np.zeros(len(onsets), int), codes])
+
+def simulate_recording(info, fwd, label, events, duration, amplitude=20e-9, rng=None):
+    '''
+    Simulate a raw recording: an evoked response in the label whose sign depends on the valence of the trigger (positive/negative),
+    a weaker response for the button trials, and sensor noise (mne.simulation). amplitude is the total dipole moment (Am) of the label.
+
+    Returns
+        raw (mne.io.Raw): raw recording with the MEG channels and the stim channel STI101
+    '''
+    meg_info = mne.pick_info(info, mne.pick_types(info, meg=True))
+    tstep = 1 / info["sfreq"]
+    times = np.arange(0, 0.5, tstep)
+    waveform = np.sin(2 * np.pi * 4 * times) * np.hanning(len(times))
+
+    source_simulator = mne.simulation.SourceSimulator(fwd["src"], tstep=tstep, duration=duration)
+    for trigger, sign in [(11, 1), (21, 1), (12, -1), (22, -1), (23, 0.5)]:
+        trigger_events = events[events[:, 2] == trigger]
+        if len(trigger_events):
+            source_simulator.add_data(label, sign * amplitude / len(label.vertices) * waveform, trigger_events)
+
+    raw = mne.simulation.simulate_raw(meg_info, source_simulator, forward=fwd, verbose=False)
+    mne.simulation.add_noise(raw, mne.make_ad_hoc_cov(raw.info), iir_filter=[0.2, -0.2, 0.04], random_state=rng, verbose=False)
+
+    # triggers last 20 ms (like the real stim channel) so they survive resampling
+    stim = np.zeros((1, len(raw.times)))
+    for onset, _, trigger in events:
+        stim[0, onset:onset + int(0.02 * info["sfreq"])] = trigger
+    stim_raw = mne.io.RawArray(stim, mne.pick_info(info, mne.pick_types(info, meg=False, stim=True)), verbose=False)
+    raw.add_channels([stim_raw], force_update_info=True)
+
+    return raw
+
+def make_dataset(root, recording_names, duration=375., sfreq=1000., n_ica_components=20, grade=4, spacing="ico3",
+                 subject="synthetic", label_name="lh.synthetic.label", amplitude=20e-9, seed=0):
+    '''
+    Write the synthetic dataset to root (skipped if a dataset with the same settings already exists there)
+
+    Args
+        root (pathlib.Path): directory of the dataset
+        recording_names (list): recording names (e.g., '001.self_block1')
+        duration (float): duration of each recording in seconds
+        sfreq (float): sampling frequency of the raw recordings
+        n_ica_components (int): number of ICA components fitted per recording
+        grade (int): subdivisions of the icosphere hemispheres
+        spacing (str): source space spacing (e.g., "ico3")
+        subject (str): subject name
+        label_name (str): file name of the label with the simulated activity
+        amplitude (float): total dipole moment (Am) of the simulated response
+        seed (int): random seed
+
+    Returns
+        paths (dict): meg_path, ica_path, subjects_dir, subject and label
+    '''
+    root = pathlib.Path(root)
+    settings = dict(recording_names=list(recording_names), duration=duration, sfreq=sfreq, n_ica_components=n_ica_components,
+                    grade=grade, spacing=spacing, subject=subject, label_name=label_name, amplitude=amplitude, seed=seed,
+                    mne=mne.__version__)
+    paths = dict(meg_path=root / "MEG", ica_path=root / "ICA", subjects_dir=root / "subjects", subject=subject, label=label_name)
+
+    settings_path = root / "settings.json"
+    if settings_path.exists() and json.loads(settings_path.read_text()) == settings:
+        return paths
+
+    rng = np.random.default_rng(seed)
+    paths["ica_path"].mkdir(parents=True, exist_ok=True)
+
+    src = make_subject(paths["subjects_dir"], subject, grade=grade, spacing=spacing)
+    for directory in ["bem", "label"]:
+        (paths["subjects_dir"] / subject / directory).mkdir(exist_ok=True)
+
+    # label: the source space vertices closest to a point on the left hemisphere
+    distances = np.linalg.norm(src[0]["rr"][src[0]["vertno"]] - src[0]["rr"][src[0]["vertno"][0]], axis=1)
+    label_vertices = np.sort(src[0]["vertno"][np.argsort(distances)[:len(src[0]["vertno"]) // 8]])
+    label = mne.Label(label_vertices, pos=src[0]["rr"][label_vertices], hemi="lh", subject=subject)
+    label.save(paths["subjects_dir"] / subject / "label" / label_name)
+
+    info = helmet_info(sfreq)
+    sphere = mne.make_sphere_model((0., 0., 0.04), 0.09, verbose=False)
+
+    for recording_name in recording_names:
+        fwd = mne.make_forward_solution(mne.pick_info(info, mne.pick_types(info, meg=True)), None, src, sphere, verbose=False)
+        mne.write_forward_solution(paths["subjects_dir"] / subject / "bem" / f"{recording_name[4:]}-oct-6-src-5120-fwd.fif", fwd,
+                                   overwrite=True, verbose=False)
+
+        fixed = mne.convert_forward_solution(fwd, force_fixed=True, surf_ori=True, verbose=False)
+        events = make_events(recording_name, int(duration * sfreq), sfreq, rng=rng)
+        raw = simulate_recording(info, fixed, label, events, duration, amplitude=amplitude, rng=rng)
+
+        recording_dir = paths["meg_path"] / recording_name / "files"
+        recording_dir.mkdir(parents=True, exist_ok=True)
+        raw.save(recording_dir / f"{recording_name[4:]}.fif", overwrite=True, verbose=False)
+
+        # ICA as in run_ica.py (fitted on 1 Hz high-passed data without the bad channel)
+        raw_ica = raw.copy().pick("meg").drop_channels(["MEG0422"]).filter(1, 40, verbose=False).resample(250, verbose=False)
+        ica = mne.preprocessing.ICA(n_components=n_ica_components, random_state=seed, max_iter=500, verbose=False)
+        ica.fit(raw_ica, verbose=False)
+        ica.save(paths["ica_path"] / f"{recording_name}-ica.fif", overwrite=True, verbose=False)
+
+    settings_path.write_text(json.dumps(settings))
+
+    return paths
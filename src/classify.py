@@ -2,7 +2,18 @@
 Script to classify brain areas. 
 
 Run in the terminal: 
-    python src/classify.py -label {BRAIN_LABEL_TO_CLASSIFY}
+    python src/classify.py -label {BRAIN_LABEL_TO_CLASSIFY} [{BRAIN_LABEL_TO_CLASSIFY} ...]
+
+or for all labels of a freesurfer annotation (e.g., aparc):
+    python src/classify.py -annot aparc
+
+Preprocessing, epoching and the inverse operators are computed once and shared by all labels.
+The classifiers are fitted with scikit-learn by default, add -engine batched to fit all samples and folds at once (see utils/batched_classify_fns.py).
+Add -generalize to also compute temporal generalization (train time x test time) matrices.
+Add -trace to write a trace of all stages (results/traces, open in chrome://tracing or https://ui.perfetto.dev),
+and -profile to also cProfile the hot loops.
+Figures are rendered at the end (in parallel with -n_jobs, -dpi sets the resolution, -figure_format pdf svg gives vector graphics)
+and are only re-rendered if their data changed.
 
 The script has been run on the following labels (from freesurfer):
     rh.bankssts.label
@@ -16,7 +27,7 @@ The script has been run on the following labels (from freesurfer):
 '''
 
 # utils
-import pathlib, argparse
+import pathlib, argparse, time
 
 # MEG package
 import mne
@@ -24,15 +35,40 @@ import mne
 # numpy
 import numpy as np
 
+# plotting without a display
+import matplotlib
+matplotlib.use("Agg")
+
 # custom modules for preprocessing and classification
 from utils.general_preprocess import preprocess_all, ica_dict, epoching
-from utils.classify_fns import simple_classification, plot_classification, get_source_space_data, combine_triggers
+from utils.classify_fns import simple_classification, plot_classification, get_source_space_data_labels
+from utils.classify_fns import generalization_classification, plot_generalization
+from utils.source_fns import read_labels
+from utils.trial_index import TrialIndex
+from utils.rejection import PeakToPeakTable, DEFAULT_REJECT
+from utils.profiling import start_tracing, stop_tracing, trace_stage
+from utils.figures import export_figures
 
 def input_parse(): 
     parser=argparse.ArgumentParser()
 
     # add arguments to parser
-    parser.add_argument("-label", "--brain_label", type=str, help="brain label to classify on (from freesurfer)", default="rh.bankssts.label")
+    parser.add_argument("-label", "--brain_label", type=str, nargs="+", help="brain label(s) to classify on (from freesurfer)", default=["rh.bankssts.label"])
+    parser.add_argument("-annot", "--annot", type=str, help="classify on all labels of this freesurfer annotation instead (e.g., aparc)", default=None)
+    parser.add_argument("-n_jobs", "--n_jobs", type=int, help="number of worker processes for preprocessing and the permutation test (-1 uses all cpus)", default=1)
+    parser.add_argument("-engine", "--engine", type=str, choices=["sklearn", "batched"], help="sklearn (one classifier per sample) or batched (all samples and folds at once, needed for -permutation_mode sequential and -bin_size)", default="sklearn")
+    parser.add_argument("-permutation_mode", "--permutation_mode", type=str, choices=["fixed", "sequential"], help="fixed number of permutations per sample or sequential (early-stopping) permutation test", default="fixed")
+    parser.add_argument("-memory_budget", "--memory_budget", type=float, help="peak memory (GB) for preprocessing recordings in parallel (caps n_jobs)", default=None)
+    parser.add_argument("-bin_size", "--bin_size", type=int, help="coarse-to-fine decoding: samples per coarse bin (e.g., 5 = 20 ms), only bins above chance + 0.05 are decoded per sample", default=None)
+    parser.add_argument("-generalize", "--generalize", action="store_true", help="also compute temporal generalization (train time x test time) matrices")
+    parser.add_argument("-trace", "--trace", action="store_true", help="write a Chrome trace-event JSON of all stages to results/traces")
+    parser.add_argument("-profile", "--profile", action="store_true", help="also profile the hot loops with cProfile (implies -trace)")
+    parser.add_argument("-dpi", "--dpi", type=int, help="resolution of raster figures", default=1200)
+    parser.add_argument("-figure_format", "--figure_format", type=str, nargs="+", help="figure formats, e.g. png or pdf svg (vector)", default=["png"])
+    parser.add_argument("-fused", "--fused", action="store_true", help="filter and downsample in one pass (faster, output differs slightly from raw.filter -> raw.resample)")
+    parser.add_argument("-reject_mag", "--reject_mag", type=float, help="peak-to-peak rejection threshold of magnetometers in T (see src/rejection_sweep.py)", default=DEFAULT_REJECT["mag"])
+    parser.add_argument("-reject_grad", "--reject_grad", type=float, help="peak-to-peak rejection threshold of gradiometers in T/m", default=DEFAULT_REJECT["grad"])
+    parser.add_argument("-feature_store", "--feature_store", action="store_true", help="write source space data to memory-mapped files in data/cache/features instead of memory")
     args = parser.parse_args()
 
     return args
@@ -47,12 +83,23 @@ def main():
     # raw meg data paths 
     meg_path = path.parents[3] / "834761" / "0108" / "20230928_000000" / "MEG"
     ica_path = path.parents[1] / "data" / "ICA"
+    cache_dir = path.parents[1] / "data" / "cache"
     subjects_dir = path.parents[3] / "835482" 
 
     # plot path
     plot_path = path.parents[1] / "plots" / "classifications"
     plot_path.mkdir(parents=True, exist_ok=True)
 
+    # results path
+    results_path = path.parents[1] / "results" / "classifications"
+    results_path.mkdir(parents=True, exist_ok=True)
+
+    # trace path
+    trace_path = path.parents[1] / "results" / "traces" / f"classify_{time.strftime('%Y%m%d_%H%M%S')}"
+
+    if args.trace or args.profile:
+        start_tracing(profile_dir=trace_path if args.profile else None)
+
     # load and preprocess all recordings
     recording_names = ['001.self_block1',  '002.other_block1',
                        '003.self_block2',  '004.other_block2',
@@ -62,11 +109,13 @@ def main():
     ica_components = ica_dict()
 
     # preprocess all recordings
-    processed_raws = preprocess_all(meg_path, recording_names, ica_path, ica_components)
+    memory_budget = args.memory_budget * 1e9 if args.memory_budget else None
+    processed_raws = preprocess_all(meg_path, recording_names, ica_path, ica_components, cache_dir=cache_dir / "preprocessed", inplace=True,
+                                    n_jobs=args.n_jobs, memory_budget=memory_budget, fused=args.fused)
 
     # prepare for epochs, define rejection criterion
-    epochs_dict = {}
-    reject_criterion = dict(mag=4e-12, grad=4000e-13)
+    epochs_dict, events_dict = {}, {}
+    reject_criterion = dict(mag=args.reject_mag, grad=args.reject_grad)
 
     # iterate over values in processed_raws
     for recording_name, raw in processed_raws.items(): 
@@ -78,15 +127,33 @@ def main():
         # get events
         events  = mne.find_events(raw, min_duration = 2/raw.info["sfreq"])
 
-        # epoch data
-        epochs = epoching(raw, events, tmin=-0.200, tmax=1.500, event_id=event_id, reject_criterion=reject_criterion)
+        # epoch data (rejection is applied to all recordings below)
+        epochs = epoching(raw, events, tmin=-0.200, tmax=1.500, event_id=event_id, reject_criterion=None)
 
         # append to dict
         epochs_dict[recording_name] = epochs
+        events_dict[recording_name] = events
+
+    # peak-to-peak amplitudes of all epochs (stored for src/rejection_sweep.py), then reject
+    ptp_table = PeakToPeakTable.from_epochs_dict(epochs_dict)
+    ptp_table.save(cache_dir / "rejection" / "peak_to_peak.npz")
+    epochs_dict = ptp_table.apply(epochs_dict, reject_criterion, copy=False)
+
+    # index of all trials (including dropped epochs)
+    trial_index = TrialIndex.from_epochs_dict(epochs_dict, events_dict)
+    print(f"[INFO:] {trial_index}")
+    print(f"[INFO:] Kept epochs per valence and condition: {trial_index.counts('valence', 'condition', dropped=False)}")
+
+    # get source space data for all labels (the inverse operators are only built once)
+    if args.annot is not None:
+        labels = read_labels(subjects_dir, subject="0108", annot=args.annot)
+    else:
+        labels = read_labels(subjects_dir, subject="0108", labels=args.brain_label)
 
-    # get source space data
-    label = args.brain_label
-    X, y = get_source_space_data(epochs_dict, subjects_dir, subject="0108", label=label)
+    store_dir = cache_dir / "features" if args.feature_store else None
+    with trace_stage("source_space", n_labels=len(labels)):
+        X_dict, y = get_source_space_data_labels(epochs_dict, labels, subjects_dir, subject="0108", cache_dir=cache_dir / "inverse",
+                                                 store_dir=store_dir)
 
     # get first value from epochs_dict
     first_epochs = list(epochs_dict.values())[0]
@@ -96,23 +163,60 @@ def main():
     triggers = [11, 21, 12, 22]
     # triggers = [11, 12] # triggers for only self_conditions. NB. remember to remove combine also in simple_classification!!!
 
-    # complete simple classification
-    mean_scores, y_pred_all, y_true_all, permutation_scores = simple_classification(
-                                X=X, 
-                                y=y, 
-                                triggers=triggers,
-                                penalty='l2', 
-                                C=1e-3, 
-                                combine=[[11, 21], [12, 22]] # combines the two positive triggers
-                                ) 
-    
-    plot_classification(
-        times = times, 
-        mean_scores = mean_scores, 
-        permutation_scores = permutation_scores,
-        title = f"{label}. Triggers: {triggers} (combined)",
-        savepath = plot_path / f"{label}_{triggers}.png"
-    )
+    figure_jobs = []
+
+    for label, X in X_dict.items():
+        print(f"[INFO:] Classifying {label}")
+
+        # complete simple classification
+        with trace_stage("classification", label=label):
+            mean_scores, y_pred_all, y_true_all, permutation_scores, permutation_info = simple_classification(
+                                        X=X, 
+                                        y=y, 
+                                        triggers=triggers,
+                                        penalty='l2', 
+                                        C=1e-3, 
+                                        engine=args.engine,
+                                        n_jobs=args.n_jobs,
+                                        permutation_mode=args.permutation_mode,
+                                        bin_size=args.bin_size,
+                                        combine=[[11, 21], [12, 22]], # combines the two positive triggers
+                                        trial_index=trial_index,
+                                        balance_random_state=0 # same balanced trials as the generalization below
+                                        ) 
+
+        # save results
+        np.savez(results_path / f"{label}_{triggers}.npz", times=times, mean_scores=mean_scores,
+                 permutation_scores=permutation_scores, **permutation_info)
+
+        # significant clusters (cluster-mass test, only with a fixed number of permutations and without bin_size)
+        clusters = permutation_info["clusters"][permutation_info["cluster_pvalues"] < 0.05] if "clusters" in permutation_info else None
+
+        # figures are rendered after all labels are classified (in parallel, skipped if their data has not changed)
+        figure_jobs.append(dict(plot_fn=plot_classification,
+                                kwargs=dict(times=times, mean_scores=mean_scores, permutation_scores=permutation_scores, clusters=clusters,
+                                            title=f"{label}. Triggers: {triggers} (combined)"),
+                                savepath=plot_path / f"{label}_{triggers}.png"))
+
+        if args.generalize:
+            with trace_stage("generalization", label=label):
+                generalization_scores = generalization_classification(X=X, y=y, triggers=triggers, combine=[[11, 21], [12, 22]],
+                                                                      trial_index=trial_index, balance_random_state=0)
+
+            np.savez(results_path / f"{label}_{triggers}_generalization.npz", times=times, generalization_scores=generalization_scores)
+
+            figure_jobs.append(dict(plot_fn=plot_generalization,
+                                    kwargs=dict(times=times, generalization_scores=generalization_scores,
+                                                title=f"{label}. Triggers: {triggers} (combined)"),
+                                    savepath=plot_path / f"{label}_{triggers}_generalization.png"))
+
+    with trace_stage("plot", n_figures=len(figure_jobs)):
+        summary = export_figures(figure_jobs, n_jobs=args.n_jobs, dpi=args.dpi, formats=args.figure_format, cache_dir=cache_dir / "figures")
+    print(f"[INFO:] Rendered {len(summary['rendered'])} figures, {len(summary['skipped'])} unchanged")
+
+    if args.trace or args.profile:
+        stop_tracing(trace_path.with_suffix(".json"))
+        print(f"[INFO:] Trace written to {trace_path.with_suffix('.json')}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,104 @@
+'''
+Script to choose the peak-to-peak rejection thresholds. Counts the epochs kept per recording and trigger for a grid of
+magnetometer and gradiometer thresholds, from the peak-to-peak amplitudes of all epochs (computed once, see utils/rejection.py).
+
+Run in the terminal:
+    python src/rejection_sweep.py -mag 3e-12 4e-12 5e-12 -grad 3000e-13 4000e-13 5000e-13
+
+The amplitudes stored by the last run of classify.py (data/cache/rejection) are used if they exist, add -recompute to preprocess
+and epoch the recordings again (e.g., after changing the ICA). The counts are saved to results/rejection/sweep.csv.
+A chosen threshold is used with python src/classify.py -reject_mag {MAG} -reject_grad {GRAD}.
+'''
+
+# utils
+import pathlib, argparse, csv
+
+# MEG package
+import mne
+
+# custom modules for preprocessing and rejection
+from utils.general_preprocess import preprocess_all, ica_dict, epoching
+from utils.rejection import PeakToPeakTable, DEFAULT_REJECT
+
+def input_parse():
+    parser=argparse.ArgumentParser()
+
+    # add arguments to parser
+    parser.add_argument("-mag", "--mag", type=float, nargs="+", help="magnetometer thresholds in T", default=[2e-12, 3e-12, DEFAULT_REJECT["mag"], 5e-12, 6e-12])
+    parser.add_argument("-grad", "--grad", type=float, nargs="+", help="gradiometer thresholds in T/m", default=[2000e-13, 3000e-13, DEFAULT_REJECT["grad"], 5000e-13, 6000e-13])
+    parser.add_argument("-recompute", "--recompute", action="store_true", help="preprocess and epoch the recordings instead of using the stored amplitudes")
+    parser.add_argument("-fused", "--fused", action="store_true", help="filter and downsample in one pass (faster, output differs slightly from raw.filter -> raw.resample)")
+    parser.add_argument("-n_jobs", "--n_jobs", type=int, help="number of worker processes for preprocessing (-1 uses all cpus)", default=1)
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    # args
+    args = input_parse()
+
+    ## PATHS and FILES ##
+    path = pathlib.Path(__file__)
+
+    # raw meg data paths
+    meg_path = path.parents[3] / "834761" / "0108" / "20230928_000000" / "MEG"
+    ica_path = path.parents[1] / "data" / "ICA"
+    cache_dir = path.parents[1] / "data" / "cache"
+    table_path = cache_dir / "rejection" / "peak_to_peak.npz"
+
+    # results path
+    results_path = path.parents[1] / "results" / "rejection"
+    results_path.mkdir(parents=True, exist_ok=True)
+
+    ## PEAK-TO-PEAK AMPLITUDES ##
+    if table_path.exists() and not args.recompute:
+        ptp_table = PeakToPeakTable.load(table_path)
+
+    else:
+        recording_names = ['001.self_block1',  '002.other_block1',
+                           '003.self_block2',  '004.other_block2',
+                           '005.self_block3',  '006.other_block3']
+
+        processed_raws = preprocess_all(meg_path, recording_names, ica_path, ica_dict(), cache_dir=cache_dir / "preprocessed", inplace=True,
+                                        n_jobs=args.n_jobs, fused=args.fused)
+
+        # epoch all recordings without rejection
+        epochs_dict = {}
+        for recording_name, raw in processed_raws.items():
+            if "self" in recording_name:
+                event_id = dict(self_positive=11, self_negative=12, button_img=23)
+            else:
+                event_id = dict(other_positive=21, other_negative=22, button_img=23)
+
+            events = mne.find_events(raw, min_duration = 2/raw.info["sfreq"])
+            epochs_dict[recording_name] = epoching(raw, events, tmin=-0.200, tmax=1.500, event_id=event_id, reject_criterion=None)
+
+        ptp_table = PeakToPeakTable.from_epochs_dict(epochs_dict)
+        ptp_table.save(table_path)
+
+    print(f"[INFO:] {ptp_table}")
+
+    ## SWEEP ##
+    counts = ptp_table.sweep(mag=args.mag, grad=args.grad)
+    triggers = sorted({trigger for group_counts in counts.values() for _, trigger in group_counts})
+
+    # one row per threshold combination and recording, one column per trigger
+    with open(results_path / "sweep.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["mag", "grad", "recording"] + triggers + ["total"])
+
+        for (mag, grad), group_counts in counts.items():
+            for recording_name in ptp_table.recording_names:
+                kept = [group_counts.get((recording_name, trigger), 0) for trigger in triggers]
+                writer.writerow([mag, grad, recording_name] + kept + [sum(kept)])
+
+    # kept epochs per threshold combination and trigger (all recordings)
+    print(f"{'mag':>10} {'grad':>10} " + " ".join(f"{trigger:>6}" for trigger in triggers) + f" {'total':>6} {'of':>6}")
+    for (mag, grad), group_counts in counts.items():
+        kept = [sum(count for (_, group_trigger), count in group_counts.items() if group_trigger == trigger) for trigger in triggers]
+        print(f"{mag:>10.2e} {grad:>10.2e} " + " ".join(f"{count:>6}" for count in kept) + f" {sum(kept):>6} {len(ptp_table):>6}")
+
+    print(f"[INFO:] Kept epochs per recording are saved to {results_path / 'sweep.csv'}")
+
+if __name__ == "__main__":
+    main()
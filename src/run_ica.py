@@ -1,72 +1,99 @@
-import pathlib
+import pathlib, argparse
+
+# plotting without a display
+import matplotlib
+matplotlib.use("Agg")
+
 import mne
 
+from utils.figures import export_figures, hash_inputs
+from utils.ica_fns import plot_ica_components, plot_ica_sources, fit_icas
+from utils.preprocess_graph import preprocessing_graph, run_graph
+
+def input_parse():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-n_jobs", "--n_jobs", type=int, help="number of worker processes fitting the ICAs and rendering the figures (-1 uses all cpus)", default=1)
+    parser.add_argument("-n_components", "--n_components", type=float, help="number of ICA components (>= 1) or proportion of variance explained (< 1)", default=0.9999)
+    parser.add_argument("-method", "--method", type=str, choices=["fastica", "infomax", "picard"], help="ICA method", default="fastica")
+    parser.add_argument("-random_state", "--random_state", type=int, help="seed of the ICA unmixing", default=42)
+    parser.add_argument("-dpi", "--dpi", type=int, help="resolution of raster figures", default=100)
+    parser.add_argument("-format", "--format", type=str, nargs="+", help="figure formats, e.g. png or pdf svg (vector)", default=["png"])
+    parser.add_argument("-fused", "--fused", action="store_true", help="filter and downsample in one pass (faster, but the ICA is then fitted on data that differs slightly from raw.filter -> raw.resample)")
+    parser.add_argument("-force", "--force", action="store_true", help="render all figures, also those whose data has not changed")
+    args = parser.parse_args()
+
+    return args
+
 def main():
+    args = input_parse()
+
     # define paths 
     path = pathlib.Path(__file__)
     meg_path = path.parents[3] / "834761" / "0108" / "20230928_000000" / "MEG"
+    cache_dir = path.parents[1] / "data" / "cache"
+
+    ica_outpath = path.parents[1] / "data" / "ICA"
+    ica_outpath.mkdir(parents=True, exist_ok=True)
+
+    # ICA fits and figures, run once all recordings are preprocessed
+    fit_jobs, figure_jobs = {}, []
+
+    # proportion of variance explained (float) or number of components (int)
+    n_components = int(args.n_components) if args.n_components >= 1 else args.n_components
 
     # define recording names 
     recording_names = ['001.self_block1',  '002.other_block1',
                        '003.self_block2',  '004.other_block2',
                        '005.self_block3',  '006.other_block3']
-    # load raw
+    # read, pick and crop (shared with preprocess) -> filter 1-40 hz -> resample (cached for the ICA workers)
+    graph = preprocessing_graph(ica_l_freq=1, h_freq=40, sfreq=250, fused=args.fused)
+
     for _, name in enumerate(recording_names):
         fif_fname = name[4:]
         full_path = meg_path / name / 'files' / (fif_fname + '.fif')
-        raw = mne.io.read_raw(full_path, preload=True)
-        raw.load_data()
-        raw.pick_types(meg=True, eeg=False, stim=True)
-
-        # remove bad channel  
-        raw.info['bads'] += ['MEG0422']
-        raw.drop_channels(raw.info['bads'])
 
-        # crop to remove initial HPI noise and noise at the end of each trial (verified by manually checking raws in run_raw.py)
-        cropped = raw.copy().crop(tmin=10, tmax=365)
-        del raw
+        # the data is read from the cache by the worker processes fitting the ICA and plotting the sources
+        raw_file = run_graph(full_path, graph, ["ica_fit"], cache_dir=cache_dir / "preprocessed", cache_nodes=["ica_fit"],
+                             load=False)["ica_fit"]
 
-        # some initial filtering 
-        filtered = cropped.copy().filter(l_freq=1, h_freq=40)
-        filtered.apply_proj()
+        fit_jobs[name] = dict(raw_file=raw_file, ica_file=ica_outpath / f"{name}-ica.fif", n_components=n_components, method=args.method,
+                              random_state=args.random_state, max_iter=3000, pca_cache_dir=cache_dir / "ica" / "pca")
 
-        resampled = filtered.copy().resample(250)
-        del filtered
+    # fit ICA (in parallel, the PCA of each recording is cached so refits only redo the unmixing)
+    reports = fit_icas(fit_jobs, n_jobs=args.n_jobs)
 
-        # do ICA 
-        ica = mne.preprocessing.ICA(n_components=0.9999, random_state=42, max_iter=3000)
+    for name, report in reports.items():
+        converged = "converged" if report["converged"] else "did NOT converge"
+        pca = "cached PCA" if report["pca_cached"] else "new PCA"
+        print(f"[INFO:] {name}: {report['n_components_']} components, {converged} after {report['n_iter_']} iterations ({report['fit_s']:.1f} s, {pca})")
 
-        # fit ICA
-        ica.fit(resampled)
+    for name, fit_job in fit_jobs.items():
+        ica = mne.preprocessing.read_ica(fit_job["ica_file"])
 
-        # save ICA 
-        ica_outpath = path.parents[1] / "data" / "ICA"
-        ica_outpath.mkdir(parents=True, exist_ok=True)
-        ica.save(ica_outpath / f"{name}-ica.fif", overwrite=True)
+        # figures are only re-rendered if the fit (or the data for the sources) changed
+        fit_hash = hash_inputs([ica.pca_components_, ica.pca_mean_, ica.unmixing_matrix_, ica.mixing_matrix_])
 
-        # plot & save components
-        components = ica.plot_components(show=False)
-
-        # saving components
+        # components, saved separately
         comp_path = path.parents[1] / "plots" / "ICA" / name
-        comp_path.mkdir(parents=True, exist_ok=True) # make plots path if it does not exist
-
-        # unzip components and save each component separately
-        for i, component in enumerate(components):
-            component.savefig(comp_path / f"component_{i}.png")
+        figure_jobs.append(dict(plot_fn=plot_ica_components, kwargs=dict(ica_file=fit_job["ica_file"]),
+                                savepath=comp_path / "component_{index}.png", inputs=fit_hash))
 
-        # get sources 
+        # sources, in batches of 20 components
         source_path = path.parents[1] / "plots" / "ICA" / "sources" / name
-        source_path.mkdir(parents=True, exist_ok=True) # make plots path if it does not exist
-
-        # saving source
         batch_size = 20
 
-        with mne.viz.use_browser_backend('matplotlib'):
-            for start_pick in range(0, ica.n_components_, batch_size):
-                end_pick = min(start_pick + batch_size, ica.n_components_)
-                sources = ica.plot_sources(resampled, show=False, show_scrollbars=False, picks=(range(start_pick, end_pick)))
-                sources.savefig(source_path / f"sources_{start_pick}_{end_pick}.png")
+        for start_pick in range(0, ica.n_components_, batch_size):
+            end_pick = min(start_pick + batch_size, ica.n_components_)
+            figure_jobs.append(dict(plot_fn=plot_ica_sources,
+                                    kwargs=dict(ica_file=fit_job["ica_file"], raw_file=fit_job["raw_file"], start_pick=start_pick, end_pick=end_pick),
+                                    savepath=source_path / f"sources_{start_pick}_{end_pick}.png",
+                                    inputs=[fit_hash, fit_job["raw_file"], start_pick, end_pick]))
+
+    # render offscreen in parallel
+    summary = export_figures(figure_jobs, n_jobs=args.n_jobs, dpi=args.dpi, formats=args.format,
+                             cache_dir=cache_dir / "figures", force=args.force)
+    print(f"[INFO:] Rendered {len(summary['rendered'])} figures, {len(summary['skipped'])} unchanged")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -18,10 +18,11 @@ def main():
 
     # load raw
     chosen_recording = recording_names[4]
-    raw = mne.io.read_raw(meg_path / chosen_recording / 'files' / f"{chosen_recording[4:]}.fif", preload=True)
+    raw = mne.io.read_raw(meg_path / chosen_recording / 'files' / f"{chosen_recording[4:]}.fif", preload=False)
 
-    # pick types
+    # pick types before loading, so that only these channels are read into memory
     raw.pick_types(meg=True, eeg=False, stim=True)
+    raw.load_data()
 
     # filter raws
     raw.filter(h_freq=40, l_freq = 0.1, n_jobs=4) # alters raw in-place
@@ -0,0 +1,118 @@
+'''
+Sanity check that the average-then-invert contrast (stc_plot.get_mean_source_time_courses) gives the same mean source time courses
+as inverting every single epoch and averaging afterwards (get_source_time_courses + split_stcs + np.mean).
+
+Run in terminal:
+    python src/sanity_checks/contrast_equivalence_check.py
+
+Add -synthetic to run the check offline on the synthetic recordings and subject of the benchmarks (see src/benchmarks/synthetic.py).
+'''
+
+# utils
+import pathlib, argparse, sys
+sys.path.append(str(pathlib.Path(__file__).parents[2]))
+sys.path.append(str(pathlib.Path(__file__).parents[1])) # stc_plot imports utils as a top-level package
+
+# MEG package
+import mne
+
+# numpy
+import numpy as np
+
+# custom modules for preprocessing and contrasts
+from src.utils.general_preprocess import preprocess_all, ica_dict, epoching
+from src.utils.rejection import DEFAULT_REJECT
+from src.utils.classify_fns import combine_triggers
+from src.stc_plot import get_source_time_courses, get_mean_source_time_courses, split_stcs
+from src.benchmarks.synthetic import make_dataset
+
+def input_parse():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-synthetic", "--synthetic", action="store_true", help="run on the synthetic benchmark data instead of the MEG data")
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    # args
+    args = input_parse()
+
+    ## PATHS and FILES ##
+    path = pathlib.Path(__file__)
+    cache_dir = path.parents[2] / "data" / "cache"
+
+    recording_names = ['001.self_block1',  '002.other_block1',
+                       '003.self_block2',  '004.other_block2',
+                       '005.self_block3',  '006.other_block3']
+
+    if args.synthetic:
+        # small synthetic dataset (generated once, as for src/benchmarks/run_benchmarks.py -size small)
+        recording_names = recording_names[:2]
+        paths = make_dataset(path.parents[2] / "data" / "benchmarks" / "small", recording_names, duration=60., grade=4, spacing="ico3")
+        meg_path, ica_path, subjects_dir, subject = paths["meg_path"], paths["ica_path"], paths["subjects_dir"], paths["subject"]
+        preprocess_kwargs, inverse_cache_dir = dict(tmax=55), None
+    else:
+        # raw meg data paths
+        meg_path = path.parents[4] / "834761" / "0108" / "20230928_000000" / "MEG"
+        ica_path = path.parents[2] / "data" / "ICA"
+        subjects_dir = path.parents[4] / "835482"
+        subject = "0108"
+        preprocess_kwargs, inverse_cache_dir = dict(cache_dir=cache_dir / "preprocessed", inplace=True), cache_dir / "inverse"
+
+    ## LOAD + PREPROCESS DATA ##
+    # get ica components to exclude
+    ica_components = ica_dict()
+
+    # preprocess all recordings
+    processed_raws = preprocess_all(meg_path, recording_names, ica_path, ica_components, **preprocess_kwargs)
+
+    # prepare for epochs, define rejection criterion
+    epochs_dict = {}
+    reject_criterion = DEFAULT_REJECT
+
+    # iterate over values in processed_raws
+    for recording_name, raw in processed_raws.items():
+        if "self" in recording_name:
+            event_id = dict(self_positive=11, self_negative=12, button_img=23)
+        else:
+            event_id = dict(other_positive=21, other_negative=22, button_img=23)
+
+        # get events
+        events  = mne.find_events(raw, min_duration = 2/raw.info["sfreq"])
+
+        # epoch data
+        epochs = epoching(raw, events, tmin=-0.200, tmax=1.500, event_id=event_id, reject_criterion=reject_criterion)
+
+        # append to dict
+        epochs_dict[recording_name] = epochs
+
+    ## PER-EPOCH PATH ##
+    stcs, y = get_source_time_courses(epochs_dict, subjects_dir, subject=subject, label=None, cache_dir=inverse_cache_dir)
+    y = combine_triggers(y, combine=[[11, 21], [12, 22]])
+    stcs_1, stcs_2 = split_stcs(stcs, y, trigger1=1121, trigger2=1222)
+
+    per_epoch = {"positive": np.mean(stcs_1), "negative": np.mean(stcs_2)}
+    del stcs, stcs_1, stcs_2
+
+    ## AVERAGE-THEN-INVERT PATH ##
+    conditions = {"positive": [11, 21], "negative": [12, 22]}
+    average_first = get_mean_source_time_courses(epochs_dict, conditions, subjects_dir, subject=subject, label=None, cache_dir=inverse_cache_dir)
+
+    ## STREAMING PER-EPOCH PATH ##
+    streamed = get_mean_source_time_courses(epochs_dict, conditions, subjects_dir, subject=subject, label=None, cache_dir=inverse_cache_dir,
+                                            average_first=False)
+
+    for condition in conditions:
+        for name, mean_stcs in [("average-then-invert", average_first), ("streaming", streamed)]:
+            difference = np.abs(per_epoch[condition].data - mean_stcs[condition].data).max()
+            relative_difference = difference / np.abs(per_epoch[condition].data).max()
+
+            print(f"[INFO:] {condition}, {name}: max relative difference {relative_difference:.2e}")
+
+            assert np.allclose(per_epoch[condition].data, mean_stcs[condition].data, rtol=1e-8, atol=0), f"{condition} differs ({name})"
+
+    print("[INFO:] Average-then-invert and streaming match the per-epoch path")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+'''
+Sanity check that the fused filter + downsampling stage (utils.filter_fns.filter_resample) gives the same data as raw.filter followed by
+raw.resample, in the time domain and in the power spectrum of the passband, and how much faster it is.
+
+Run in terminal:
+    python src/sanity_checks/fused_filter_check.py
+'''
+
+# utils
+import pathlib, sys, time
+sys.path.append(str(pathlib.Path(__file__).parents[2]))
+
+# MEG package
+import mne
+
+# numpy
+import numpy as np
+
+# custom modules for preprocessing
+from src.utils.preprocess_graph import preprocessing_graph, run_graph
+from src.utils.filter_fns import filter_resample
+
+def main():
+    ## PATHS and FILES ##
+    path = pathlib.Path(__file__)
+
+    # raw meg data paths
+    meg_path = path.parents[4] / "834761" / "0108" / "20230928_000000" / "MEG"
+
+    chosen_recording = '001.self_block1'
+    full_path = meg_path / chosen_recording / 'files' / (chosen_recording[4:] + '.fif')
+
+    # read, pick and crop (the input of both filter paths)
+    l_freq, h_freq, sfreq = 0.1, 40, 250
+    graph = preprocessing_graph(l_freq=l_freq, h_freq=h_freq, sfreq=sfreq)
+    prefix = run_graph(full_path, graph, ["prefix"])["prefix"]
+
+    ## FILTER -> RESAMPLE ##
+    start = time.perf_counter()
+    separate = prefix.copy().filter(l_freq=l_freq, h_freq=h_freq).resample(sfreq)
+    separate_time = time.perf_counter() - start
+
+    ## FUSED ##
+    start = time.perf_counter()
+    fused = filter_resample(prefix, l_freq=l_freq, h_freq=h_freq, sfreq=sfreq)
+    fused_time = time.perf_counter() - start
+
+    print(f"[INFO:] filter -> resample {separate_time:.1f} s, fused {fused_time:.1f} s ({separate_time / fused_time:.1f}x)")
+
+    assert fused.n_times == separate.n_times and fused.first_samp == separate.first_samp, "fused output has another length"
+
+    # events are kept on the same samples
+    events_separate = mne.find_events(separate, min_duration=2/sfreq)
+    events_fused = mne.find_events(fused, min_duration=2/sfreq)
+    assert np.array_equal(events_separate, events_fused), "events differ"
+
+    for ch_type in ["mag", "grad"]:
+        picks = mne.pick_types(separate.info, meg=ch_type)
+        data_separate, data_fused = separate.get_data(picks), fused.get_data(picks)
+
+        # time domain, relative to the root mean square of the data
+        difference = np.sqrt(np.mean((data_fused - data_separate) ** 2)) / np.sqrt(np.mean(data_separate ** 2))
+
+        # power spectrum of the passband (away from the transition bands)
+        psd_separate, freqs = mne.time_frequency.psd_array_welch(data_separate, sfreq, fmin=1, fmax=35, n_fft=2048, verbose=False)
+        psd_fused, _ = mne.time_frequency.psd_array_welch(data_fused, sfreq, fmin=1, fmax=35, n_fft=2048, verbose=False)
+        psd_difference = np.abs(psd_fused / psd_separate - 1).max()
+
+        print(f"[INFO:] {ch_type}: relative RMS difference {difference:.2e}, max relative PSD difference (1-35 Hz) {psd_difference:.2e}")
+
+        assert difference < 1e-3, f"{ch_type} differs in the time domain"
+        assert psd_difference < 1e-2, f"{ch_type} differs in the passband"
+
+    print("[INFO:] Fused filtering matches filter -> resample")
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ import mne
 
 # custom modules for preprocessing
 from src.utils.general_preprocess import preprocess, ica_dict, epoching
+from src.utils.rejection import DEFAULT_REJECT
 from src.utils.arguments import input_parse
 
 # plotting 
@@ -42,6 +43,7 @@ def main():
     # raw meg data paths 
     meg_path = path.parents[4] / "834761" / "0108" / "20230928_000000" / "MEG"
     ica_path = path.parents[2] / "data" / "ICA"
+    cache_dir = path.parents[2] / "data" / "cache"
 
     # source reconstruction paths
     bem_path = path.parents[4] / "835482" / "0108" / "bem"
@@ -63,7 +65,7 @@ def main():
     ica_components = ica_dict()
     
     # load and preprocess data
-    processed_raw = preprocess(meg_path, chosen_recording, ica_path, ica_components[chosen_recording])
+    processed_raw = preprocess(meg_path, chosen_recording, ica_path, ica_components[chosen_recording], cache_dir=cache_dir / "preprocessed", inplace=True)
 
     ## EPOCHING ##
     # get events
@@ -76,7 +78,7 @@ def main():
         event_id = dict(other_positive=21, other_negative=22, button_img=23)
 
     # do epochs 
-    reject = dict(mag=4e-12, grad=4000e-13) # T, T/m, V
+    reject = DEFAULT_REJECT # T, T/m
     epochs = epoching(processed_raw, events, event_id=event_id, tmin=-0.200, tmax=1.000, reject_criterion=reject)
 
     ## SOURCE RECONSTRUCTION ##
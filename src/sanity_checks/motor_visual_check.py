@@ -17,7 +17,9 @@ import numpy as np
 
 # custom modules for preprocessing and classification
 from src.utils.general_preprocess import preprocess_all, ica_dict, epoching
+from src.utils.rejection import DEFAULT_REJECT
 from src.utils.classify_fns import simple_classification, plot_classification, get_source_space_data
+from src.utils.trial_index import TrialIndex
 
 def main(): 
     ## PATHS and FILES ## 
@@ -26,6 +28,7 @@ def main():
     # raw meg data paths 
     meg_path = path.parents[4] / "834761" / "0108" / "20230928_000000" / "MEG"
     ica_path = path.parents[2] / "data" / "ICA"
+    cache_dir = path.parents[2] / "data" / "cache"
     subjects_dir = path.parents[4] / "835482" 
 
     # plot path
@@ -41,11 +44,11 @@ def main():
     ica_components = ica_dict()
 
     # preprocess all recordings
-    processed_raws = preprocess_all(meg_path, recording_names, ica_path, ica_components)
+    processed_raws = preprocess_all(meg_path, recording_names, ica_path, ica_components, cache_dir=cache_dir / "preprocessed", inplace=True)
 
     # prepare for epochs, define rejection criterion
-    epochs_dict = {}
-    reject_criterion = dict(mag=4e-12, grad=4000e-13)
+    epochs_dict, events_dict = {}, {}
+    reject_criterion = DEFAULT_REJECT
 
     # iterate over values in processed_raws
     for recording_name, raw in processed_raws.items(): 
@@ -62,10 +65,16 @@ def main():
 
         # append to dict
         epochs_dict[recording_name] = epochs
+        events_dict[recording_name] = events
+
+    # index of all trials (including dropped epochs)
+    trial_index = TrialIndex.from_epochs_dict(epochs_dict, events_dict)
+    print(f"[INFO:] {trial_index}")
+    print(f"[INFO:] Kept epochs per valence and condition: {trial_index.counts('valence', 'condition', dropped=False)}")
 
     # get source space data
     label = "lh.precentral.label"
-    X, y = get_source_space_data(epochs_dict, subjects_dir, subject="0108", label=label)
+    X, y = get_source_space_data(epochs_dict, subjects_dir, subject="0108", label=label, cache_dir=cache_dir / "inverse")
 
     # get first value from epochs_dict
     first_epochs = list(epochs_dict.values())[0]
@@ -75,18 +84,23 @@ def main():
     triggers = [11, 21, 23]
 
     # complete simple classification
-    mean_scores, y_pred_all, y_true_all, permutation_scores = simple_classification(
+    mean_scores, y_pred_all, y_true_all, permutation_scores, permutation_info = simple_classification(
                                 X=X, 
                                 y=y, 
                                 triggers=triggers,
                                 penalty='l2', 
                                 C=1e-3, 
-                                combine=[[11, 21]]) # combines the two positive triggers
+                                combine=[[11, 21]], # combines the two positive triggers
+                                trial_index=trial_index)
     
+    # significant clusters (cluster-mass test, only with a fixed number of permutations and without bin_size)
+    clusters = permutation_info["clusters"][permutation_info["cluster_pvalues"] < 0.05] if "clusters" in permutation_info else None
+
     plot_classification(
         times = times, 
         mean_scores = mean_scores, 
         permutation_scores = permutation_scores,
+        clusters = clusters,
         title = f"Motor vs visual activation in precentral gyrus (lh)",
         savepath = plot_path / f"{label}_{triggers}.png"
     )
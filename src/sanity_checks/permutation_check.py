@@ -0,0 +1,101 @@
+'''
+Sanity check of the permutation statistics of simple_classification on synthetic data (runs offline, no MEG data needed).
+
+Checks that coarse-to-fine decoding (bin_size) does not report corrections across time, as the samples of a bin that was not
+screened in share the permutation scores of their bin, and that the corrections reject permutations not run at every sample.
+Checks that the p-values of the sequential permutation test are calibrated under the null (despite the early stopping).
+
+Run in terminal:
+    python src/sanity_checks/permutation_check.py
+'''
+
+# utils
+import pathlib, sys
+sys.path.append(str(pathlib.Path(__file__).parents[2]))
+
+# numpy
+import numpy as np
+
+# cross validation
+from sklearn.model_selection import StratifiedKFold
+
+# custom modules for classification
+from src.utils.classify_fns import simple_classification, correct_across_time
+from src.utils.batched_classify_fns import sequential_permutation_scores
+
+def make_data(n_trials=80, n_vertices=10, n_times=60, effect=slice(20, 30), effect_size=1.0, seed=0):
+    '''
+    Gaussian noise with two classes (triggers 11 and 12) that differ in the samples of effect
+    '''
+    rng = np.random.default_rng(seed)
+
+    y = np.repeat([11, 12], n_trials // 2).astype(float)
+    X = rng.normal(size=(n_trials, n_vertices, n_times))
+    X[y == 11, :, effect] += effect_size
+
+    return X, y
+
+def check_binned_corrections():
+    X, y = make_data()
+    n_times = X.shape[2]
+
+    _, _, _, _, unbinned_info = simple_classification(X, y, triggers=[11, 12], engine="batched", n_permutations=50)
+    mean_scores, _, _, permutation_scores, binned_info = simple_classification(X, y, triggers=[11, 12], engine="batched", n_permutations=50,
+                                                                               bin_size=5)
+
+    # the unbinned decoding is corrected across time and finds the effect
+    assert "clusters" in unbinned_info and "corrected_pvalues" in unbinned_info, "corrections missing without bin_size"
+    significant = unbinned_info["clusters"][unbinned_info["cluster_pvalues"] < 0.05]
+    assert len(significant) > 0, "no significant cluster for the effect"
+
+    # the binned decoding still has one value per sample, but no corrections across time
+    assert len(mean_scores) == n_times and permutation_scores.shape[0] == n_times, "binned output is not per sample"
+    assert binned_info["screened"].any() and not binned_info["screened"].all(), "screening did not separate the effect"
+    for key in ["corrected_pvalues", "clusters", "cluster_masses", "cluster_pvalues"]:
+        assert key not in binned_info, f"{key} reported with bin_size"
+
+    print(f"[INFO:] Binned decoding: {binned_info['screened'].sum()} of {n_times} samples screened in, no corrections across time")
+
+def check_correction_guard():
+    # permutations a sample did not run (sequential permutation test) cannot be corrected across time
+    permutation_scores = np.random.default_rng(0).uniform(size=(20, 50))
+    permutation_scores[5:10, 30:] = np.nan
+
+    try:
+        correct_across_time(np.full(20, 0.6), permutation_scores)
+    except ValueError:
+        print("[INFO:] Corrections across time reject permutation scores with NaN")
+    else:
+        raise AssertionError("correct_across_time accepted NaN permutation scores")
+
+def check_sequential_calibration(n_times=500, alpha=0.05):
+    # no effect at any sample, so the samples with p <= alpha are false positives
+    X, y = make_data(n_trials=60, n_vertices=5, n_times=n_times, effect_size=0, seed=1)
+    cv = StratifiedKFold(n_splits=5, random_state=42, shuffle=True)
+
+    _, n_used, pvalues = sequential_permutation_scores(X, y, cv, n_permutations=100, max_permutations=1000, alpha=alpha)
+
+    # at most alpha (up to three binomial standard errors), the scores are discrete so the test is somewhat conservative
+    false_positive_rate = np.mean(pvalues <= alpha)
+    tolerance = 3 * np.sqrt(alpha * (1 - alpha) / n_times)
+    print(f"[INFO:] Sequential test under the null: {false_positive_rate:.3f} of {n_times} samples at p <= {alpha}, "
+          f"{n_used.mean():.1f} permutations per sample")
+
+    assert false_positive_rate <= alpha + tolerance, f"sequential test is anti-conservative ({false_positive_rate:.3f} > {alpha})"
+    assert n_used.mean() < 100, "sequential test did not save permutations under the null"
+
+    # significant samples only stop once the interval is below alpha (72 permutations at alpha=0.05, confidence=0.95)
+    assert np.all(n_used[pvalues <= alpha] >= 72), "a significant sample stopped before its interval could be below alpha"
+
+def main():
+    # the class balancing draws trials with np.random
+    np.random.seed(0)
+
+    check_binned_corrections()
+    check_correction_guard()
+    check_sequential_calibration()
+
+    print("[INFO:] Permutation statistics checks passed")
+
+if __name__ == "__main__":
+    main()
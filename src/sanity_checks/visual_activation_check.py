@@ -20,6 +20,7 @@ import mne
 
 # custom module
 from src.utils.general_preprocess import preprocess, epoching, ica_dict, create_evoked
+from src.utils.rejection import DEFAULT_REJECT
 from src.utils.arguments import input_parse
 
 def main(): 
@@ -31,6 +32,7 @@ def main():
 
     meg_path = path.parents[4] / "834761" / "0108" / "20230928_000000" / "MEG"
     ica_path = path.parents[2] / "data" / "ICA"
+    cache_dir = path.parents[2] / "data" / "cache"
 
     plots_path = path.parents[2] / "plots" / "sanity_checks" / "visual_activation"
     plots_path.mkdir(parents=True, exist_ok=True) # make plots path if it does not exist
@@ -47,7 +49,7 @@ def main():
     ica_components = ica_dict()
     
     # load and preprocess data
-    processed_raw = preprocess(meg_path, chosen_recording, ica_path, ica_components[chosen_recording])
+    processed_raw = preprocess(meg_path, chosen_recording, ica_path, ica_components[chosen_recording], cache_dir=cache_dir / "preprocessed", inplace=True)
 
     # get events
     events  = mne.find_events(processed_raw, min_duration = 2/processed_raw.info["sfreq"])
@@ -64,7 +66,7 @@ def main():
         cond = "other"
 
     # do epochs 
-    reject = dict(mag=4e-12, grad=4000e-13) # T, T/m, V
+    reject = DEFAULT_REJECT # T, T/m
 
     epochs = epoching(processed_raw, events, event_id=event_id, tmin=-0.200, tmax=1.000, reject_criterion=reject)
     print(epochs)
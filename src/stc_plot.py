@@ -6,9 +6,11 @@ import mne
 import pathlib
 
 from utils.general_preprocess import preprocess_all, ica_dict, epoching
-from utils.classify_fns import combine_triggers
+from utils.source_fns import get_inverse_operator
+from utils.trial_index import TrialIndex
+from utils.rejection import DEFAULT_REJECT
 
-def get_source_time_courses(epochs_dict:dict, subjects_dir, subject:str="0108", label=None, method="dSPM"):
+def get_source_time_courses(epochs_dict:dict, subjects_dir, subject:str="0108", label=None, method="dSPM", cache_dir=None):
     '''
     Extract source space data for contrasts 
     (loosely based on https://mne.tools/stable/auto_examples/decoding/decoding_spatio_temporal_source.html#ex-dec-st-source)
@@ -18,6 +20,7 @@ def get_source_time_courses(epochs_dict:dict, subjects_dir, subject:str="0108",
         subjects_dir (str): path to subjects_dir
         subject (str): subject name (defaults to "0108")
         label (str): label name
+        cache_dir (pathlib.Path): directory for cached inverse operators and noise covariances (see utils.source_fns)
     '''
     # set empty array for y
     y = np.zeros(0)
@@ -34,16 +37,8 @@ def get_source_time_courses(epochs_dict:dict, subjects_dir, subject:str="0108",
     combined_stcs = []
 
     for epochs_index, (recording_name, epochs) in enumerate(epochs_dict.items()):
-        fwd_name = f"{recording_name[4:]}-oct-6-src-5120-fwd.fif"
-
-        # read forward solution
-        fwd = mne.read_forward_solution(subjects_dir / subject / 'bem' / fwd_name)
-
-        # source estimation! 
-        noise_cov = mne.compute_covariance(epochs, tmax=0.000)
-        
-        inv = mne.minimum_norm.make_inverse_operator(epochs.info,
-                                                     fwd, noise_cov)
+        # forward solution + noise covariance -> inverse operator (cached)
+        inv = get_inverse_operator(epochs, recording_name, subjects_dir, subject=subject, cache_dir=cache_dir)
   
         stcs = mne.minimum_norm.apply_inverse_epochs(epochs, inv, lambda2=1,
                                                      method=method, label=label,
@@ -54,6 +49,107 @@ def get_source_time_courses(epochs_dict:dict, subjects_dir, subject:str="0108",
 
     return combined_stcs, y 
 
+def is_linear_inverse(inv, method="dSPM", pick_ori="normal"):
+    '''
+    Whether applying the inverse operator is linear in the sensor data (so that the mean of the inverted epochs equals the
+    inverse of the mean epoch). True for MNE/dSPM/sLORETA/eLORETA unless free orientations are combined into their norm (pick_ori=None).
+    '''
+    fixed_orientation = inv['source_ori'] == mne.io.constants.FIFF.FIFFV_MNE_FIXED_ORI
+
+    return method in ["MNE", "dSPM", "sLORETA", "eLORETA"] and (pick_ori in ["normal", "vector"] or fixed_orientation)
+
+def get_mean_source_time_courses(epochs_dict:dict, conditions:dict, subjects_dir, subject:str="0108", label=None, method="dSPM",
+                                 pick_ori="normal", cache_dir=None, average_first=True, trial_index=None):
+    '''
+    Streaming alternative to get_source_time_courses + split_stcs + np.mean, where memory does not grow with the number of trials.
+
+    If average_first and the inverse is linear (see is_linear_inverse), the epochs of each recording are averaged per condition
+    in sensor space and inverted once per recording and condition. The recordings are then weighted by their trial counts, which
+    equals the mean of the per-epoch source estimates. Otherwise the inverse is applied one epoch at a time and added to a
+    running sum per condition.
+
+    Args
+        epochs_dict (dict): dictionary with epochs for each recording (keys are recording names, values are epochs objects)
+        conditions (dict): triggers to average per condition, e.g., {"positive": [11, 21], "negative": [12, 22]}
+        subjects_dir (str): path to subjects_dir
+        subject (str): subject name (defaults to "0108")
+        label (str): label name
+        method (str): inverse method
+        pick_ori (str): orientation to pick (as in apply_inverse_epochs)
+        cache_dir (pathlib.Path): directory for cached inverse operators and noise covariances (see utils.source_fns)
+        average_first (bool): average in sensor space before inverting when the inverse is linear
+        trial_index (TrialIndex): select the epochs of each condition through this index (see utils.trial_index) instead of
+                                  the events of the epochs
+
+    Returns
+        mean_stcs (dict): mean source estimate per condition
+    '''
+    # load labels if relevant (if None, it will do a whole brain analysis)
+    if label is not None:
+        label_path = subjects_dir / subject / 'label' / label
+        label = mne.read_label(label_path)
+
+    sums = {}
+    counts = {condition: 0 for condition in conditions}
+    templates = {}
+
+    def accumulate(condition, stc, weight=1):
+        # add to the running sum of the condition (in epoch order, as np.mean over the list of stcs)
+        if condition in sums:
+            sums[condition] += weight * stc.data
+        else:
+            sums[condition] = weight * stc.data
+            templates[condition] = stc
+
+        counts[condition] += weight
+
+    for recording_name, epochs in epochs_dict.items():
+        # forward solution + noise covariance -> inverse operator (cached)
+        inv = get_inverse_operator(epochs, recording_name, subjects_dir, subject=subject, cache_dir=cache_dir)
+
+        # triggers of the kept epochs of the recording (in epoch order)
+        if trial_index is not None:
+            recording_trials = trial_index.kept().select(recording=recording_name)
+            if len(recording_trials) != len(epochs):
+                raise ValueError(f"{recording_name} has {len(epochs)} epochs but {len(recording_trials)} kept trials in {trial_index}")
+            epoch_triggers = recording_trials.trigger
+        else:
+            epoch_triggers = epochs.events[:, 2]
+
+        if average_first and is_linear_inverse(inv, method, pick_ori):
+            for condition, triggers in conditions.items():
+                selection = recording_trials.mask(trigger=triggers) if trial_index is not None else np.isin(epoch_triggers, triggers)
+                if not selection.any():
+                    continue
+
+                evoked = epochs[selection].average()
+
+                # noise normalisation as for single epochs (apply_inverse_epochs uses nave=1)
+                evoked.nave = 1
+
+                stc = mne.minimum_norm.apply_inverse(evoked, inv, lambda2=1, method=method,
+                                                     label=label, pick_ori=pick_ori)
+
+                accumulate(condition, stc, weight=int(selection.sum()))
+
+            continue
+
+        stcs = mne.minimum_norm.apply_inverse_epochs(epochs, inv, lambda2=1,
+                                                     method=method, label=label,
+                                                     pick_ori=pick_ori, return_generator=True)
+
+        for trigger, stc in zip(epoch_triggers, stcs):
+            for condition, triggers in conditions.items():
+                if trigger in triggers:
+                    accumulate(condition, stc)
+
+    mean_stcs = {}
+    for condition in sums:
+        mean_stcs[condition] = templates[condition].copy()
+        mean_stcs[condition].data = sums[condition] / counts[condition]
+
+    return mean_stcs
+
 def split_stcs(stcs_list, y, trigger1, trigger2):
     '''
     Split stcs into self and other conditions
@@ -70,10 +166,13 @@ def split_stcs(stcs_list, y, trigger1, trigger2):
 
 def plot_stcs(stcs, subjects_dir, subject="0108", savepath=None):
     '''
-    Plot source time course object 
+    Plot source time course object (the mean of a list of stcs, or an already averaged stc, see get_mean_source_time_courses)
     '''
     # get mean stc
-    mean_stcs = np.mean(stcs)
+    if isinstance(stcs, mne.SourceEstimate):
+        mean_stcs = stcs
+    else:
+        mean_stcs = np.mean(stcs)
 
     # plot params
     clim = dict(kind='value', lims=[0.35, 0.85, 1.4])
@@ -99,6 +198,7 @@ def main():
     # raw meg data paths 
     meg_path = path.parents[3] / "834761" / "0108" / "20230928_000000" / "MEG"
     ica_path = path.parents[1] / "data" / "ICA"
+    cache_dir = path.parents[1] / "data" / "cache"
     subjects_dir = path.parents[3] / "835482" 
 
     # plot path
@@ -114,11 +214,11 @@ def main():
     ica_components = ica_dict()
 
     # preprocess all recordings
-    processed_raws = preprocess_all(meg_path, recording_names, ica_path, ica_components)
+    processed_raws = preprocess_all(meg_path, recording_names, ica_path, ica_components, cache_dir=cache_dir / "preprocessed", inplace=True)
 
     # prepare for epochs, define rejection criterion
-    epochs_dict = {}
-    reject_criterion = dict(mag=4e-12, grad=4000e-13)
+    epochs_dict, events_dict = {}, {}
+    reject_criterion = DEFAULT_REJECT
 
     # iterate over values in processed_raws
     for recording_name, raw in processed_raws.items(): 
@@ -135,19 +235,21 @@ def main():
 
         # append to dict
         epochs_dict[recording_name] = epochs
+        events_dict[recording_name] = events
 
-    # get source space data
-    stcs, y = get_source_time_courses(epochs_dict, subjects_dir, subject="0108", label=None)
-
-    # combine triggers
-    y = combine_triggers(y, combine=[[11, 21], [12, 22]])
+    # index of all trials (including dropped epochs)
+    trial_index = TrialIndex.from_epochs_dict(epochs_dict, events_dict)
+    print(f"[INFO:] {trial_index}")
+    print(f"[INFO:] Kept epochs per valence and condition: {trial_index.counts('valence', 'condition', dropped=False)}")
 
-    # get stcs for the two groups (based on triggers)
-    stcs_1, stcs_2 = split_stcs(stcs, y, trigger1=1121, trigger2=1222)
+    # get mean source time courses for the two groups (based on triggers), averaged per recording in sensor space before inverting
+    conditions = {"positive": [11, 21], "negative": [12, 22]}
+    mean_stcs = get_mean_source_time_courses(epochs_dict, conditions, subjects_dir, subject="0108", label=None, cache_dir=cache_dir / "inverse",
+                                             trial_index=trial_index)
 
     # plot contrast for both stcs and stcs2 using plot_stcs:
-    plot_stcs(stcs_1, subjects_dir, subject="0108", savepath=plot_path / "positive_self_and_other.png")
-    plot_stcs(stcs_2, subjects_dir, subject="0108", savepath=plot_path / "negative_self_and_other.png")
+    plot_stcs(mean_stcs["positive"], subjects_dir, subject="0108", savepath=plot_path / "positive_self_and_other.png")
+    plot_stcs(mean_stcs["negative"], subjects_dir, subject="0108", savepath=plot_path / "negative_self_and_other.png")
 
 if __name__ == "__main__": 
     main()
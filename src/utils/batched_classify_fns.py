@@ -0,0 +1,601 @@
+'''
+Batched (vectorised) time-resolved decoding.
+
+Standardises, fits and predicts diagonal-covariance classifiers for all time points and all
+cross validation folds at once as NumPy operations over the full (n_trials, n_vertices, n_times) array.
+Mirrors the per-sample sklearn loop in simple_classification (StandardScaler + GaussianNB + StratifiedKFold)
+'''
+import numpy as np
+from scipy.stats import beta
+from sklearn.utils import check_random_state
+
+from .parallel import get_n_jobs, get_executor, shared_array, load_shared_array
+
+# diagonal-covariance models supported by the batched engine
+#   "gnb": gaussian naive bayes (one variance per class, as sklearn.naive_bayes.GaussianNB)
+#   "diag_lda": diagonal LDA (one pooled within-class variance shared by all classes)
+MODELS = ["gnb", "diag_lda"]
+
+def standardize(X):
+    '''
+    Standardise each (vertex, time) feature across trials (equivalent to fitting a StandardScaler on every time sample)
+
+    Args
+        X (array): data array with shape (n_trials, n_vertices, n_times)
+
+    Returns
+        X_std (array): standardised data with the same shape as X
+    '''
+    mean = X.mean(axis=0)
+    scale = X.std(axis=0)
+
+    # constant features are left unscaled (as in sklearn)
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0
+
+    return (X - mean) / scale
+
+def fit_diagonal_model(X, y, classes, model="gnb", var_smoothing=1e-9):
+    '''
+    Fit a diagonal-covariance classifier independently for every time point
+
+    Args
+        X (array): training data with shape (n_trials, n_vertices, n_times)
+        y (array): labels with shape (n_trials, )
+        classes (array): sorted unique classes
+        model (str): one of MODELS
+        var_smoothing (float): portion of the largest feature variance added to all variances (as in GaussianNB)
+
+    Returns
+        params (dict): log_prior (n_classes, ), theta and var (n_classes, n_vertices, n_times)
+    '''
+    if model not in MODELS:
+        raise ValueError(f"model must be one of {MODELS}, got {model!r}")
+
+    counts = np.array([np.sum(y == c) for c in classes])
+    theta = np.stack([X[y == c].mean(axis=0) for c in classes])
+
+    if model == "gnb":
+        var = np.stack([X[y == c].var(axis=0) for c in classes])
+    else:
+        pooled = sum(n * X[y == c].var(axis=0) for n, c in zip(counts, classes)) / counts.sum()
+        var = np.broadcast_to(pooled, theta.shape).copy()
+
+    # one epsilon per time point, computed from the variance of all features at that time point
+    epsilon = var_smoothing * X.var(axis=0).max(axis=0)
+    var += epsilon
+
+    log_prior = np.log(counts / counts.sum())
+
+    return dict(log_prior=log_prior, theta=theta, var=var)
+
+def joint_log_likelihood(X, params):
+    '''
+    Joint log likelihood of every trial under every class at every time point
+
+    Args
+        X (array): data with shape (n_trials, n_vertices, n_times)
+        params (dict): output of fit_diagonal_model
+
+    Returns
+        jll (array): shape (n_trials, n_classes, n_times)
+    '''
+    theta, var = params["theta"], params["var"]
+    jll = np.empty((X.shape[0], theta.shape[0], X.shape[2]))
+
+    for class_index in range(theta.shape[0]):
+        n_ij = -0.5 * np.sum(np.log(2.0 * np.pi * var[class_index]), axis=0)
+        n_ij = n_ij - 0.5 * np.sum((X - theta[class_index]) ** 2 / var[class_index], axis=1)
+        jll[:, class_index, :] = params["log_prior"][class_index] + n_ij
+
+    return jll
+
+def fit_predict_folds(X, y, folds, model="gnb", var_smoothing=1e-9):
+    '''
+    Cross validated predictions for all time points (equivalent to cross_val_predict per time sample)
+
+    Args
+        X (array): standardised data with shape (n_trials, n_vertices, n_times)
+        y (array): labels with shape (n_trials, )
+        folds (list): list of (train, test) index arrays
+        model (str): one of MODELS
+        var_smoothing (float): see fit_diagonal_model
+
+    Returns
+        y_pred (array): predictions with shape (n_trials, n_times)
+    '''
+    y_pred = np.empty((X.shape[0], X.shape[2]), dtype=y.dtype)
+
+    for train, test in folds:
+        classes = np.unique(y[train])
+        params = fit_diagonal_model(X[train], y[train], classes, model=model, var_smoothing=var_smoothing)
+        jll = joint_log_likelihood(X[test], params)
+        y_pred[test] = classes[np.argmax(jll, axis=1)]
+
+    return y_pred
+
+def fold_scores(X, y, folds, model="gnb", var_smoothing=1e-9):
+    '''
+    Mean accuracy across folds for all time points (equivalent to cross_val_score(...).mean() per time sample)
+
+    Returns
+        scores (array): shape (n_times, )
+    '''
+    scores = np.zeros(X.shape[2])
+
+    for train, test in folds:
+        classes = np.unique(y[train])
+        params = fit_diagonal_model(X[train], y[train], classes, model=model, var_smoothing=var_smoothing)
+        jll = joint_log_likelihood(X[test], params)
+        scores += np.mean(classes[np.argmax(jll, axis=1)] == y[test][:, None], axis=0)
+
+    return scores / len(folds)
+
+def time_blocks(n_times, block_size):
+    '''
+    Split n_times into consecutive slices of at most block_size samples (bounds memory of the batched engine)
+    '''
+    return [slice(start, min(start + block_size, n_times)) for start in range(0, n_times, block_size)]
+
+def bin_samples(X, bin_size, trials=None):
+    '''
+    Average consecutive time points in bins of bin_size samples (the last bin may be shorter). X is read bin by bin.
+
+    Args
+        X (array): data with shape (n_all_trials, n_vertices, n_times), may be a numpy.memmap
+        bin_size (int): number of time points per bin (e.g., 5 samples = 20 ms at 250 Hz)
+        trials (array): indices of the trials to read (None reads all trials)
+
+    Returns
+        X_binned (array): shape (n_trials, n_vertices, n_bins)
+    '''
+    bins = time_blocks(X.shape[2], bin_size)
+    n_trials = X.shape[0] if trials is None else len(trials)
+    X_binned = np.empty((n_trials, X.shape[1], len(bins)))
+
+    for bin_index, block in enumerate(bins):
+        X_binned[:, :, bin_index] = get_block(X, block, trials).mean(axis=2)
+
+    return X_binned
+
+def auto_block_size(n_trials, n_vertices, max_block_bytes=500e6, n_copies=4):
+    '''
+    Largest number of time points for which a block of data (plus ~n_copies temporaries of the same size) fits in max_block_bytes
+    '''
+    return max(int(max_block_bytes // (8 * n_copies * n_trials * n_vertices)), 1)
+
+def get_block(X, block, trials=None):
+    '''
+    Read a block of time points for the selected trials. If X is memory-mapped only this block is loaded into memory.
+
+    Args
+        X (array): data with shape (n_all_trials, n_vertices, n_times), may be a numpy.memmap
+        block (slice or array): time points to read
+        trials (array): indices of the trials to read (None reads all trials)
+
+    Returns
+        X_block (array): in-memory array with shape (n_trials, n_vertices, n_block_times)
+    '''
+    X_block = X[:, :, block]
+
+    if trials is not None:
+        X_block = X_block[trials]
+
+    return np.asarray(X_block)
+
+def select_times(times, block):
+    '''
+    Time points of X in a block of the selected time points (times=None selects all time points of X)
+    '''
+    return block if times is None else times[block]
+
+def count_times(X, times=None):
+    '''
+    Number of selected time points
+    '''
+    return X.shape[2] if times is None else len(times)
+
+def draw_permutations(n_trials, n_permutations, random_state=0):
+    '''
+    Draw label permutations in the same order as sklearn's permutation_test_score
+    '''
+    random_state = check_random_state(random_state)
+
+    return np.array([random_state.permutation(n_trials) for _ in range(n_permutations)])
+
+def batched_cross_val_predict(X, y, cv, model="gnb", block_size=None, trials=None, times=None):
+    '''
+    Standardise and run cross validated predictions for all time points at once
+
+    Args
+        X (array): data with shape (n_trials, n_vertices, n_times)
+        y (array): labels with shape (n_trials, )
+        cv (cross validation generator): e.g., StratifiedKFold
+        model (str): one of MODELS
+        block_size (int): number of time points processed together (None sizes blocks with auto_block_size)
+        trials (array): indices of the trials of X to use (y holds their labels). Avoids copying a (memory-mapped) X.
+        times (array): indices of the time points of X to use (None uses all time points)
+
+    Returns
+        y_pred (array): predictions with shape (n_trials, n_times)
+    '''
+    block_size = block_size or auto_block_size(len(y), X.shape[1])
+    folds = list(cv.split(np.zeros(len(y)), y))
+    y_pred = np.empty((len(y), count_times(X, times)), dtype=y.dtype)
+
+    for block in time_blocks(count_times(X, times), block_size):
+        y_pred[:, block] = fit_predict_folds(standardize(get_block(X, select_times(times, block), trials)), y, folds, model=model)
+
+    return y_pred
+
+def generalization_log_likelihood(X, params):
+    '''
+    Joint log likelihood of every trial under every class for every pair of (train time, test time), i.e. the model fitted
+    at each train time point applied to the data at each test time point. The squared distances are expanded so that the
+    sum over vertices becomes matrix multiplications.
+
+    Args
+        X (array): test data with shape (n_trials, n_vertices, n_test_times)
+        params (dict): output of fit_diagonal_model (fitted on n_train_times time points)
+
+    Returns
+        jll (array): shape (n_trials, n_classes, n_train_times, n_test_times)
+    '''
+    theta, var = params["theta"], params["var"]
+    n_trials, n_vertices, n_test_times = X.shape
+    n_classes, _, n_train_times = theta.shape
+
+    # (n_trials * n_test_times, n_vertices)
+    X_flat = X.transpose(0, 2, 1).reshape(-1, n_vertices)
+    X_squared = X_flat ** 2
+
+    jll = np.empty((n_trials, n_classes, n_train_times, n_test_times))
+
+    for class_index in range(n_classes):
+        precision = 1.0 / var[class_index]
+        weighted_theta = theta[class_index] * precision
+
+        # sum over vertices of (x - theta)^2 / var, shape (n_trials * n_test_times, n_train_times)
+        distance = X_squared @ precision - 2 * (X_flat @ weighted_theta) + np.sum(theta[class_index] * weighted_theta, axis=0)
+        n_ij = -0.5 * np.sum(np.log(2.0 * np.pi * var[class_index]), axis=0) - 0.5 * distance
+
+        jll[:, class_index] = (params["log_prior"][class_index] + n_ij).reshape(n_trials, n_test_times, n_train_times).transpose(0, 2, 1)
+
+    return jll
+
+def batched_generalization_scores(X, y, cv, model="gnb", block_size=None, trials=None):
+    '''
+    Temporal generalization: mean accuracy across folds of the model trained at every time point and tested at every time point.
+
+    Each time point's model is fitted once per fold and scored against blocks of test time points at once (see
+    generalization_log_likelihood). Train and test time points are streamed in blocks, so memory is bounded by the block size
+    rather than by n_times ** 2. Every time point is standardised across trials (as in batched_cross_val_predict), so the
+    diagonal of the matrix is the time-resolved decoding accuracy.
+
+    Args
+        X (array): data with shape (n_trials, n_vertices, n_times)
+        y (array): labels with shape (n_trials, )
+        cv (cross validation generator): e.g., StratifiedKFold
+        model (str): one of MODELS
+        block_size (int): number of (train and test) time points processed together (None sizes blocks with auto_block_size)
+        trials (array): indices of the trials of X to use (y holds their labels)
+
+    Returns
+        scores (array): shape (n_train_times, n_test_times)
+    '''
+    block_size = block_size or auto_block_size(len(y), X.shape[1])
+    folds = list(cv.split(np.zeros(len(y)), y))
+    blocks = time_blocks(X.shape[2], block_size)
+
+    scores = np.zeros((X.shape[2], X.shape[2]))
+
+    for train_block in blocks:
+        X_train = standardize(get_block(X, train_block, trials))
+
+        # fit the models of this block of train time points once per fold
+        fold_params = []
+        for train, test in folds:
+            classes = np.unique(y[train])
+            fold_params.append((classes, fit_diagonal_model(X_train[train], y[train], classes, model=model)))
+        del X_train
+
+        for test_block in blocks:
+            X_test = standardize(get_block(X, test_block, trials))
+
+            for (train, test), (classes, params) in zip(folds, fold_params):
+                jll = generalization_log_likelihood(X_test[test], params)
+                y_pred = classes[np.argmax(jll, axis=1)]
+                scores[train_block, test_block] += np.mean(y_pred == y[test][:, None, None], axis=0)
+
+    return scores / len(folds)
+
+def permutation_tile(X, y, cv, permutations, model="gnb"):
+    '''
+    Permutation scores for one work unit (a block of time points x a chunk of permutations)
+
+    Args
+        X (array): data with shape (n_trials, n_vertices, n_block_times)
+        y (array): labels with shape (n_trials, )
+        cv (cross validation generator): e.g., StratifiedKFold
+        permutations (array): permuted trial indices with shape (n_chunk_permutations, n_trials)
+        model (str): one of MODELS
+
+    Returns
+        scores (array): shape (n_block_times, n_chunk_permutations)
+    '''
+    X_std = standardize(X)
+    scores = np.zeros((X.shape[2], len(permutations)))
+
+    for perm_index, permutation in enumerate(permutations):
+        # folds depend on the permuted labels (stratification), so they are computed per permutation
+        y_perm = y[permutation]
+        folds = list(cv.split(np.zeros(len(y_perm)), y_perm))
+        scores[:, perm_index] = fold_scores(X_std, y_perm, folds, model=model)
+
+    return scores
+
+def _shared_permutation_tile(X_path, block, trials, y, cv, permutations, model):
+    '''
+    Worker entry point: read the time block from the shared memory map and score the permutation chunk
+    '''
+    X = load_shared_array(X_path)
+
+    return permutation_tile(get_block(X, block, trials), y, cv, permutations, model=model)
+
+def batched_permutation_scores(X, y, cv, n_permutations=100, random_state=0, model="gnb", block_size=None, n_jobs=1, executor=None,
+                               trials=None, times=None):
+    '''
+    Permutation scores for all time points at once (equivalent to permutation_test_score per time sample)
+
+    The permutations are drawn up front from random_state, and each (time block x permutation chunk) work unit writes into
+    its own cells of the output, so the result is identical regardless of the number of workers.
+
+    Args
+        X (array): data with shape (n_trials, n_vertices, n_times)
+        y (array): labels with shape (n_trials, )
+        cv (cross validation generator): e.g., StratifiedKFold
+        n_permutations (int): number of permutations
+        random_state (int): seed for the permutations (sklearn's permutation_test_score uses 0)
+        model (str): one of MODELS
+        block_size (int): number of time points processed together (None sizes blocks with auto_block_size)
+        n_jobs (int): number of worker processes (1 runs serially, -1 uses all cpus)
+        executor (concurrent.futures.Executor): optional executor to submit the work units to instead of a new process pool
+        trials (array): indices of the trials of X to use (y holds their labels)
+        times (array): indices of the time points of X to use (None uses all time points)
+
+    Returns
+        permutation_scores (array): shape (n_times, n_permutations)
+    '''
+    block_size = block_size or auto_block_size(len(y), X.shape[1])
+    permutations = draw_permutations(len(y), n_permutations, random_state)
+    blocks = time_blocks(count_times(X, times), block_size)
+
+    permutation_scores = np.zeros((count_times(X, times), n_permutations))
+
+    if executor is None and get_n_jobs(n_jobs) == 1:
+        for block in blocks:
+            permutation_scores[block] = permutation_tile(get_block(X, select_times(times, block), trials), y, cv, permutations, model=model)
+
+        return permutation_scores
+
+    # split permutations into chunks so that there are at least as many work units per time block as workers
+    chunks = np.array_split(np.arange(n_permutations), min(get_n_jobs(n_jobs), n_permutations))
+
+    with shared_array(X) as X_path, get_executor(n_jobs, executor) as pool:
+        futures = {
+            pool.submit(_shared_permutation_tile, X_path, select_times(times, block), trials, y, cv, permutations[chunk], model): (block, chunk)
+            for block in blocks for chunk in chunks
+        }
+
+        for future, (block, chunk) in futures.items():
+            permutation_scores[block, chunk[0]:chunk[-1] + 1] = future.result()
+
+    return permutation_scores
+
+def observed_scores(X, y, cv, model="gnb", block_size=None, trials=None, times=None):
+    '''
+    Mean accuracy across folds on the true labels for all (or the selected) time points (the score permutation_test_score compares against)
+    '''
+    block_size = block_size or auto_block_size(len(y), X.shape[1])
+    folds = list(cv.split(np.zeros(len(y)), y))
+    scores = np.zeros(count_times(X, times))
+
+    for block in time_blocks(count_times(X, times), block_size):
+        scores[block] = fold_scores(standardize(get_block(X, select_times(times, block), trials)), y, folds, model=model)
+
+    return scores
+
+def permutation_pvalues(scores, permutation_scores):
+    '''
+    Permutation p-values per time point, (C + 1) / (n_permutations + 1) as in permutation_test_score.
+    Permutations that were not run (NaN) are ignored.
+    '''
+    n_used = np.sum(~np.isnan(permutation_scores), axis=1)
+    n_exceed = np.sum(permutation_scores >= scores[:, None], axis=1)
+
+    return (n_exceed + 1) / (n_used + 1)
+
+def max_statistic_pvalues(scores, permutation_scores):
+    '''
+    Family-wise corrected p-values across time points from the max-statistic null distribution (the maximum score over time
+    points of each permutation). Requires that permutation j is the same label permutation at every time point.
+
+    Args
+        scores (array): observed scores with shape (n_times, )
+        permutation_scores (array): shape (n_times, n_permutations)
+
+    Returns
+        corrected_pvalues (array): shape (n_times, )
+        max_null (array): maximum score over time points per permutation, shape (n_permutations, )
+    '''
+    max_null = permutation_scores.max(axis=0)
+    n_exceed = np.sum(max_null[None, :] >= scores[:, None], axis=1)
+
+    return (n_exceed + 1) / (len(max_null) + 1), max_null
+
+def find_clusters(above):
+    '''
+    Runs of consecutive True values along the first axis of above (n_times, n_series)
+
+    Returns
+        run_ids (array): run number per element (-1 outside runs), numbered consecutively over all series
+        n_runs (int): number of runs
+    '''
+    above = above.reshape(above.shape[0], -1)
+    previous = np.vstack([np.zeros((1, above.shape[1]), dtype=bool), above[:-1]])
+    starts = above & ~previous
+
+    # number runs column by column (transpose so that the cumulative sum runs along time within each series)
+    run_ids = np.cumsum(starts.T.ravel()).reshape(above.shape[1], above.shape[0]).T - 1
+    run_ids[~above] = -1
+
+    return run_ids, int(starts.sum())
+
+def cluster_masses(statistic, above):
+    '''
+    Mass (sum of statistic) of every temporal cluster (run of consecutive supra-threshold time points) in every series
+
+    Args
+        statistic (array): shape (n_times, n_series)
+        above (array): supra-threshold mask with shape (n_times, n_series)
+
+    Returns
+        run_ids (array): cluster number per element (-1 outside clusters)
+        masses (array): mass per cluster, shape (n_clusters, )
+    '''
+    run_ids, n_runs = find_clusters(above)
+    masses = np.bincount(run_ids[above], weights=statistic[above], minlength=n_runs)
+
+    return run_ids, masses
+
+def cluster_mass_test(scores, permutation_scores, cluster_alpha=0.05):
+    '''
+    Temporal cluster-mass permutation test (in the spirit of Maris & Oostenveld, 2007).
+
+    A time point is supra-threshold if its score exceeds the (1 - cluster_alpha) quantile of its permutation distribution,
+    and the mass of a cluster of consecutive supra-threshold time points is the sum of its scores minus the permutation mean.
+    The null distribution is the largest cluster mass of each permutation (computed with the same threshold, all permutations
+    at once), which requires that permutation j is the same label permutation at every time point.
+
+    Each row must be decoded at its own time point. The cluster extents are counted in rows, so rows copied from a coarser
+    resolution (e.g., the bins of coarse_to_fine_decoding in classify_fns) would count the same bin several times and give
+    cluster extents that are not in samples.
+
+    Args
+        scores (array): observed scores with shape (n_times, )
+        permutation_scores (array): shape (n_times, n_permutations)
+        cluster_alpha (float): cluster forming threshold (uncorrected level per time point)
+
+    Returns
+        clusters (array): first and last + 1 time point of each observed cluster, shape (n_clusters, 2)
+        masses (array): mass per cluster
+        cluster_pvalues (array): corrected p-value per cluster
+        max_null (array): largest cluster mass per permutation (0 if a permutation has no cluster), shape (n_permutations, )
+    '''
+    n_permutations = permutation_scores.shape[1]
+    threshold = np.quantile(permutation_scores, 1 - cluster_alpha, axis=1)
+    null_mean = permutation_scores.mean(axis=1)
+
+    # null distribution of the largest cluster mass
+    above = permutation_scores > threshold[:, None]
+    run_ids, null_masses = cluster_masses(permutation_scores - null_mean[:, None], above)
+    max_null = np.zeros(n_permutations)
+    np.maximum.at(max_null, np.broadcast_to(np.arange(n_permutations), above.shape)[above], null_masses[run_ids[above]])
+
+    # observed clusters
+    above = (scores > threshold)[:, None]
+    run_ids, masses = cluster_masses((scores - null_mean)[:, None], above)
+    run_ids = run_ids[:, 0]
+    clusters = np.array([[np.flatnonzero(run_ids == run)[0], np.flatnonzero(run_ids == run)[-1] + 1] for run in range(len(masses))],
+                        dtype=int).reshape(-1, 2)
+    cluster_pvalues = (np.sum(max_null[None, :] >= masses[:, None], axis=1) + 1) / (n_permutations + 1)
+
+    return clusters, masses, cluster_pvalues, max_null
+
+def pvalue_interval(n_exceed, n_used, confidence=0.95):
+    '''
+    Clopper-Pearson interval for the true permutation p-value given n_exceed exceedances in n_used permutations
+    '''
+    tail = (1 - confidence) / 2
+
+    lower = np.where(n_exceed > 0, beta.ppf(tail, n_exceed, n_used - n_exceed + 1), 0.0)
+    upper = np.where(n_exceed < n_used, beta.ppf(1 - tail, n_exceed + 1, n_used - n_exceed), 1.0)
+
+    return lower, upper
+
+def sequential_permutation_scores(X, y, cv, n_permutations=100, max_permutations=1000, alpha=0.05, confidence=0.95,
+                                  batch_size=10, random_state=0, model="gnb", block_size=None, trials=None, times=None):
+    '''
+    Sequential Monte Carlo permutation test with a Clopper-Pearson stopping rule (not the h-exceedance rule of Besag & Clifford, 1991).
+
+    Permutations are run in batches. A time point stops being permuted once the Clopper-Pearson interval of its p-value
+    lies entirely above or below alpha (i.e., the test decision is settled). The budget saved this way
+    (n_permutations per time point on average) is spent on undecided (borderline) time points, up to max_permutations each.
+    Permutation j is the same label permutation at every time point (drawn as in batched_permutation_scores).
+
+    The p-value is the plain (n_exceed + 1) / (n_used + 1) of the permutations a time point ran, without a correction for the
+    optional stopping (it is calibrated under the null in simulation, see src/sanity_checks/permutation_check.py). Budget is
+    mostly saved on null time points: a time point without exceedances only stops once the upper end of the interval is below
+    alpha, which takes at least log((1 - confidence) / 2) / log(1 - alpha) permutations (72 at alpha=0.05 and confidence=0.95,
+    i.e. 80 with batch_size=10), so clearly significant time points cost about as much as in the fixed test.
+
+    Args
+        X (array): data with shape (n_trials, n_vertices, n_times)
+        y (array): labels with shape (n_trials, )
+        cv (cross validation generator): e.g., StratifiedKFold
+        n_permutations (int): average number of permutations per time point (total budget = n_permutations * n_times)
+        max_permutations (int): maximum number of permutations for any single time point
+        alpha (float): significance level at which the decision is made
+        confidence (float): confidence of the interval used to decide when to stop
+        batch_size (int): number of permutations run between stopping checks
+        random_state (int): seed for the permutations
+        model (str): one of MODELS
+        block_size (int): number of time points processed together (None sizes blocks with auto_block_size)
+        trials (array): indices of the trials of X to use (y holds their labels)
+        times (array): indices of the time points of X to use (None uses all time points)
+
+    Returns
+        permutation_scores (array): shape (n_times, n_drawn), NaN where a time point had stopped
+        n_used (array): number of permutations run per time point
+        pvalues (array): permutation p-values per time point ((n_exceed + 1) / (n_used + 1), see above)
+    '''
+    n_times = count_times(X, times)
+    max_permutations = max(max_permutations, n_permutations)
+    random_state = check_random_state(random_state)
+
+    block_size = block_size or auto_block_size(len(y), X.shape[1])
+    scores = observed_scores(X, y, cv, model=model, block_size=block_size, trials=trials, times=times)
+
+    permutation_scores = np.full((n_times, max_permutations), np.nan)
+    n_used = np.zeros(n_times, dtype=int)
+    n_exceed = np.zeros(n_times, dtype=int)
+    active = np.ones(n_times, dtype=bool)
+
+    budget = n_permutations * n_times
+    n_drawn = 0
+
+    while active.any() and n_drawn < max_permutations and budget > 0:
+        # do not draw more permutations than the remaining budget allows for the active time points
+        this_batch = min(batch_size, max_permutations - n_drawn, max(budget // active.sum(), 1))
+        permutations = np.array([random_state.permutation(len(y)) for _ in range(this_batch)])
+        batch = slice(n_drawn, n_drawn + this_batch)
+
+        active_times = np.flatnonzero(active)
+        for block in time_blocks(len(active_times), block_size):
+            block_times = active_times[block]
+            permutation_scores[block_times, batch] = permutation_tile(get_block(X, select_times(times, block_times), trials), y, cv,
+                                                                      permutations, model=model)
+
+        n_drawn += this_batch
+        budget -= this_batch * len(active_times)
+
+        n_used[active] += this_batch
+        n_exceed[active] += np.sum(permutation_scores[active, batch] >= scores[active, None], axis=1)
+
+        # stop time points whose decision at alpha is settled
+        lower, upper = pvalue_interval(n_exceed, n_used, confidence=confidence)
+        active &= (lower <= alpha) & (upper >= alpha)
+
+    permutation_scores = permutation_scores[:, :n_drawn]
+    pvalues = (n_exceed + 1) / (n_used + 1)
+
+    return permutation_scores, n_used, pvalues
@@ -0,0 +1,88 @@
+'''
+Content-addressed on-disk cache (keys are hashes of the input files and all parameters)
+'''
+import hashlib, json, os, pathlib
+
+def hash_file(path, chunk_size=2**22):
+    '''
+    Hash the content of a file (blake2b, read in chunks)
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def hash_params(params:dict):
+    '''
+    Hash a (json serialisable) dictionary of parameters into a cache key
+    '''
+    serialised = json.dumps(params, sort_keys=True, default=str)
+
+    return hashlib.blake2b(serialised.encode(), digest_size=16).hexdigest()
+
+def get_cached(cache_dir, key, suffix):
+    '''
+    Return the path of a cached entry if it exists (and mark it as recently used), else None
+    '''
+    path = pathlib.Path(cache_dir) / f"{key}{suffix}"
+
+    if not path.exists():
+        return None
+
+    # update modification time so that eviction removes the least recently used entries first
+    os.utime(path)
+
+    return path
+
+def write_cached(cache_dir, key, suffix, save_fn):
+    '''
+    Write an entry atomically: save_fn(tmp_path) writes the file which is then renamed to its final name
+
+    Args
+        cache_dir (pathlib.Path): cache directory
+        key (str): cache key
+        suffix (str): filename suffix (e.g., "_raw.fif")
+        save_fn (callable): function writing the entry to the path it receives
+
+    Returns
+        path (pathlib.Path): path of the cached entry
+    '''
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    path = cache_dir / f"{key}{suffix}"
+    tmp_path = cache_dir / f"{key}.tmp{os.getpid()}{suffix}"
+
+    save_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+    return path
+
+def evict(cache_dir, max_bytes, pattern="*", keep=()):
+    '''
+    Remove the least recently used entries until the cache directory is below max_bytes
+
+    Args
+        cache_dir (pathlib.Path): cache directory
+        max_bytes (int): size budget of the cache in bytes (None disables eviction)
+        pattern (str): glob pattern of the entries to consider
+        keep (iterable): paths which are never removed (e.g., the entry just written)
+    '''
+    if max_bytes is None:
+        return
+
+    keep = {pathlib.Path(path) for path in keep}
+    entries = sorted(pathlib.Path(cache_dir).glob(pattern), key=lambda path: path.stat().st_mtime)
+    total = sum(path.stat().st_size for path in entries)
+
+    for path in entries:
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+
+        total -= path.stat().st_size
+        path.unlink()
@@ -15,12 +15,25 @@ from sklearn.naive_bayes import GaussianNB
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import cross_val_score, StratifiedKFold, cross_val_predict, permutation_test_score
 from sklearn.inspection import permutation_importance
+from sklearn.utils import check_random_state
 
 # plotting
 import matplotlib.pyplot as plt
 
+# source reconstruction
+from .source_fns import get_inverse_operator, read_labels, make_inverse_kernel, apply_inverse_kernel, allocate_features
+
+# stage tracing (see utils.profiling)
+from .profiling import trace_stage, profile_hot_loop, array_info
+
+# batched (vectorised) decoding engine
+from .batched_classify_fns import (batched_cross_val_predict, batched_permutation_scores, sequential_permutation_scores,
+                                   observed_scores, permutation_pvalues, batched_generalization_scores, bin_samples, time_blocks,
+                                   max_statistic_pvalues, cluster_mass_test)
+
 ## PREPROCESSING 
-def get_source_space_data(epochs_dict:dict, subjects_dir, subject:str="0108", label=None, method="dSPM"):
+def get_source_space_data(epochs_dict:dict, subjects_dir, subject:str="0108", label=None, method="dSPM", cache_dir=None, batched=True,
+                          store_dir=None, dtype=np.float64, vertex_chunk_size=None):
     '''
     Extract source space data for classification 
     (loosely based on https://mne.tools/stable/auto_examples/decoding/decoding_spatio_temporal_source.html#ex-dec-st-source)
@@ -30,6 +43,41 @@ def get_source_space_data(epochs_dict:dict, subjects_dir, subject:str="0108", la
         subjects_dir (str): path to subjects_dir
         subject (str): subject name (defaults to "0108")
         label (str): label name
+        cache_dir (pathlib.Path): directory for cached inverse operators and noise covariances (see utils.source_fns)
+        batched (bool): apply the inverse to all epochs in one matrix multiplication (see get_source_space_data_labels)
+        store_dir, dtype, vertex_chunk_size: memory-mapped feature store options (see get_source_space_data_labels)
+    '''
+    # load labels if relevant (if None, it will do a whole brain analysis)
+    labels = read_labels(subjects_dir, subject, labels=[label]) if label is not None else {None: None}
+
+    X_dict, y = get_source_space_data_labels(epochs_dict, labels, method=method, subjects_dir=subjects_dir, subject=subject,
+                                             cache_dir=cache_dir, batched=batched, store_dir=store_dir, dtype=dtype,
+                                             vertex_chunk_size=vertex_chunk_size)
+
+    return X_dict[label], y
+
+def get_source_space_data_labels(epochs_dict:dict, labels:dict, subjects_dir, subject:str="0108", method="dSPM", cache_dir=None, batched=True,
+                                 store_dir=None, dtype=np.float64, vertex_chunk_size=None):
+    '''
+    Extract source space data for several labels at once. The inverse operator of each recording is built (or loaded) and
+    prepared once, and then applied for every label.
+
+    Args
+        epochs_dict (dict): dictionary with epochs for each recording (keys are recording names, values are epochs objects)
+        labels (dict): label objects keyed by name (see utils.source_fns.read_labels). A None value means whole brain
+        subjects_dir (str): path to subjects_dir
+        subject (str): subject name (defaults to "0108")
+        cache_dir (pathlib.Path): directory for cached inverse operators and noise covariances (see utils.source_fns)
+        batched (bool): apply the label-restricted imaging kernel to all epochs in one matrix multiplication, writing into a
+                        preallocated array (see utils.source_fns.make_inverse_kernel). If False, apply_inverse_epochs is used.
+        store_dir (pathlib.Path): if given (batched only), the features are written to memory-mapped .npy files in this directory,
+                                  so that e.g. whole brain data does not need to fit in memory
+        dtype (numpy dtype): dtype of the features (batched only)
+        vertex_chunk_size (int): apply the kernel to chunks of this many vertices at a time (batched only)
+
+    Returns
+        X_dict (dict): source space data with shape (n_trials, n_vertices, n_times) per label name
+        y (array): triggers with shape (n_trials, )
     '''
     # set empty array for y
     y = np.zeros(0)
@@ -38,48 +86,72 @@ def get_source_space_data(epochs_dict:dict, subjects_dir, subject:str="0108", la
     for epochs in epochs_dict.values():
         y = np.concatenate((y, epochs.events[:, 2]))
 
-    # load labels if relevant (if None, it will do a whole brain analysis)
-    if label is not None:
-        label_path = subjects_dir / subject / 'label' / label
-        label = mne.read_label(label_path)
-    
-    for epochs_index, (recording_name, epochs) in enumerate(epochs_dict.items()):
-        fwd_name = f"{recording_name[4:]}-oct-6-src-5120-fwd.fif"
-
-        # read forward solution
-        fwd = mne.read_forward_solution(subjects_dir / subject / 'bem' / fwd_name)
-
-        # source estimation! 
-        noise_cov = mne.compute_covariance(epochs, tmax=0.000)
-        
-        inv = mne.minimum_norm.make_inverse_operator(epochs.info,
-                                                     fwd, noise_cov)
-  
-        stcs = mne.minimum_norm.apply_inverse_epochs(epochs, inv, lambda2=1,
-                                                     method=method, label=label,
-                                                     pick_ori="normal")
-        # extract source space
-        this_X = np.array([stc.data for stc in stcs])
-
-        # concatenate (if first iteration, create X)
-        if epochs_index == 0:
-            X = this_X
-        else:
-            X = np.concatenate((X, this_X))
-    
-    return X, y 
+    n_times = len(next(iter(epochs_dict.values())).times)
+
+    X_dict = {}
+    X_lists = {name: [] for name in labels}
+    start = 0
+
+    for recording_name, epochs in epochs_dict.items():
+        with trace_stage("inverse_operator", recording=recording_name):
+            # forward solution + noise covariance -> inverse operator (cached)
+            inv = get_inverse_operator(epochs, recording_name, subjects_dir, subject=subject, cache_dir=cache_dir)
+
+            # prepare once for all labels (nave=1 as for single epochs)
+            inv = mne.minimum_norm.prepare_inverse_operator(inv, nave=1, lambda2=1, method=method)
+
+        for name, label in labels.items():
+            with trace_stage("apply_inverse", recording=recording_name, label=name, n_epochs=len(epochs)) as stage:
+                if batched:
+                    kernel, _ = make_inverse_kernel(inv, epochs.info, label=label, method=method, lambda2=1, prepared=True)
+
+                    # size the output once all dimensions are known (first recording)
+                    if name not in X_dict:
+                        X_dict[name] = allocate_features((len(y), kernel.shape[0], n_times), store_dir=store_dir, name=name, dtype=dtype)
+
+                    apply_inverse_kernel(kernel, epochs, out=X_dict[name][start:start + len(epochs)], chunk_size=vertex_chunk_size)
+                    stage.update(array_info(kernel=kernel, X=X_dict[name]))
+                else:
+                    stcs = mne.minimum_norm.apply_inverse_epochs(epochs, inv, lambda2=1,
+                                                                 method=method, label=label,
+                                                                 pick_ori="normal", prepared=True)
+                    # extract source space
+                    X_lists[name].append(np.array([stc.data for stc in stcs]))
+
+        start += len(epochs)
+
+    if not batched:
+        X_dict = {name: np.concatenate(X_list) for name, X_list in X_lists.items()}
+
+    for X in X_dict.values():
+        if isinstance(X, np.memmap):
+            X.flush()
+
+    return X_dict, y 
 
 ## CLASSIFICATION FUNCTIONS USED IN SIMPLE CLASSIFICATION FUNCTION
 def get_indices(y, triggers):
     '''
     Extract indices for triggers
     '''
-    indices = list()
-    for trigger_index, trigger in enumerate(y):
-        if trigger in triggers:
-            indices.append(trigger_index)
-            
-    return indices
+    return np.flatnonzero(np.isin(y, triggers))
+
+def balance_indices(y, random_state=None):
+    '''
+    Indices of the trials kept when balancing the classes (randomly drawn so each class has as many trials as the smallest class)
+    random_state (int): seed for the draw, so that e.g. several analyses use the same trials (None draws from np.random)
+    '''
+    random_state = check_random_state(random_state)
+    keys, counts = np.unique(y, return_counts = True)
+
+    keep_inds = []
+
+    for key in keys:
+        index = np.where(np.array(y) == key)
+        random_choices = random_state.choice(index[0], size = counts.min(), replace=False)
+        keep_inds.extend(random_choices)
+
+    return np.array(keep_inds, dtype=int)
 
 def balance_class_weights_multiple(X, y):
     '''
@@ -93,14 +165,7 @@ def balance_class_weights_multiple(X, y):
         X_equal (array): data array with shape (n_channels, n_trials, n_times) with equal number of trials for each class
         y_equal (array): contains the classes of the original y array, but now with an equal number of trials for each class
     '''
-    keys, counts = np.unique(y, return_counts = True)
-
-    keep_inds = []
-
-    for key in keys:
-        index = np.where(np.array(y) == key)
-        random_choices = np.random.choice(index[0], size = counts.min(), replace=False)
-        keep_inds.extend(random_choices)
+    keep_inds = balance_indices(y)
     
     X_equal = X[keep_inds, :, :]
     y_equal = y[keep_inds]
@@ -115,33 +180,222 @@ def combine_triggers(y, combine):
 
     for pair in combine:
         combine_pair = int(str(pair[0]) + str(pair[1]))
-        for i, trigger in enumerate(y_combined):
-            if trigger in pair:
-                y_combined[i] = combine_pair
+        y_combined[np.isin(y_combined, pair)] = combine_pair
     
     return y_combined
 
-## SIMPLE CLASSIFICATION FUNCTION
-def simple_classification(X, y, triggers, penalty='none', C=1.0, n_splits=5, combine=None, n_permutations=100):
+def select_trials(y, triggers, combine=None, trial_index=None, random_state=None):
     '''
-    Perform a Logistic regression 
+    Select the trials with the given triggers, balance the classes and combine triggers
+
+    Args
+        y (array): triggers with shape (n_trials, )
+        triggers (list): triggers to include
+        combine (list): list of trigger pairs to combine into one class
+        trial_index (TrialIndex): index of the trials (see utils.trial_index). If given, the trials are selected and combined
+                                  through its kept trials, whose rows line up with y
+        random_state (int): seed for balancing the classes (see balance_indices)
+
+    Returns
+        trials (array): indices of the selected trials
+        y (array): their (combined) triggers
     '''
+    if trial_index is not None:
+        kept = trial_index.kept()
+        if not np.array_equal(kept.trigger, y):
+            raise ValueError(f"the kept trials of {trial_index} do not line up with y ({len(y)} trials)")
 
-    n_samples = X.shape[2]
+        # get indices for only the triggers we want
+        indices = np.flatnonzero(kept.mask(trigger=triggers))
+
+        # equalize data (balance classes, so no triggers are overrepresented )
+        trials = indices[balance_indices(kept.trigger[indices], random_state)]
+
+        if combine:
+            mapping = {trigger: int(str(pair[0]) + str(pair[1])) for pair in combine for trigger in pair}
+            return trials, kept.remap("trigger", mapping)[trials]
+
+        return trials, kept.trigger[trials]
 
     # get indices for only the triggers we want
     indices = get_indices(y, triggers)
 
-    # reduce data based on these indices
-    X = X[indices,:,:]
-    y = y[indices]
-    
     # equalize data (balance classes, so no triggers are overrepresented )
-    X, y = balance_class_weights_multiple(X, y)
+    trials = indices[balance_indices(y[indices], random_state)]
+    y = y[trials]
 
     if combine:
         y = combine_triggers(y, combine)
 
+    return trials, y
+
+def batched_decoding(X, y, cv, trials=None, times=None, model="gnb", permutation_mode="fixed", n_permutations=100, max_permutations=1000,
+                     alpha=0.05, random_state=0, n_jobs=1, executor=None):
+    '''
+    Cross validated predictions and permutation test with the batched engine (see simple_classification for the arguments)
+
+    Returns
+        y_pred (array): predictions with shape (n_trials, n_times)
+        permutation_scores (array): shape (n_times, n_permutations) (NaN for permutations not run)
+        n_used (array): permutations used per time sample
+        pvalues (array): permutation p-value per time sample
+        scores (array): observed score per time sample (mean accuracy across folds, the score the permutations are compared against)
+    '''
+    with trace_stage("cross_val_predict", n_trials=len(y), n_vertices=X.shape[1]) as stage:
+        y_pred = batched_cross_val_predict(X, y, cv, model=model, trials=trials, times=times)
+        scores = observed_scores(X, y, cv, model=model, trials=trials, times=times)
+        n_times = y_pred.shape[1]
+        stage.update(n_times=n_times)
+
+    with trace_stage("permutations", mode=permutation_mode, n_trials=len(y), n_times=n_times), profile_hot_loop("permutations"):
+        if permutation_mode == "sequential":
+            permutation_scores, n_used, pvalues = sequential_permutation_scores(X, y, cv, n_permutations=n_permutations,
+                                                                                max_permutations=max_permutations, alpha=alpha,
+                                                                                random_state=random_state, model=model, trials=trials, times=times)
+        else:
+            permutation_scores = batched_permutation_scores(X, y, cv, n_permutations=n_permutations, random_state=random_state,
+                                                            model=model, n_jobs=n_jobs, executor=executor, trials=trials, times=times)
+            n_used = np.full(n_times, n_permutations)
+            pvalues = permutation_pvalues(scores, permutation_scores)
+
+    return y_pred, permutation_scores, n_used, pvalues, scores
+
+def coarse_to_fine_decoding(X, y, cv, trials, bin_size, screening_threshold=None, **decoding_kwargs):
+    '''
+    Decode bins of bin_size averaged samples, then decode the samples of the bins above screening_threshold at full resolution
+    (see simple_classification). Samples of bins that were not screened in get the results of their bin.
+
+    Returns
+        y_pred, permutation_scores, n_used, pvalues, scores (see batched_decoding), with one value per sample
+        screened (array): boolean mask of the samples decoded at full resolution
+    '''
+    n_samples = X.shape[2]
+
+    if screening_threshold is None:
+        screening_threshold = 1 / len(np.unique(y)) + 0.05
+
+    # coarse pass (the binned data of the selected trials fits in memory)
+    X_binned = bin_samples(X, bin_size, trials)
+    y_pred, permutation_scores, n_used, pvalues, scores = batched_decoding(X_binned, y, cv, **decoding_kwargs)
+    del X_binned
+
+    # map bins back onto samples
+    sample_bins = np.concatenate([np.full(block.stop - block.start, bin_index)
+                                  for bin_index, block in enumerate(time_blocks(n_samples, bin_size))])
+    coarse_scores = np.mean(y_pred == y[:, None], axis=0)
+    screened = coarse_scores[sample_bins] > screening_threshold
+
+    y_pred, permutation_scores, n_used, pvalues, scores = (y_pred[:, sample_bins], permutation_scores[sample_bins], n_used[sample_bins],
+                                                           pvalues[sample_bins], scores[sample_bins])
+
+    if not screened.any():
+        return y_pred, permutation_scores, n_used, pvalues, scores, screened
+
+    # fine pass on the screened samples only
+    fine_times = np.flatnonzero(screened)
+    fine_pred, fine_permutation_scores, fine_used, fine_pvalues, fine_scores = batched_decoding(X, y, cv, trials, times=fine_times,
+                                                                                                **decoding_kwargs)
+
+    # the sequential permutation test may draw a different number of permutations in the two passes
+    n_columns = max(permutation_scores.shape[1], fine_permutation_scores.shape[1])
+    padded = np.full((n_samples, n_columns), np.nan)
+    padded[:, :permutation_scores.shape[1]] = permutation_scores
+    padded[fine_times] = np.nan
+    padded[fine_times, :fine_permutation_scores.shape[1]] = fine_permutation_scores
+
+    y_pred[:, fine_times] = fine_pred
+    n_used[fine_times] = fine_used
+    pvalues[fine_times] = fine_pvalues
+    scores[fine_times] = fine_scores
+
+    return y_pred, padded, n_used, pvalues, scores, screened
+
+def correct_across_time(scores, permutation_scores, cluster_alpha=0.05):
+    '''
+    Family-wise corrections across time samples. Both use that permutation j is the same permutation of y at every sample.
+
+    Only valid when every sample has its own scores from the same permutations (a fixed number of permutations, without bin_size).
+    Coarse-to-fine decoding copies the scores of a bin to its samples, which would inflate the cluster masses and mix bin and
+    sample resolution in the max-statistic, and the cluster extents would not be in samples. The sequential permutation test
+    leaves NaN for the permutations a sample did not run, which is rejected.
+
+    Args
+        scores (array): observed score per sample
+        permutation_scores (array): shape (n_times, n_permutations), one independently decoded row per sample
+        cluster_alpha (float): cluster forming threshold of the cluster-mass test
+
+    Returns
+        corrections (dict): "corrected_pvalues" (max-statistic p-value per sample), "clusters" (first and last + 1 sample of each
+                            temporal cluster, shape (n_clusters, 2)), "cluster_masses" and "cluster_pvalues" (cluster-mass p-value per cluster)
+    '''
+    if np.isnan(permutation_scores).any():
+        raise ValueError("correct_across_time needs the same permutations at every sample (fixed permutation_mode)")
+
+    corrected_pvalues, _ = max_statistic_pvalues(scores, permutation_scores)
+    clusters, masses, cluster_pvalues, _ = cluster_mass_test(scores, permutation_scores, cluster_alpha=cluster_alpha)
+
+    return dict(corrected_pvalues=corrected_pvalues, clusters=clusters, cluster_masses=masses, cluster_pvalues=cluster_pvalues)
+
+## SIMPLE CLASSIFICATION FUNCTION
+def simple_classification(X, y, triggers, penalty='none', C=1.0, n_splits=5, combine=None, n_permutations=100, engine="sklearn", model="gnb", random_state=0, n_jobs=1, executor=None,
+                          permutation_mode="fixed", alpha=0.05, max_permutations=1000, bin_size=None, screening_threshold=None,
+                          trial_index=None, balance_random_state=None):
+    '''
+    Perform a time-resolved classification (one classifier per time sample)
+
+    With bin_size (batched engine only) the decoding is coarse-to-fine: the data is first decoded (with permutations) on bins of
+    bin_size averaged samples, and only the bins scoring above screening_threshold are decoded and permuted again at full resolution.
+    Samples in bins that did not pass the screening get the results of their bin, so the output still has one value per sample.
+
+    Args
+        X (array): data array with shape (n_trials, n_vertices, n_times) (may be memory-mapped, see get_source_space_data_labels)
+        y (array): triggers with shape (n_trials, )
+        triggers (list): triggers to include in the classification
+        n_splits (int): number of cross validation folds
+        combine (list): list of trigger pairs to combine into one class
+        n_permutations (int): number of permutations per time sample
+        engine (str): "sklearn" (loop over samples) or "batched" (all samples and folds at once, see batched_classify_fns)
+        model (str): diagonal-covariance model used by the batched engine ("gnb" or "diag_lda")
+        random_state (int): seed for the label permutations
+        n_jobs (int): number of worker processes for the permutation test (-1 uses all cpus)
+        executor (concurrent.futures.Executor): optional executor for the batched permutation test (overrides n_jobs)
+        permutation_mode (str): "fixed" (n_permutations at every sample) or "sequential" (batched engine only, stops permuting
+                                a sample once its p-value is decided at alpha, see sequential_permutation_scores)
+        alpha (float): significance level for the sequential permutation test and cluster forming threshold of the cluster-mass test
+        max_permutations (int): maximum number of permutations for a single sample in the sequential permutation test
+        bin_size (int): number of samples per coarse bin (e.g., 5 samples = 20 ms at 250 Hz). None decodes every sample.
+        screening_threshold (float): coarse accuracy a bin must exceed to be decoded at full resolution (defaults to chance + 0.05)
+        trial_index (TrialIndex): select and combine the trials through this index instead of y (see select_trials)
+        balance_random_state (int): seed for balancing the classes, pass the same seed to generalization_classification to decode
+                                    the same trials (None draws from np.random)
+
+    Returns
+        mean_scores (array): proportion classified correctly per time sample
+        y_pred_all (list): cross validated predictions per time sample
+        y_true_all (list): true labels per time sample
+        permutation_scores (array): permutation scores with shape (n_times, n_permutations) (NaN for permutations not run)
+        permutation_info (dict): "n_permutations" (permutations used per sample) and "pvalues" (permutation p-value per sample).
+                                 With bin_size also "screened" (samples decoded at full resolution). With a fixed number of
+                                 permutations and without bin_size also the corrections across time (see correct_across_time).
+    '''
+    if permutation_mode not in ["fixed", "sequential"]:
+        raise ValueError(f"permutation_mode must be 'fixed' or 'sequential', got {permutation_mode!r}")
+
+    if permutation_mode == "sequential" and engine != "batched":
+        raise ValueError("the sequential permutation test is only implemented for engine='batched'")
+
+    if bin_size and engine != "batched":
+        raise ValueError("coarse-to-fine decoding (bin_size) is only implemented for engine='batched'")
+
+    n_samples = X.shape[2]
+
+    # select and balance the trials with the triggers we want
+    trials, y = select_trials(y, triggers, combine, trial_index=trial_index, random_state=balance_random_state)
+
+    # the batched engine reads the selected trials block by block (X may be a memory-mapped feature store)
+    if engine != "batched":
+        X = X[trials, :, :]
+
     #clf = LogisticRegression(penalty=penalty, C=C, solver='newton-cg')
     clf = GaussianNB()
 
@@ -154,40 +408,110 @@ def simple_classification(X, y, triggers, penalty='none', C=1.0, n_splits=5, com
     # init cross validation
     cv = StratifiedKFold(n_splits = n_splits, random_state=42, shuffle=True)
     
+    if engine == "batched":
+        decoding_kwargs = dict(model=model, permutation_mode=permutation_mode, n_permutations=n_permutations, max_permutations=max_permutations,
+                               alpha=alpha, random_state=random_state, n_jobs=n_jobs, executor=executor)
+
+        if bin_size:
+            y_pred, permutation_scores, n_used, pvalues, scores, screened = coarse_to_fine_decoding(X, y, cv, trials, bin_size,
+                                                                                                    screening_threshold, **decoding_kwargs)
+        else:
+            y_pred, permutation_scores, n_used, pvalues, scores = batched_decoding(X, y, cv, trials, **decoding_kwargs)
+
+        mean_scores = np.mean(y_pred == y[:, None], axis=0)
+        y_pred_all = list(y_pred.T)
+        y_true_all = [y] * n_samples
+
+        permutation_info = dict(n_permutations=n_used, pvalues=pvalues)
+
+        if bin_size:
+            permutation_info["screened"] = screened
+
+        # the samples of a bin that was not screened in share its permutation scores, so the corrections would count the bin once per sample
+        if permutation_mode == "fixed" and not bin_size:
+            permutation_info.update(correct_across_time(scores, permutation_scores, cluster_alpha=alpha))
+
+        return mean_scores, y_pred_all, y_true_all, permutation_scores, permutation_info
+
     # init vals 
     mean_scores = np.zeros(n_samples)
     
     permutation_scores = np.zeros((n_samples, n_permutations))
+    pvalues = np.zeros(n_samples)
+    scores = np.zeros(n_samples)
     y_pred_all = []
     y_true_all = [] 
     
-    for sample_index in tqdm(range(n_samples)):
-        this_X = X[:, :, sample_index]
-        sc.fit(this_X)
-        this_X_std = sc.transform(this_X)
+    with trace_stage("sklearn_samples", n_trials=len(y), n_times=n_samples, n_permutations=n_permutations), profile_hot_loop("sklearn_samples"):
+        for sample_index in tqdm(range(n_samples)):
+            this_X = X[:, :, sample_index]
+            sc.fit(this_X)
+            this_X_std = sc.transform(this_X)
+
+            # cross val
+            y_pred = cross_val_predict(clf, this_X_std, y, cv=cv)
+
+            mean_scores[sample_index] = np.mean(y_pred == y)
+
+            y_pred_all.append(y_pred)
+            y_true_all.append(y)
+
+            # permutation tst
+            score, permutation_score, pvalue = permutation_test_score(clf, this_X_std, y, cv=cv, n_permutations=n_permutations,
+                                                                  random_state=random_state, n_jobs=n_jobs)
+            permutation_scores[sample_index, :] = permutation_score
+            pvalues[sample_index] = pvalue
+            scores[sample_index] = score
+
+    permutation_info = dict(n_permutations=np.full(n_samples, n_permutations), pvalues=pvalues)
 
-        # cross val
-        y_pred = cross_val_predict(clf, this_X_std, y, cv=cv)
+    # permutation_test_score draws the same permutations at every sample (fixed random_state), so they can be corrected across time
+    permutation_info.update(correct_across_time(scores, permutation_scores, cluster_alpha=alpha))
 
-        scores = np.mean(y_pred == y)
-        mean_scores[sample_index] = scores
+    return mean_scores, y_pred_all, y_true_all, permutation_scores, permutation_info
 
-        y_pred_all.append(y_pred)
-        y_true_all.append(y)
+## TEMPORAL GENERALIZATION
+def generalization_classification(X, y, triggers, n_splits=5, combine=None, model="gnb", block_size=None, trial_index=None,
+                                  balance_random_state=None):
+    '''
+    Temporal generalization decoding: train a classifier at every time sample and test it at every time sample
+    (batched engine, see batched_generalization_scores)
+
+    Args
+        X (array): data array with shape (n_trials, n_vertices, n_times) (may be memory-mapped, see get_source_space_data_labels)
+        y (array): triggers with shape (n_trials, )
+        triggers (list): triggers to include in the classification
+        n_splits (int): number of cross validation folds
+        combine (list): list of trigger pairs to combine into one class
+        model (str): diagonal-covariance model ("gnb" or "diag_lda")
+        block_size (int): number of time samples processed together (bounds memory, None sizes blocks automatically)
+        trial_index (TrialIndex): select and combine the trials through this index instead of y (see select_trials)
+        balance_random_state (int): seed for balancing the classes (see simple_classification)
+
+    Returns
+        generalization_scores (array): proportion classified correctly with shape (n_train_times, n_test_times)
+    '''
+    # select and balance the trials with the triggers we want
+    trials, y = select_trials(y, triggers, combine, trial_index=trial_index, random_state=balance_random_state)
+
+    # init cross validation
+    cv = StratifiedKFold(n_splits = n_splits, random_state=42, shuffle=True)
 
-        # permutation tst
-        _, permutation_score, pvalue = permutation_test_score(clf, this_X_std, y, cv=cv)
-        permutation_scores[sample_index, :] = permutation_score
-        
-    return mean_scores, y_pred_all, y_true_all, permutation_scores
+    return batched_generalization_scores(X, y, cv, model=model, block_size=block_size, trials=trials)
 
 def get_permutation_quantiles(permutation_scores):
-    percentile_01 = np.quantile(permutation_scores, 0.01, axis=1)
-    percentile_99 = np.quantile(permutation_scores, 0.99, axis=1)
+    # nan-aware as samples may have used different numbers of permutations (sequential permutation test)
+    percentile_01 = np.nanquantile(permutation_scores, 0.01, axis=1)
+    percentile_99 = np.nanquantile(permutation_scores, 0.99, axis=1)
 
     return percentile_01, percentile_99
 
-def plot_classification(times, mean_scores, permutation_scores, title=None, savepath=None):
+def plot_classification(times, mean_scores, permutation_scores, title=None, savepath=None, clusters=None, dpi=1200):
+    '''
+    Plot the time-resolved classification with the 1-99% range of the permutation scores.
+    clusters (array): optional (first, last + 1) samples of significant clusters (e.g., from correct_across_time, not available with bin_size) to shade
+    dpi (int): resolution if savepath is given (see figures.export_figures to render many plots in parallel or as vector graphics)
+    '''
     # get permutation quantiles
     percentile_01, percentile_99 = get_permutation_quantiles(permutation_scores)
 
@@ -200,6 +524,10 @@ def plot_classification(times, mean_scores, permutation_scores, title=None, save
     # Plot permutation scores
     ax.fill_between(times, percentile_01, percentile_99, color = "lightgray", alpha=0.55)
     
+    # shade significant clusters
+    for cluster_index, (start, stop) in enumerate(clusters if clusters is not None else []):
+        ax.axvspan(times[start], times[stop - 1], color='tab:blue', alpha=0.2, linewidth=0, label='Significant cluster' if cluster_index == 0 else None)
+
     # Add a dashed line at y=0.5
     ax.hlines(0.50, times[0], times[-1], linestyle='dashed', color='red', linewidth=0.75)
     
@@ -213,6 +541,37 @@ def plot_classification(times, mean_scores, permutation_scores, title=None, save
         ax.set_title(title, fontsize=16, fontweight='bold')
 
     if savepath: 
-        fig.savefig(savepath, dpi=1200, bbox_inches='tight')
+        fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
+
+    return fig, ax
+
+def plot_generalization(times, generalization_scores, title=None, savepath=None, dpi=1200):
+    '''
+    Plot a temporal generalization matrix (train time x test time)
+    '''
+    fig, ax = plt.subplots(figsize=(8, 6))
+
+    # centre the colour scale on chance
+    limit = max(np.abs(generalization_scores - 0.5).max(), 0.05)
+    image = ax.imshow(generalization_scores, origin='lower', cmap='RdBu_r', vmin=0.5 - limit, vmax=0.5 + limit,
+                      extent=[times[0], times[-1], times[0], times[-1]], interpolation='nearest')
+
+    # mark stimulus onset and the diagonal (time-resolved decoding)
+    ax.axvline(0, color='k', linewidth=0.75)
+    ax.axhline(0, color='k', linewidth=0.75)
+    ax.plot([times[0], times[-1]], [times[0], times[-1]], 'k--', linewidth=0.75)
+
+    # Set labels, title and colorbar
+    ax.set_xlabel('Testing time (s)', fontsize=14)
+    ax.set_ylabel('Training time (s)', fontsize=14)
+    ax.tick_params(axis='both', which='major', labelsize=12)
+    colorbar = fig.colorbar(image, ax=ax)
+    colorbar.set_label('Proportion classified correctly', fontsize=12)
+
+    if title:
+        ax.set_title(title, fontsize=16, fontweight='bold')
+
+    if savepath: 
+        fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
 
     return fig, ax
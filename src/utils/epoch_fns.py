@@ -0,0 +1,147 @@
+'''
+Epoching on the continuous data array, an alternative to mne.Epochs(..., preload=True) followed by pick_types and apply_proj.
+
+mne.Epochs cuts, baseline corrects, projects and checks every epoch in a loop. Here all windows are cut from a strided view of the
+preloaded data in one copy (only of the picked channels), and baseline correction, projection and the peak-to-peak rejection are
+applied to all epochs at once. The result is an mne.EpochsArray with the same events, selection and drop log as mne.Epochs.
+'''
+import numpy as np
+import mne
+from mne.baseline import rescale
+
+def _make_projector_info():
+    '''
+    mne's private make_projector_info (None if this mne version does not have it, see strided_supported)
+    '''
+    try:
+        from mne._fiff.proj import make_projector_info
+    except ImportError:
+        return None
+
+    return make_projector_info
+
+def epoch_windows(data, starts, n_times, picks):
+    '''
+    Cut windows of n_times samples starting at starts from data (n_channels, n_samples) without copying the full channels
+
+    Returns
+        windows (array): windows (n_epochs, n_picks, n_times)
+    '''
+    # view of all windows (n_samples - n_times + 1, n_channels, n_times), the fancy index makes the only copy
+    view = np.lib.stride_tricks.sliding_window_view(data, n_times, axis=-1).transpose(1, 0, 2)
+
+    return view[starts[:, np.newaxis], picks[np.newaxis, :]]
+
+def peak_to_peak(data):
+    '''
+    Peak-to-peak amplitude of every channel of every epoch in one pass
+
+    Args
+        data (array): epochs (n_epochs, n_channels, n_times)
+
+    Returns
+        deltas (array): peak-to-peak amplitudes (n_epochs, n_channels)
+    '''
+    return data.max(axis=-1) - data.min(axis=-1)
+
+def rejection_log(deltas, info, reject):
+    '''
+    Peak-to-peak rejection of all epochs at once (as mne's _is_good with full_report=True)
+
+    Args
+        deltas (array): peak-to-peak amplitudes (n_epochs, n_channels), see peak_to_peak
+        info (mne.Info): info of the channels
+        reject (dict): maximum peak-to-peak amplitude per channel type (e.g., dict(mag=4e-12, grad=4000e-13))
+
+    Returns
+        bad_log (list): tuple of the channels exceeding their threshold for every epoch (empty if the epoch is good)
+    '''
+    channel_type_idx = mne.channel_indices_by_type(info)
+    bad_log = [() for _ in range(len(deltas))]
+
+    for ch_type, threshold in reject.items():
+        idx = np.asarray(channel_type_idx[ch_type])
+        if len(idx) == 0:
+            continue
+
+        for epoch, channel in zip(*np.nonzero(deltas[:, idx] > threshold)):
+            bad_log[epoch] += (info["ch_names"][idx[channel]],)
+
+    return bad_log
+
+def strided_epochs(raw, events, event_id, tmin, tmax, baseline=(None, 0), reject=None):
+    '''
+    Epoch the MEG channels of preloaded raw data (see above). Equivalent to mne.Epochs(raw, events, event_id, tmin, tmax, baseline,
+    reject=reject, preload=True), .pick_types(meg=True) and .apply_proj()
+
+    Args
+        raw (mne.io.Raw): preloaded raw data (without bad annotations, see strided_supported)
+        events (array): events
+        event_id (dict): dictionary of events
+        tmin, tmax (float): start and end of epochs in seconds
+        baseline (tuple): baseline window (as in mne.Epochs)
+        reject (dict): peak-to-peak rejection thresholds per channel type (None rejects no epochs)
+
+    Returns
+        epochs (mne.EpochsArray): baseline corrected and projected epochs, the dropped epochs are in epochs.drop_log
+    '''
+    sfreq = raw.info["sfreq"]
+    events = np.asarray(events)
+
+    # the samples of mne.Epochs
+    times = np.arange(int(round(tmin * sfreq)), int(round(tmax * sfreq)) + 1) / sfreq
+    starts = np.round(events[:, 0] + times[0] * sfreq).astype(int) - raw.first_samp
+
+    # events that are not in event_id are ignored, events too close to the start or end of the data have no data
+    selected = np.isin(events[:, 2], list(event_id.values()))
+    drop_log = [() if is_selected else ("IGNORED",) for is_selected in selected]
+    for index in np.nonzero(selected & (starts < 0))[0]:
+        drop_log[index] = ("NO_DATA",)
+    for index in np.nonzero(selected & (starts >= 0) & (starts + len(times) > raw.n_times))[0]:
+        drop_log[index] = ("TOO_SHORT",)
+    selection = np.array([index for index, reason in enumerate(drop_log) if reason == ()], dtype=int)
+
+    picks = mne.pick_types(raw.info, meg=True)
+    info = mne.pick_info(raw.info, picks)
+    data = epoch_windows(raw._data, starts[selection], len(times), picks)
+
+    # baseline correction and projection of all epochs at once (projections that are already active are reapplied, as in mne.Epochs)
+    if baseline is not None:
+        rescale(data, times, baseline, mode="mean", copy=False, verbose=False)
+        baseline = (float(times[0] if baseline[0] is None else baseline[0]), float(times[-1] if baseline[1] is None else baseline[1]))
+
+    make_projector_info = _make_projector_info()
+    if make_projector_info is None or not hasattr(info, "_unlock"):
+        raise RuntimeError(f"strided_epochs is not supported with mne {mne.__version__}, use mne.Epochs (see strided_supported)")
+
+    projector, n_projs = make_projector_info(info)
+    if n_projs > 0:
+        data = np.matmul(projector, data)
+    with info._unlock():
+        for proj in info["projs"]:
+            proj["active"] = True
+
+    if reject:
+        bad_log = rejection_log(peak_to_peak(data), info, reject)
+        good = np.array([bad == () for bad in bad_log], dtype=bool)
+        for index, bad in zip(selection, bad_log):
+            drop_log[index] = drop_log[index] + bad
+        data, selection = data[good], selection[good]
+
+    # the projections are applied and data is baseline corrected already
+    epochs = mne.EpochsArray(data, info, events=events[selection], tmin=times[0], event_id=event_id, baseline=None, proj=False,
+                             selection=selection, drop_log=tuple(drop_log), verbose=False)
+    epochs.baseline = baseline
+    epochs.reject = dict(reject) if reject else None
+
+    return epochs
+
+def strided_supported(raw):
+    '''
+    Whether strided_epochs gives the same epochs as mne.Epochs for raw (preloaded, no bad annotations which mne.Epochs rejects by)
+    and the installed mne has the private helpers it uses
+    '''
+    if _make_projector_info() is None or not hasattr(mne.Info, "_unlock"):
+        return False
+
+    return raw.preload and not any(description.lower().startswith("bad") for description in raw.annotations.description)
@@ -0,0 +1,177 @@
+'''
+Headless figure export. Figures are rendered by plot functions in a pool of worker processes (offscreen, Agg backend),
+saved as raster (configurable dpi) and/or vector files, and only re-rendered when the data they are drawn from has changed.
+'''
+import hashlib, json, pathlib, os
+from functools import lru_cache
+
+import numpy as np
+
+from .cache import hash_file, write_cached
+from .parallel import get_n_jobs, get_executor
+
+# formats saved without rasterising (dpi only applies to raster formats)
+VECTOR_FORMATS = ["pdf", "svg", "eps"]
+
+@lru_cache(maxsize=256)
+def _hash_path(path, mtime_ns, size):
+    '''
+    Hash of a file, remembered as long as it is not modified
+    '''
+    return hash_file(path)
+
+def hash_inputs(value, digest=None):
+    '''
+    Hash the data a figure is drawn from: arrays by their content, existing files by their content, containers recursively
+    and anything else by its repr
+
+    Returns
+        key (str): hexdigest
+    '''
+    top_level = digest is None
+    digest = digest or hashlib.blake2b(digest_size=16)
+
+    if isinstance(value, np.ndarray):
+        digest.update(f"array{value.dtype}{value.shape}".encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, pathlib.Path) and value.is_file():
+        stat = value.stat()
+        digest.update(_hash_path(str(value), stat.st_mtime_ns, stat.st_size).encode())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            digest.update(f"key{key!r}".encode())
+            hash_inputs(value[key], digest)
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            hash_inputs(item, digest)
+    elif callable(value):
+        digest.update(f"{value.__module__}.{value.__qualname__}".encode())
+    else:
+        digest.update(repr(value).encode())
+
+    return digest.hexdigest() if top_level else None
+
+def figure_paths(savepath, n_figures, formats):
+    '''
+    Output files of a figure: one per format (replacing the suffix of savepath), and per figure if the plot function returns
+    several figures (savepath then contains an {index} field, e.g. "component_{index}.png")
+    '''
+    savepath = pathlib.Path(savepath)
+    formats = formats or [savepath.suffix.lstrip(".") or "png"]
+
+    paths = []
+    for index in range(n_figures):
+        path = pathlib.Path(str(savepath).format(index=index))
+        paths.append([path.with_suffix(f".{fmt}") for fmt in formats])
+
+    return paths
+
+def save_figure(fig, paths, dpi=300):
+    '''
+    Save a figure to each path (raster formats at dpi, vector formats unrasterised)
+    '''
+    for path in paths:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fmt = path.suffix.lstrip(".")
+
+        if fmt in VECTOR_FORMATS:
+            fig.savefig(path, format=fmt, bbox_inches='tight')
+        else:
+            fig.savefig(path, format=fmt, dpi=dpi, bbox_inches='tight')
+
+def render_figure(plot_fn, kwargs, savepath, dpi=300, formats=None):
+    '''
+    Call plot_fn(**kwargs) and save the figure(s) it returns (a figure, a (fig, ax) tuple or a list of figures)
+
+    Returns
+        paths (list): files written
+    '''
+    import matplotlib.pyplot as plt
+
+    result = plot_fn(**kwargs)
+
+    if isinstance(result, tuple):
+        figures = [result[0]]
+    elif isinstance(result, list):
+        figures = result
+    else:
+        figures = [result]
+
+    written = []
+    for fig, paths in zip(figures, figure_paths(savepath, len(figures), formats)):
+        save_figure(fig, paths, dpi=dpi)
+        plt.close(fig)
+        written.extend(paths)
+
+    return written
+
+def _render_worker(plot_fn, kwargs, savepath, dpi, formats):
+    '''
+    Worker entry point: render offscreen (Agg backend)
+    '''
+    import matplotlib.pyplot as plt
+    plt.switch_backend("agg")
+
+    return render_figure(plot_fn, kwargs, savepath, dpi=dpi, formats=formats)
+
+def export_figures(jobs, n_jobs=1, executor=None, dpi=300, formats=None, cache_dir=None, force=False):
+    '''
+    Render and save figures, in parallel worker processes if n_jobs > 1, skipping figures whose inputs have not changed
+
+    Args
+        jobs (list): one dict per figure with
+                        plot_fn (callable): module level function returning the figure(s) (picklable, for the worker processes)
+                        kwargs (dict): arguments of plot_fn
+                        savepath (pathlib.Path): output file (its suffix is replaced by formats, may contain {index}, see figure_paths)
+                        inputs (optional): what the figure is drawn from, hashed to decide whether to re-render (defaults to kwargs),
+                                           e.g. file paths or precomputed hashes when kwargs are expensive to hash
+        n_jobs (int): number of worker processes (1 renders in this process, -1 uses all cpus)
+        executor (concurrent.futures.Executor): optional executor to submit the figures to (overrides n_jobs)
+        dpi (int): resolution of raster formats
+        formats (list): file formats, e.g. ["png"] or ["pdf", "svg"] (None uses the suffix of each savepath)
+        cache_dir (pathlib.Path): directory for the input hashes of rendered figures (None always renders)
+        force (bool): render even if the inputs have not changed
+
+    Returns
+        summary (dict): "rendered" and "skipped" lists of the savepaths of the jobs
+    '''
+    summary = dict(rendered=[], skipped=[])
+    to_render = []
+
+    for job in jobs:
+        key = hash_inputs(dict(plot_fn=job["plot_fn"], inputs=job.get("inputs", job["kwargs"]), dpi=dpi, formats=formats))
+        record_path = None
+
+        if cache_dir is not None:
+            record_name = hashlib.blake2b(str(pathlib.Path(job["savepath"]).resolve()).encode(), digest_size=16).hexdigest()
+            record_path = pathlib.Path(cache_dir) / f"{record_name}.json"
+
+            if not force and record_path.exists():
+                record = json.loads(record_path.read_text())
+                if record["key"] == key and all(os.path.exists(path) for path in record["files"]):
+                    summary["skipped"].append(job["savepath"])
+                    continue
+
+        to_render.append((job, key, record_path))
+
+    def record(job, key, record_path, written):
+        summary["rendered"].append(job["savepath"])
+        if record_path is not None:
+            content = json.dumps(dict(key=key, files=[str(path) for path in written]))
+            write_cached(record_path.parent, record_path.stem, ".json", lambda path: pathlib.Path(path).write_text(content))
+
+    if executor is None and (get_n_jobs(n_jobs) == 1 or len(to_render) <= 1):
+        for job, key, record_path in to_render:
+            record(job, key, record_path, render_figure(job["plot_fn"], job["kwargs"], job["savepath"], dpi=dpi, formats=formats))
+
+        return summary
+
+    with get_executor(min(get_n_jobs(n_jobs), len(to_render)), executor) as pool:
+        futures = [(pool.submit(_render_worker, job["plot_fn"], job["kwargs"], job["savepath"], dpi, formats), job, key, record_path)
+                   for job, key, record_path in to_render]
+
+        for future, job, key, record_path in futures:
+            record(job, key, record_path, future.result())
+
+    return summary
@@ -0,0 +1,194 @@
+'''
+Fused band-pass filter and downsampling, an alternative to raw.filter followed by raw.resample.
+
+raw.filter applies the band-pass at the native sampling rate and raw.resample then does a second FFT-based pass over the full-rate data.
+Here the low-pass edge (mne's FIR design, which is also the anti-aliasing filter) is applied once at the native rate keeping only the
+samples needed, and the long high-pass FIR is applied after decimation (on a fraction of the samples). Channels and time are
+processed in chunks, so the memory used on top of the input and output is bounded by the chunk sizes.
+'''
+import numpy as np
+import mne
+from scipy.signal import oaconvolve
+
+def reflect_pad(x, n_pad):
+    '''
+    Pad the last axis of x by n_pad samples on both sides with odd reflection, and zeros beyond the length of x
+    (mne's "reflect_limited" padding)
+    '''
+    n_reflect = min(n_pad, x.shape[-1] - 1)
+    zeros = np.zeros(x.shape[:-1] + (n_pad - n_reflect,))
+    left = 2 * x[..., :1] - x[..., n_reflect:0:-1]
+    right = 2 * x[..., -1:] - x[..., -2:-n_reflect - 2:-1]
+
+    return np.concatenate([zeros, left, x, right, zeros], axis=-1)
+
+def fft_resample_phase(n_times, down):
+    '''
+    Input sample that the first output sample of mne's FFT resampling (raw.resample with npad="auto") corresponds to.
+    mne pads the data to a power of 2 before resampling, so output sample n lies at input sample down * n + phase (|phase| <= down / 2).
+    '''
+    min_add = min(n_times // 8, 100) * 2
+    npad = (2 ** int(np.ceil(np.log2(n_times + min_add))) - n_times) // 2
+
+    return down * int(round(npad / down)) - npad
+
+def lowpass_decimate(x, h, down, n_out, phase=0, n_extra=0, block_size=2**15):
+    '''
+    Zero-phase FIR filter x with h (odd length) and keep every down-th sample, in blocks of output samples
+
+    Args
+        x (array): data (n_channels, n_times)
+        h (array): symmetric FIR filter of odd length
+        down (int): decimation factor
+        n_out (int): number of output samples (output sample n is the filtered input sample down * n + phase)
+        phase (int): input sample of the first output sample (within the filter length of the start)
+        n_extra (int): number of output samples to add on both sides, computed from the padded input (for filters applied afterwards)
+        block_size (int): number of output samples computed at a time
+
+    Returns
+        y (array): filtered and decimated data (n_channels, n_out + 2 * n_extra), starting at output sample -n_extra
+    '''
+    center = (len(h) - 1) // 2
+
+    n_pad = len(h) - 1 + down * n_extra + abs(phase)
+    x = reflect_pad(x, n_pad)
+
+    # output sample n (counted from -n_extra) is sum_k h[k] x[down * n + offset - k] (x padded)
+    offset = n_pad - down * n_extra + center + phase
+
+    n_total = n_out + 2 * n_extra
+    y = np.empty(x.shape[:-1] + (n_total,))
+    for start in range(0, n_total, block_size):
+        stop = min(start + block_size, n_total)
+        segment = x[..., down * start + offset - (len(h) - 1):down * (stop - 1) + offset + 1]
+
+        # FFT convolution (faster than a direct polyphase filter for mne's filter lengths), only the kept samples are copied
+        y[..., start:stop] = oaconvolve(segment, h[np.newaxis], mode="valid", axes=-1)[..., ::down]
+
+    return y
+
+def filter_decimate(data, sfreq, l_freq, h_freq, new_sfreq, picks=None, phase="mne", chunk_size=32, block_size=2**15):
+    '''
+    Band-pass filter data from l_freq to h_freq and downsample it from sfreq to new_sfreq (an integer factor)
+
+    mne designs a band-pass as a low-pass at h_freq minus a (much longer) low-pass at l_freq. The short low-pass is applied with
+    lowpass_decimate, and the high-pass on the decimated data. The input is padded by the length of the high-pass (as mne pads by
+    the length of the band-pass), so the output also matches raw.filter near the edges.
+
+    Args
+        data (array): data (n_channels, n_times)
+        sfreq (float): sampling frequency of data
+        l_freq, h_freq (float): filter band in Hz (l_freq None only low-passes), the transition bands are mne's defaults
+        new_sfreq (float): sampling frequency to downsample to
+        picks (array): rows of data to filter (None filters all), only chunk_size rows are copied at a time
+        phase (int | str): input sample of the first output sample, "mne" uses the samples raw.resample (FFT) outputs (see fft_resample_phase)
+        chunk_size (int): number of channels filtered at a time
+        block_size (int): number of output samples decimated at a time
+
+    Returns
+        filtered (array): filtered data (n_picks, round(n_times * new_sfreq / sfreq))
+    '''
+    down = sfreq / new_sfreq
+    if not np.isclose(down, round(down)):
+        raise ValueError(f"Fused filtering needs an integer downsampling factor, {sfreq} Hz / {new_sfreq} Hz is not. Use raw.filter and raw.resample instead.")
+    if h_freq is None or h_freq >= new_sfreq / 2:
+        raise ValueError(f"h_freq ({h_freq} Hz) must be below the new Nyquist frequency ({new_sfreq / 2} Hz) to prevent aliasing")
+    down = int(round(down))
+
+    # low-pass and high-pass edges of mne's band-pass design (firwin, hamming window)
+    h_low = mne.filter.create_filter(None, sfreq, l_freq=None, h_freq=h_freq, verbose=False)
+    h_high = mne.filter.create_filter(None, new_sfreq, l_freq=l_freq, h_freq=None, verbose=False) if l_freq is not None else np.ones(1)
+    n_extra = (len(h_high) - 1) // 2
+
+    picks = np.arange(len(data)) if picks is None else np.asarray(picks)
+    n_out = max(int(round(data.shape[-1] * new_sfreq / sfreq)), 1)
+    if phase == "mne":
+        phase = fft_resample_phase(data.shape[-1], down)
+
+    filtered = np.empty((len(picks), n_out))
+    for start in range(0, len(picks), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        decimated = lowpass_decimate(data[picks[chunk]], h_low, down, n_out, phase=phase, n_extra=n_extra, block_size=block_size)
+
+        # high-pass on the decimated data (the extra samples on both sides are the padding)
+        filtered[chunk] = oaconvolve(decimated, h_high[np.newaxis], mode="valid", axes=-1)
+
+    return filtered
+
+def resample_stim(stim_data, ratio):
+    '''
+    Downsample stim channels keeping their events: each new sample takes the first non-zero value in its window of old samples
+    (or the value at the start of the window), as raw.resample does for stim channels
+
+    Args
+        stim_data (array): stim channels (n_stim_channels, n_samples)
+        ratio (float): new sampling frequency / old sampling frequency
+
+    Returns
+        stim_resampled (array): shape (n_stim_channels, round(n_samples * ratio))
+    '''
+    n_samples = stim_data.shape[1]
+    n_out = int(round(n_samples * ratio))
+
+    # first old sample and end of the window of every new sample
+    starts = np.minimum((np.arange(n_out) / ratio).astype(int), n_samples - 1)
+    stops = np.r_[starts[1:], n_samples]
+
+    stim_resampled = np.empty((len(stim_data), n_out))
+    for stim_index, stim in enumerate(stim_data):
+        nonzero = np.flatnonzero(stim)
+
+        # first non-zero sample at or after the start of each window, if it is inside the window
+        first = np.searchsorted(nonzero, starts)
+        candidate = nonzero[np.minimum(first, len(nonzero) - 1)] if len(nonzero) else starts
+        in_window = (first < len(nonzero)) & (candidate < stops)
+
+        stim_resampled[stim_index] = stim[np.where(in_window, candidate, starts)]
+
+    return stim_resampled
+
+def filter_resample(raw, l_freq, h_freq, sfreq, chunk_size=32):
+    '''
+    Fused raw.filter(l_freq, h_freq) and raw.resample(sfreq) (see filter_decimate). Data channels are filtered, stim channels are
+    downsampled keeping their events (as in raw.resample) and other channels are only low-passed before downsampling.
+
+    Args
+        raw (mne.io.Raw): preloaded raw data
+        l_freq, h_freq (float): filter band in Hz
+        sfreq (float): sampling frequency to downsample to (an integer factor of the sampling frequency of raw)
+        chunk_size (int): number of channels filtered at a time
+
+    Returns
+        resampled (mne.io.RawArray): filtered and downsampled raw data
+    '''
+    if not raw.preload:
+        raise ValueError("filter_resample needs preloaded data")
+
+    old_sfreq = raw.info["sfreq"]
+    ratio = sfreq / old_sfreq
+    data_picks = mne.pick_types(raw.info, meg=True, eeg=True, seeg=True, ecog=True, dbs=True, fnirs=True, ref_meg=False)
+    stim_picks = mne.pick_types(raw.info, meg=False, stim=True)
+    other_picks = np.setdiff1d(np.arange(len(raw.ch_names)), np.concatenate([data_picks, stim_picks]))
+
+    # the loaded data buffer (get_data would copy all channels at once)
+    raw_data = raw._data
+
+    n_out = max(int(round(raw.n_times * ratio)), 1)
+    data = np.empty((len(raw.ch_names), n_out))
+
+    data[data_picks] = filter_decimate(raw_data, old_sfreq, l_freq, h_freq, sfreq, picks=data_picks, chunk_size=chunk_size)
+    if len(stim_picks):
+        data[stim_picks] = resample_stim(raw_data[stim_picks], ratio)
+    if len(other_picks):
+        data[other_picks] = filter_decimate(raw_data, old_sfreq, None, h_freq, sfreq, picks=other_picks, chunk_size=chunk_size)
+
+    info = raw.info.copy()
+    with info._unlock():
+        info["sfreq"] = sfreq
+        info["highpass"] = l_freq if l_freq is not None else info["highpass"]
+        info["lowpass"] = h_freq
+
+    resampled = mne.io.RawArray(data, info, first_samp=int(round(raw.first_samp * ratio)), verbose=False)
+    resampled.set_annotations(raw.annotations)
+
+    return resampled
@@ -1,6 +1,11 @@
 import pathlib
 import mne
 
+from .parallel import get_n_jobs, get_executor
+from .profiling import trace_stage, array_info
+from .preprocess_graph import preprocessing_graph, run_graph
+from .epoch_fns import strided_epochs, strided_supported
+
 def ica_dict():
     ica_dict = {
         "001.self_block1":[1, 5, 8], 
@@ -13,7 +18,8 @@ def ica_dict():
 
     return ica_dict
 
-def preprocess(meg_path, recording_name, ica_path, ica_exclude:list):
+def preprocess(meg_path, recording_name, ica_path, ica_exclude:list, tmin=10, tmax=365, l_freq=0.1, h_freq=40, sfreq=250,
+               bads=("MEG0422",), fused=False, cache_dir=None, cache_max_bytes=20e9, inplace=False, memory_report=None):
     '''
     Preprocesses raw data for a single recording
 
@@ -22,6 +28,15 @@ def preprocess(meg_path, recording_name, ica_path, ica_exclude:list):
         recording_name (str): recording name
         ica_path (pathlib.Path): path to ICA data
         ica_exclude (list): list of ICA components to exclude
+        tmin, tmax (float): crop window in seconds
+        l_freq, h_freq (float): filter band in Hz
+        sfreq (float): sampling frequency to resample to
+        bads (tuple): bad channels to drop
+        fused (bool): filter and resample in one pass (see utils.filter_fns) instead of raw.filter and raw.resample (opt-in, the output differs slightly)
+        cache_dir (pathlib.Path): directory for the cached stages of the preprocessing graph (see utils.preprocess_graph, None disables caching)
+        cache_max_bytes (float): size budget of the cache, least recently used raws are evicted beyond it
+        inplace (bool): run the stages in place instead of on copies (lower peak memory, identical output)
+        memory_report (list): if a list is passed, a dict with the memory used by each stage is appended to it (see utils.profiling)
 
     Returns:
         processed_raw (mne.io.Raw): preprocessed raw data (where ica has been applied)
@@ -30,43 +45,42 @@ def preprocess(meg_path, recording_name, ica_path, ica_exclude:list):
     # load raw
     fif_fname = recording_name[4:]
     full_path = meg_path / recording_name / 'files' / (fif_fname + '.fif')
-    
-    # read, load raw, pick types
-    raw = mne.io.read_raw(full_path, preload=True)
-    raw.load_data()
-    raw.pick_types(meg=True, eog=False, stim=True)
-
-    # remove bad channel
-    raw.info['bads'] += ['MEG0422']
-    raw.drop_channels(raw.info['bads'])
-
-    # crop to remove initial HPI noise and noise at the end of each trial (verified by manually checking raws in run_raw.py)
-    cropped = raw.copy().crop(tmin=10, tmax=365)
-    del raw
-
-    # initial filtering (back to 0.1 hz instead of 1 hz)
-    filtered = cropped.copy().filter(l_freq=0.1, h_freq=40)
-    filtered.apply_proj()
-
-    # RESAMPLE 
-    resampled = filtered.copy().resample(250)
-    del filtered
-    
-    # load ICA 
     ica_full_path = ica_path / f"{recording_name}-ica.fif"
-    ica = mne.preprocessing.read_ica(ica_full_path)
 
-    # exclude icas 
-    ica.exclude = ica_exclude
+    # read, pick and crop (shared with run_ica.py) -> filter 0.1-40 hz + resample -> apply ICA, reusing the deepest cached stage
+    graph = preprocessing_graph(tmin=tmin, tmax=tmax, l_freq=l_freq, h_freq=h_freq, sfreq=sfreq, bads=bads,
+                                ica_file=ica_full_path, ica_exclude=ica_exclude, fused=fused)
+
+    processed = run_graph(full_path, graph, ["analysis"], cache_dir=cache_dir, cache_max_bytes=cache_max_bytes, inplace=inplace,
+                          memory_report=memory_report)
+
+    return processed["analysis"]
+
+def estimate_preprocess_memory(meg_path, recording_name, tmin=10, tmax=365):
+    '''
+    Estimate the peak memory (bytes) of preprocess for a single recording from the size of its FIF file, its channel count and its duration.
+    Only the MEG + stim channels within the crop window are loaded (as float64), and the loaded and filtered data are alive at the same time.
+    '''
+    full_path = meg_path / recording_name / 'files' / (recording_name[4:] + '.fif')
+
+    # only reads the header and the directory of the data buffers
+    raw = mne.io.read_raw(full_path, preload=False, verbose=False)
+    n_channels = len(raw.ch_names)
+    n_picked = len(mne.pick_types(raw.info, meg=True, stim=True))
+    window = (min(tmax, raw.times[-1]) - tmin) / raw.times[-1]
 
-    # apply ICA
-    processed_raw = resampled.copy()
-    del resampled
-    ica.apply(processed_raw)
+    # raw data is stored as 32 bit floats, so preloading it as float64 doubles the on-disk size
+    preloaded = 2 * pathlib.Path(full_path).stat().st_size
 
-    return processed_raw
+    return int(2 * preloaded * window * n_picked / n_channels)
 
-def preprocess_all(meg_path, recording_names, ica_path, ica_dict):
+def _preprocess_worker(meg_path, name, ica_path, ica_exclude, preprocess_kwargs):
+    '''
+    Run preprocess in a worker process (module level so that it can be pickled)
+    '''
+    return preprocess(meg_path, name, ica_path, ica_exclude, **preprocess_kwargs)
+
+def preprocess_all(meg_path, recording_names, ica_path, ica_dict, n_jobs=1, memory_budget=None, **preprocess_kwargs):
     '''
     Preprocesses all recordings in recording_names
 
@@ -75,19 +89,58 @@ def preprocess_all(meg_path, recording_names, ica_path, ica_dict):
         recording_names (list): list of recording names
         ica_path (pathlib.Path): path to ICA data
         ica_dict (dict): dictionary of ICA exclude lists
+        n_jobs (int): number of recordings preprocessed in parallel processes (-1 uses all cpus)
+        memory_budget (float): peak memory in bytes allowed for all workers together, caps the number of workers
+                               based on estimate_preprocess_memory (None means no cap)
+        preprocess_kwargs: passed to preprocess (e.g., cache_dir)
 
     Returns:
-        processed_raws (dict): dictionary of preprocessed raws (where ica has been applied)
+        processed_raws (dict): dictionary of preprocessed raws (where ica has been applied), in the order of recording_names
+
+    Raises:
+        RuntimeError: if any recording failed (serial or parallel), after all recordings were tried, listing the error of each
     '''
+    n_workers = min(get_n_jobs(n_jobs), len(recording_names))
+
+    if n_workers > 1 and memory_budget is not None:
+        window = {key: preprocess_kwargs[key] for key in ["tmin", "tmax"] if key in preprocess_kwargs}
+        peak_memory = max(estimate_preprocess_memory(meg_path, name, **window) for name in recording_names)
+        n_workers = max(min(n_workers, int(memory_budget // peak_memory)), 1)
 
     processed_raws = {}
-    for _, name in enumerate(recording_names):
-        ica_exclude = ica_dict[name]
-        processed_raws[name] = preprocess(meg_path, name, ica_path, ica_exclude)
+
+    # a failing recording does not stop the others, the failures are raised together below
+    failed = {}
+
+    if n_workers == 1:
+        for _, name in enumerate(recording_names):
+            ica_exclude = ica_dict[name]
+            try:
+                with trace_stage("preprocess", recording=name):
+                    processed_raws[name] = preprocess(meg_path, name, ica_path, ica_exclude, **preprocess_kwargs)
+            except Exception as error:
+                failed[name] = error
+
+    else:
+        # stages inside the worker processes are not traced
+        with trace_stage("preprocess_all", n_recordings=len(recording_names), n_workers=n_workers), get_executor(n_workers) as pool:
+            futures = {name: pool.submit(_preprocess_worker, meg_path, name, ica_path, ica_dict[name], preprocess_kwargs)
+                       for name in recording_names}
+
+            # collect in the original recording order
+            for name, future in futures.items():
+                try:
+                    processed_raws[name] = future.result()
+                except Exception as error:
+                    failed[name] = error
+
+    if failed:
+        report = "\n".join(f"    {name}: {type(error).__name__}: {error}" for name, error in failed.items())
+        raise RuntimeError(f"Preprocessing failed for {len(failed)} of {len(recording_names)} recordings:\n{report}") from next(iter(failed.values()))
 
     return processed_raws
 
-def epoching(raw, events, tmin, tmax, event_id=dict, reject_criterion:dict=None):
+def epoching(raw, events, tmin, tmax, event_id=dict, reject_criterion:dict=None, strided=False):
     '''
     Epochs raw data based on events and event_id. Rejects epochs based on reject_criterion if specified.
 
@@ -98,26 +151,36 @@ def epoching(raw, events, tmin, tmax, event_id=dict, reject_criterion:dict=None)
         tmax (float): end of epoch in seconds
         event_id (dict): dictionary of events
         reject_criterion (dict): dictionary of reject criterion
+        strided (bool): cut, baseline correct, project and reject all epochs at once (see utils.epoch_fns), same epochs and drop log as mne.Epochs.
+                        Falls back to mne.Epochs if the raw or the installed mne is not supported (see strided_supported)
 
     Returns:
         epochs (mne.Epochs): epoched data
     '''
 
-    if reject_criterion:
-        epochs = mne.Epochs(raw, events, event_id, tmin=tmin, tmax=tmax,
-                    baseline=(None, 0), reject=reject_criterion, preload=True,
-                    proj=True) # have proj = True if you want to reject 
-
-    else: 
-        epochs = mne.Epochs(raw, events, event_id, tmin=tmin, tmax=tmax,
-                    baseline=(None, 0), reject=reject_criterion, preload=True,
-                    proj=False)
-    
-    epochs.pick_types(meg=True, eog=False, ias=False, emg=False, misc=False,
-                        stim=False, syst=False)
-
-    # apply projections
-    epochs.apply_proj()
+    with trace_stage("epoching", n_events=len(events), strided=strided) as stage:
+        if strided and strided_supported(raw):
+            # already picked and projected
+            epochs = strided_epochs(raw, events, event_id, tmin=tmin, tmax=tmax, baseline=(None, 0), reject=reject_criterion)
+
+        else:
+            if reject_criterion:
+                epochs = mne.Epochs(raw, events, event_id, tmin=tmin, tmax=tmax,
+                            baseline=(None, 0), reject=reject_criterion, preload=True,
+                            proj=True) # have proj = True if you want to reject 
+
+            else: 
+                epochs = mne.Epochs(raw, events, event_id, tmin=tmin, tmax=tmax,
+                            baseline=(None, 0), reject=reject_criterion, preload=True,
+                            proj=False)
+            
+            epochs.pick_types(meg=True, eog=False, ias=False, emg=False, misc=False,
+                                stim=False, syst=False)
+
+            # apply projections
+            epochs.apply_proj()
+
+        stage.update(n_epochs=len(epochs), **array_info(epochs=epochs.get_data(copy=False)))
 
     return epochs 
 
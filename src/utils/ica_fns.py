@@ -0,0 +1,171 @@
+'''
+Fitting and plotting ICA. Fits and plots are loaded from / saved to file so that they can run in worker processes.
+'''
+import hashlib, pathlib, threading, time
+from contextlib import contextmanager
+
+import numpy as np
+import mne
+from mne.preprocessing import ica as ica_module
+from mne.utils.numerics import _PCA
+
+from .cache import get_cached, write_cached
+from .parallel import get_n_jobs, get_executor
+
+# fitted attributes of the PCA stage (see CachedPCA)
+PCA_ATTRIBUTES = ["mean_", "components_", "explained_variance_", "explained_variance_ratio_", "singular_values_",
+                  "noise_variance_", "n_samples_", "n_features_", "n_components_"]
+
+# cached_pca replaces the PCA of mne's ICA module for the whole process, so only one context may be active at a time
+_PCA_LOCK = threading.RLock()
+
+def plot_ica_components(ica_file):
+    '''
+    Topographies of all components of an ICA fit
+
+    Args
+        ica_file (pathlib.Path): path of the ICA fit (-ica.fif)
+
+    Returns
+        figures (list): figures of the components
+    '''
+    ica = mne.preprocessing.read_ica(ica_file, verbose=False)
+    components = ica.plot_components(show=False)
+
+    # a single figure is returned if all components fit in one
+    return components if isinstance(components, list) else [components]
+
+def plot_ica_sources(ica_file, raw_file, start_pick, end_pick):
+    '''
+    Time courses of the components start_pick to end_pick (exclusive) of an ICA fit
+
+    Args
+        ica_file (pathlib.Path): path of the ICA fit (-ica.fif)
+        raw_file (pathlib.Path): path of the raw data the ICA was fitted on
+        start_pick, end_pick (int): range of components to plot
+
+    Returns
+        fig (matplotlib.figure.Figure)
+    '''
+    ica = mne.preprocessing.read_ica(ica_file, verbose=False)
+    raw = mne.io.read_raw(raw_file, preload=True, verbose=False)
+
+    with mne.viz.use_browser_backend('matplotlib'):
+        fig = ica.plot_sources(raw, show=False, show_scrollbars=False, picks=range(start_pick, end_pick))
+
+    return fig
+
+class CachedPCA(_PCA):
+    '''
+    PCA (whitening) stage of ICA fitting that stores its decomposition in cache_dir, keyed by the hash of the (pre-whitened) data.
+    ICA refits of the same data with other n_components, methods or random states then skip the SVD and only redo the unmixing
+    (the whitened data is read back from a memory-mapped file, so the fits are identical to uncached ones).
+    '''
+    def __init__(self, cache_dir, n_components=None, whiten=True):
+        super().__init__(n_components=n_components, whiten=whiten)
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.from_cache = False
+
+    def fit_transform(self, X, y=None):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{X.dtype}{X.shape}{self.n_components}{self.whiten}".encode())
+        digest.update(np.ascontiguousarray(X).tobytes())
+        key = digest.hexdigest()
+
+        cached_path = get_cached(self.cache_dir, key, "-pca.npz")
+
+        if cached_path is None:
+            U = super().fit_transform(X)
+            attributes = {name: getattr(self, name) for name in PCA_ATTRIBUTES}
+
+            write_cached(self.cache_dir, key, "-pca.npz", lambda path: np.savez(path, **attributes))
+            write_cached(self.cache_dir, key, "-pca_transformed.npy", lambda path: np.save(path, U))
+
+            return U
+
+        with np.load(cached_path) as cached:
+            for name in PCA_ATTRIBUTES:
+                setattr(self, name, cached[name][()])
+        self.from_cache = True
+
+        # load into memory, the unmixing iterates over it
+        return np.array(np.load(self.cache_dir / f"{key}-pca_transformed.npy", mmap_mode="r"))
+
+@contextmanager
+def cached_pca(cache_dir):
+    '''
+    Use CachedPCA (see above) for ICA fits within the context. The PCA of mne's ICA module is replaced for the whole process,
+    so contexts in several threads are run one at a time (fit in worker processes to fit in parallel, see fit_icas).
+
+    Yields
+        pcas (list): the CachedPCA of each fit (e.g., to check pca.from_cache)
+    '''
+    pcas = []
+
+    def make_pca(n_components=None, whiten=True):
+        pcas.append(CachedPCA(cache_dir, n_components=n_components, whiten=whiten))
+        return pcas[-1]
+
+    with _PCA_LOCK:
+        original = ica_module._PCA
+        ica_module._PCA = make_pca
+
+        try:
+            yield pcas
+        finally:
+            ica_module._PCA = original
+
+def fit_ica(raw_file, ica_file, n_components=0.9999, method="fastica", random_state=42, max_iter=3000, pca_cache_dir=None):
+    '''
+    Fit an ICA to preprocessed (filtered, resampled) raw data and save it
+
+    Args
+        raw_file (pathlib.Path): path of the raw data to fit to
+        ica_file (pathlib.Path): path to save the ICA fit to (-ica.fif)
+        n_components (int | float): number of components, or the proportion of variance explained by them
+        method (str): "fastica", "infomax" or "picard"
+        random_state (int): seed of the unmixing
+        max_iter (int): maximum number of unmixing iterations
+        pca_cache_dir (pathlib.Path): cache for the PCA stage (see CachedPCA), None computes it every time
+
+    Returns
+        report (dict): n_components_, n_iter_, converged, pca_cached, fit_s (seconds for the fit, without reading the data)
+    '''
+    raw = mne.io.read_raw(raw_file, preload=True, verbose=False)
+    ica = mne.preprocessing.ICA(n_components=n_components, method=method, random_state=random_state, max_iter=max_iter, verbose=False)
+
+    start = time.perf_counter()
+    if pca_cache_dir is not None:
+        with cached_pca(pca_cache_dir) as pcas:
+            ica.fit(raw, verbose=False)
+        pca_cached = pcas[-1].from_cache
+    else:
+        ica.fit(raw, verbose=False)
+        pca_cached = False
+    fit_s = time.perf_counter() - start
+
+    ica.save(ica_file, overwrite=True, verbose=False)
+
+    return dict(n_components_=int(ica.n_components_), n_iter_=int(ica.n_iter_), converged=bool(ica.n_iter_ < max_iter),
+                pca_cached=pca_cached, fit_s=fit_s)
+
+def fit_icas(jobs, n_jobs=1, executor=None):
+    '''
+    Fit several ICAs (e.g., one per recording) in parallel worker processes
+
+    Args
+        jobs (dict): keyword arguments of fit_ica for each fit (keys are names, e.g. recording names)
+        n_jobs (int): number of worker processes (-1 uses all cpus)
+        executor (concurrent.futures.Executor): optional executor to submit the fits to (overrides n_jobs). Fits with a
+                                                pca_cache_dir run one at a time in a thread pool (see cached_pca)
+
+    Returns
+        reports (dict): report of each fit (see fit_ica)
+    '''
+    if executor is None and (get_n_jobs(n_jobs) == 1 or len(jobs) <= 1):
+        return {name: fit_ica(**kwargs) for name, kwargs in jobs.items()}
+
+    with get_executor(min(get_n_jobs(n_jobs), len(jobs)), executor) as pool:
+        futures = {name: pool.submit(fit_ica, **kwargs) for name, kwargs in jobs.items()}
+
+        return {name: future.result() for name, future in futures.items()}
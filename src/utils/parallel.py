@@ -0,0 +1,84 @@
+'''
+Helpers for spreading work over a process pool
+'''
+import os, tempfile, pathlib, shutil
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# memory maps opened by this (worker) process, keyed by path
+_opened_arrays = {}
+
+def get_n_jobs(n_jobs):
+    '''
+    Resolve n_jobs (None means 1, negative values count back from the number of cpus as in joblib)
+    '''
+    n_cpus = os.cpu_count() or 1
+
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(n_cpus + 1 + n_jobs, 1)
+
+    return max(min(n_jobs, n_cpus), 1)
+
+@contextmanager
+def get_executor(n_jobs=1, executor=None):
+    '''
+    Yield the executor passed by the user, or a process pool with n_jobs workers which is shut down afterwards
+    '''
+    if executor is not None:
+        yield executor
+        return
+
+    with ProcessPoolExecutor(max_workers=get_n_jobs(n_jobs)) as pool:
+        yield pool
+
+@contextmanager
+def shared_array(X, tmp_dir=None):
+    '''
+    Write X once to a memory-mapped .npy file (in shared memory /dev/shm if available) so that workers can read it without pickling.
+    Yields the path of the file, which is removed afterwards. If X already is a memory-mapped .npy file (e.g., a feature store),
+    its path is yielded as is.
+
+    Args
+        X (array): array to share
+        tmp_dir (str): directory for the file (defaults to /dev/shm if it exists, else the system temp dir)
+    '''
+    if is_npy_memmap(X):
+        yield str(X.filename)
+        return
+
+    if tmp_dir is None and os.path.isdir("/dev/shm"):
+        tmp_dir = "/dev/shm"
+
+    share_dir = pathlib.Path(tempfile.mkdtemp(prefix="inner_speech_", dir=tmp_dir))
+    path = share_dir / "X.npy"
+
+    try:
+        np.save(path, X)
+        yield str(path)
+    finally:
+        _opened_arrays.pop(str(path), None)
+        shutil.rmtree(share_dir, ignore_errors=True)
+
+def is_npy_memmap(X):
+    '''
+    Whether X is a complete memory-mapped .npy file (and not a view of a part of it)
+    '''
+    if not isinstance(X, np.memmap) or X.filename is None or not str(X.filename).endswith(".npy"):
+        return False
+
+    on_disk = np.load(X.filename, mmap_mode="r")
+
+    return on_disk.shape == X.shape and on_disk.dtype == X.dtype and on_disk.offset == X.offset and X.flags.c_contiguous
+
+def load_shared_array(path):
+    '''
+    Open (read only) a memory-mapped array written by shared_array, once per process
+    '''
+    if path not in _opened_arrays:
+        _opened_arrays[path] = np.load(path, mmap_mode="r")
+
+    return _opened_arrays[path]
@@ -0,0 +1,225 @@
+'''
+Preprocessing as a small graph of stages. All branches share a prefix (read, pick, crop) which is computed once per recording
+and fanned out to the branches:
+
+    prefix:   read (lazily) -> pick MEG + stim, drop bads -> crop 10-365 s -> load
+    ica_fit:  prefix -> filter 1-40 Hz -> resample 250 Hz          (data the ICA is fitted on, run_ica.py)
+    filtered: prefix -> filter 0.1-40 Hz -> resample 250 Hz        (data for analysis before ICA)
+    analysis: filtered -> apply ICA                                (preprocess)
+
+The output of the downsampled nodes (filtered and analysis by default, ica_fit for run_ica.py) is saved to the cache directory,
+keyed by the content of the recording and the parameters of all stages up to the node, so whichever script runs next starts from
+the deepest node already computed (e.g., changing the excluded components only reruns the analysis node after filtered).
+The prefix is still at the full sampling rate (hundreds of MB per recording in double precision), so it is only cached on request.
+
+Filtering and resampling can be fused into one stage (fused=True, see utils.filter_fns), which only filters the samples kept at 250 Hz.
+Its output differs slightly from raw.filter -> raw.resample, so it is opt-in.
+'''
+import pathlib
+import numpy as np
+import mne
+
+from .cache import hash_file, hash_params, get_cached, write_cached, evict
+from .filter_fns import filter_resample
+from .profiling import track_memory
+
+def _pick(raw, bads):
+    raw.pick_types(meg=True, eog=False, stim=True)
+
+    # remove bad channels
+    raw.info['bads'] += list(bads)
+    raw.drop_channels(raw.info['bads'])
+
+def _crop(raw, tmin, tmax):
+    # remove initial HPI noise and noise at the end of each trial (verified by manually checking raws in run_raw.py)
+    raw.crop(tmin=tmin, tmax=tmax)
+
+def _load(raw):
+    # only the picked channels of the buffers within the crop window are read from the file
+    raw.load_data()
+
+def _filter(raw, l_freq, h_freq):
+    raw.filter(l_freq=l_freq, h_freq=h_freq)
+    raw.apply_proj()
+
+def _resample(raw, sfreq):
+    raw.resample(sfreq)
+
+def _filter_resample(raw, l_freq, h_freq, sfreq):
+    # the fused filter needs an integer downsampling factor
+    if not np.isclose(raw.info['sfreq'] / sfreq, round(raw.info['sfreq'] / sfreq)):
+        _filter(raw, l_freq, h_freq)
+        _resample(raw, sfreq)
+        return raw
+
+    raw = filter_resample(raw, l_freq=l_freq, h_freq=h_freq, sfreq=sfreq)
+    raw.apply_proj()
+
+    return raw
+
+def _apply_ica(raw, ica_file, exclude):
+    ica = mne.preprocessing.read_ica(ica_file)
+    ica.exclude = list(exclude)
+    ica.apply(raw)
+
+# stages modify the raw in place (or return a new raw)
+STAGES = {"pick": _pick, "crop": _crop, "load": _load, "filter": _filter, "resample": _resample, "filter_resample": _filter_resample, "ica": _apply_ica}
+
+def preprocessing_graph(tmin=10, tmax=365, l_freq=0.1, h_freq=40, ica_l_freq=1, sfreq=250, bads=("MEG0422",), ica_file=None, ica_exclude=(),
+                        fused=False):
+    '''
+    Nodes of the preprocessing graph (see above)
+
+    Args
+        tmin, tmax (float): crop window in seconds
+        l_freq, h_freq (float): filter band in Hz of the analysis branch
+        ica_l_freq (float): high-pass in Hz of the data the ICA is fitted on
+        sfreq (float): sampling frequency to resample to
+        bads (tuple): bad channels to drop
+        ica_file (pathlib.Path): ICA fit to apply in the analysis node (None leaves out the analysis node)
+        ica_exclude (list): ICA components to exclude
+        fused (bool): filter and resample in one stage (see utils.filter_fns) instead of raw.filter and raw.resample
+
+    Returns
+        graph (dict): {node: (parent node or None for the raw file, [(stage, params), ...])}
+    '''
+    def filter_stages(l_freq):
+        if fused:
+            return [("filter_resample", dict(l_freq=l_freq, h_freq=h_freq, sfreq=sfreq))]
+
+        return [("filter", dict(l_freq=l_freq, h_freq=h_freq)), ("resample", dict(sfreq=sfreq))]
+
+    graph = {
+        "prefix": (None, [("pick", dict(bads=sorted(bads))), ("crop", dict(tmin=tmin, tmax=tmax)), ("load", dict())]),
+        "ica_fit": ("prefix", filter_stages(ica_l_freq)),
+        "filtered": ("prefix", filter_stages(l_freq)),
+        }
+
+    if ica_file is not None:
+        graph["analysis"] = ("filtered", [("ica", dict(ica_file=pathlib.Path(ica_file), exclude=sorted(ica_exclude)))])
+
+    return graph
+
+def node_keys(full_path, graph):
+    '''
+    Cache key of every node: hash of the key of its parent (the content of the raw file for the prefix) and its stages
+    (files in the parameters, e.g. the ICA fit, are keyed by their content)
+    '''
+    keys = {}
+
+    def key(node):
+        if node not in keys:
+            parent, stages = graph[node]
+            stages = [(stage, {name: hash_file(value) if isinstance(value, pathlib.Path) else value for name, value in params.items()})
+                      for stage, params in stages]
+            parent_key = hash_file(full_path) if parent is None else key(parent)
+            keys[node] = hash_params(dict(parent=parent_key, stages=stages, mne=mne.__version__))
+
+        return keys[node]
+
+    for node in graph:
+        key(node)
+
+    return keys
+
+def run_graph(full_path, graph, outputs, cache_dir=None, cache_max_bytes=20e9, cache_nodes=("filtered", "analysis"), load=True, inplace=True,
+              memory_report=None):
+    '''
+    Compute the output nodes of the preprocessing graph for one recording. Each node needed is computed once, nodes
+    with several children are copied for all but the last, and nodes already in the cache are read instead of computed.
+
+    Args
+        full_path (pathlib.Path): path of the raw recording (.fif)
+        graph (dict): preprocessing graph (see preprocessing_graph)
+        outputs (list): nodes to return
+        cache_dir (pathlib.Path): directory the output of the cache_nodes is saved to (None disables caching)
+        cache_max_bytes (float): size budget of the cache, least recently used nodes are evicted beyond it
+        cache_nodes (tuple): nodes that are saved to and read from the cache (e.g., add "prefix" to also cache the full-rate data)
+        load (bool): return the raws of the outputs, if False their paths in cache_dir are returned (without reading them,
+                     the outputs must be in cache_nodes)
+        inplace (bool): run the stages of a node in place on the output of its parent when the parent has no other children
+                        (lower peak memory, identical output) instead of on a copy
+        memory_report (list): if a list is passed, a dict with the memory used by each stage is appended to it (see utils.profiling)
+
+    Returns
+        results (dict): raw (or path of the cached raw if load is False) of each output node
+    '''
+    if not load and cache_dir is None:
+        raise ValueError("load=False needs a cache_dir to return the paths of the outputs")
+
+    if not load and not set(outputs) <= set(cache_nodes):
+        raise ValueError(f"load=False needs the outputs {outputs} in cache_nodes {cache_nodes} to return their paths")
+
+    keys = node_keys(full_path, graph)
+    cached = {node: get_cached(cache_dir, keys[node], "_raw.fif") if cache_dir is not None and node in cache_nodes else None for node in graph}
+
+    # nodes to compute: the outputs and their ancestors up to the first cached node, and how often each is used
+    to_compute, uses = [], {node: int(node in outputs) for node in graph}
+    for output in outputs:
+        node = output
+        while node is not None and cached[node] is None and node not in to_compute:
+            to_compute.append(node)
+            parent = graph[node][0]
+            if parent is not None:
+                uses[parent] += 1
+            node = parent
+
+    raws = {}
+
+    def get_raw(node):
+        '''
+        Raw of a node, taken over by the caller if it is its last use
+        '''
+        if node not in raws:
+            if node in to_compute:
+                raws[node] = compute(node)
+            else:
+                raws[node] = mne.io.read_raw_fif(cached[node], preload=True)
+
+        uses[node] -= 1
+        if uses[node] > 0:
+            return raws[node].copy()
+
+        return raws.pop(node)
+
+    def compute(node):
+        parent, stages = graph[node]
+
+        if parent is None:
+            # only the header is read here, the data is loaded by the load stage after picking and cropping
+            with track_memory("read", memory_report):
+                raw = mne.io.read_raw(full_path, preload=False)
+        else:
+            raw = get_raw(parent)
+            if not inplace:
+                raw = raw.copy()
+
+        for stage, params in stages:
+            with track_memory(stage, memory_report):
+                result = STAGES[stage](raw, **params)
+                if result is not None:
+                    raw = result
+
+        if cache_dir is not None and node in cache_nodes:
+            # save in double precision so that a cache hit returns exactly the same data
+            cached[node] = write_cached(cache_dir, keys[node], "_raw.fif", lambda path: raw.save(path, fmt="double", overwrite=True))
+            evict(cache_dir, cache_max_bytes, pattern="*_raw.fif", keep=[path for path in cached.values() if path is not None])
+
+        return raw
+
+    results = {}
+    for output in outputs:
+        if load:
+            results[output] = get_raw(output)
+        else:
+            if cached[output] is None:
+                raws[output] = compute(output)
+                uses[output] -= 1
+
+            # drop nodes that are not needed anymore
+            for node in [node for node in raws if uses[node] <= 0]:
+                del raws[node]
+
+            results[output] = cached[output]
+
+    return results
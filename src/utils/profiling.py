@@ -0,0 +1,246 @@
+'''
+Instrumentation of pipeline stages (memory, and wall time / CPU time traces that can be opened in a trace viewer)
+'''
+import resource, tracemalloc, os, time, json, threading, cProfile, pathlib
+from contextlib import contextmanager
+
+# trace events recorded since start_tracing (None when tracing is off), see trace_stage
+_trace = None
+_trace_start = 0
+
+# directory for the cProfile output of hot loops (None when profiling is off), see profile_hot_loop
+_profile_dir = None
+_profile_active = False
+
+# running peak resident set size of the open (nested) stages, as entering a stage resets the peak
+_open_stages = []
+
+def current_rss():
+    '''
+    Current resident set size of this process in bytes (Linux, else None)
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+def reset_peak_rss():
+    '''
+    Reset the peak resident set size of this process (Linux >= 4.0). Returns False if not supported, in which case
+    peak_rss() returns the peak over the lifetime of the process
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss():
+    '''
+    Peak resident set size in bytes since the last reset_peak_rss (or since the process started)
+    '''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+@contextmanager
+def track_memory(stage, report=None):
+    '''
+    Record memory used by a stage: bytes allocated (peak of traced allocations above the level at the start of the stage),
+    net bytes still allocated at the end, and the peak resident set size during the stage.
+
+    Args
+        stage (str): name of the stage
+        report (list): list to append a dict per stage to. If None, nothing is tracked.
+    '''
+    if report is None:
+        with trace_stage(stage, category="memory"):
+            yield
+        return
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    tracemalloc.reset_peak()
+    _update_open_stages()
+    reset_peak_rss()
+    start_traced, _ = tracemalloc.get_traced_memory()
+
+    try:
+        with trace_stage(stage, category="memory"):
+            yield
+    finally:
+        end_traced, peak_traced = tracemalloc.get_traced_memory()
+
+        report.append(dict(
+            stage=stage,
+            allocated_bytes=peak_traced - start_traced,
+            net_bytes=end_traced - start_traced,
+            rss_bytes=current_rss(),
+            peak_rss_bytes=peak_rss(),
+            ))
+
+        if started_tracing:
+            tracemalloc.stop()
+
+def format_memory_report(report):
+    '''
+    Format a memory report (list of stage dicts) as a table in MB
+    '''
+    lines = [f"{'stage':<12}{'allocated':>12}{'net':>12}{'rss':>12}{'peak rss':>12}"]
+
+    for row in report:
+        values = [row[key] for key in ["allocated_bytes", "net_bytes", "rss_bytes", "peak_rss_bytes"]]
+        lines.append(f"{row['stage']:<12}" + "".join(f"{value / 1e6 if value is not None else float('nan'):>12.1f}" for value in values))
+
+    return "\n".join(lines)
+
+def start_tracing(profile_dir=None):
+    '''
+    Start recording trace events for every stage (see trace_stage)
+
+    Args
+        profile_dir (pathlib.Path): if given, hot loops are also profiled with cProfile (see profile_hot_loop) and written to this directory
+    '''
+    global _trace, _trace_start, _profile_dir
+
+    _trace = [dict(name="process_name", ph="M", pid=os.getpid(), args=dict(name="inner-speech-MEG"))]
+    _trace_start = time.perf_counter_ns()
+    _profile_dir = pathlib.Path(profile_dir) if profile_dir is not None else None
+
+    if _profile_dir is not None:
+        _profile_dir.mkdir(parents=True, exist_ok=True)
+
+def stop_tracing(path=None):
+    '''
+    Stop tracing and write the events as Chrome trace-event JSON (open in chrome://tracing, https://ui.perfetto.dev or speedscope)
+
+    Args
+        path (pathlib.Path): output file (None only returns the events)
+
+    Returns
+        events (list): trace events
+    '''
+    global _trace, _profile_dir
+
+    events, _trace, _profile_dir = _trace or [], None, None
+
+    if path is not None:
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f, default=_to_json)
+
+    return events
+
+def _to_json(value):
+    '''
+    Convert numpy values (and anything else) in event args to JSON
+    '''
+    return value.tolist() if hasattr(value, "tolist") else str(value)
+
+def _timestamp():
+    '''
+    Microseconds since start_tracing
+    '''
+    return (time.perf_counter_ns() - _trace_start) / 1e3
+
+def array_info(**arrays):
+    '''
+    Shapes and sizes of arrays for trace event args, e.g. stage.update(array_info(X=X))
+    '''
+    info = {}
+
+    for name, array in arrays.items():
+        info[f"{name}_shape"] = list(array.shape)
+        info[f"{name}_bytes"] = int(array.nbytes)
+
+    return info
+
+def _update_open_stages():
+    '''
+    Update the running peak resident set size of the open stages (before the peak is reset)
+    '''
+    peak = peak_rss()
+
+    for open_stage in _open_stages:
+        open_stage[0] = max(open_stage[0], peak)
+
+@contextmanager
+def trace_stage(name, category="stage", **args):
+    '''
+    Record a stage as a complete trace event with its wall time, CPU time and peak resident set size (no-op unless start_tracing was called).
+    Yields the dict of event args, so that sizes known inside the stage can be added:
+
+        with trace_stage("apply_inverse", recording=recording_name, label=name) as stage:
+            ...
+            stage.update(array_info(kernel=kernel))
+
+    Args
+        name (str): name of the stage
+        category (str): category of the stage (e.g., "stage", "memory" for the stages of track_memory)
+        args: context of the stage (e.g., recording or label) shown in the trace viewer
+    '''
+    if _trace is None:
+        yield args
+        return
+
+    # nested stages reset the peak, so hand the peak so far to the enclosing stages first
+    _update_open_stages()
+    reset_peak_rss()
+
+    running_peak = [current_rss() or 0]
+    _open_stages.append(running_peak)
+
+    start, cpu = _timestamp(), time.process_time()
+
+    try:
+        yield args
+    finally:
+        end, cpu = _timestamp(), time.process_time() - cpu
+
+        _update_open_stages()
+        _open_stages.pop()
+
+        rss = current_rss()
+        event_args = dict(args, wall_s=(end - start) / 1e6, cpu_s=cpu, peak_rss_bytes=running_peak[0], rss_bytes=rss)
+
+        if _trace is not None:
+            _trace.append(dict(name=name, cat=category, ph="X", ts=start, dur=end - start, pid=os.getpid(), tid=threading.get_ident(),
+                               args=event_args))
+            _trace.append(dict(name="memory", ph="C", ts=end, pid=os.getpid(), args=dict(rss_MB=(rss or 0) / 1e6)))
+
+@contextmanager
+def profile_hot_loop(name):
+    '''
+    Opt-in cProfile of a hot loop (only if start_tracing was called with profile_dir). Every call writes {profile_dir}/{name}_{n}.prof,
+    which can be read with pstats, snakeviz or converted for speedscope. Nested hot loops are profiled by the outermost one.
+    For sampling profilers such as py-spy (py-spy record -- python src/classify.py ...) the loops need no hook.
+    '''
+    global _profile_active
+
+    if _profile_dir is None or _profile_active:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    _profile_active = True
+    profiler.enable()
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profile_active = False
+
+        n_profiles = len(list(_profile_dir.glob(f"{name}_*.prof")))
+        profiler.dump_stats(_profile_dir / f"{name}_{n_profiles}.prof")
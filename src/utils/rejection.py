@@ -0,0 +1,161 @@
+'''
+Peak-to-peak rejection from stored amplitudes. The peak-to-peak amplitude of every channel of every epoch is computed once, on epochs
+epoched without rejection. Any rejection thresholds can then be evaluated (PeakToPeakTable.sweep) or applied to the epochs
+(PeakToPeakTable.apply) without epoching again. Applying a threshold gives the same epochs and drop log as rejecting while epoching.
+'''
+import pathlib
+import numpy as np
+import mne
+
+from .epoch_fns import peak_to_peak, rejection_log
+
+# peak-to-peak rejection thresholds of the analysis (T, T/m)
+DEFAULT_REJECT = dict(mag=4e-12, grad=4000e-13)
+
+class PeakToPeakTable:
+    '''
+    Peak-to-peak amplitudes of the epochs of all recordings:
+        deltas (dict): peak-to-peak amplitude of every channel (n_epochs, n_channels) for each recording
+        max_deltas (dict): largest peak-to-peak amplitude per channel type {ch_type: (n_trials,)} over all recordings
+        recording (array): position of the recording of every trial in recording_names
+        trigger (array): trigger value of every trial
+    '''
+    def __init__(self, recording_names, deltas:dict, max_deltas:dict, recording, trigger):
+        self.recording_names = list(recording_names)
+        self.deltas = deltas
+        self.max_deltas = {ch_type: np.asarray(values) for ch_type, values in max_deltas.items()}
+        self.recording = np.asarray(recording)
+        self.trigger = np.asarray(trigger)
+
+    def __len__(self):
+        return len(self.trigger)
+
+    def __repr__(self):
+        return f"<PeakToPeakTable | {len(self)} trials, {len(self.recording_names)} recordings, {', '.join(self.max_deltas)}>"
+
+    @classmethod
+    def from_epochs_dict(cls, epochs_dict:dict, ch_types=("mag", "grad")):
+        '''
+        Compute the peak-to-peak amplitudes of epochs without rejection (e.g., epoching(..., reject_criterion=None))
+
+        Args
+            epochs_dict (dict): epochs for each recording (keys are recording names, values are epochs objects)
+            ch_types (tuple): channel types thresholds can be set for
+
+        Returns
+            table (PeakToPeakTable)
+        '''
+        deltas, max_deltas = {}, {ch_type: [] for ch_type in ch_types}
+        recording, trigger = [], []
+
+        for recording_index, (recording_name, epochs) in enumerate(epochs_dict.items()):
+            deltas[recording_name] = peak_to_peak(epochs.get_data(copy=False))
+            channel_type_idx = mne.channel_indices_by_type(epochs.info)
+
+            for ch_type in ch_types:
+                idx = channel_type_idx[ch_type]
+                max_deltas[ch_type].append(deltas[recording_name][:, idx].max(axis=1) if len(idx) else np.zeros(len(epochs)))
+
+            recording.append(np.full(len(epochs), recording_index))
+            trigger.append(epochs.events[:, 2])
+
+        max_deltas = {ch_type: np.concatenate(values) for ch_type, values in max_deltas.items()}
+
+        return cls(epochs_dict.keys(), deltas, max_deltas, np.concatenate(recording), np.concatenate(trigger))
+
+    def save(self, path):
+        '''
+        Save the table as .npz
+        '''
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        arrays = {f"deltas_{index}": self.deltas[name] for index, name in enumerate(self.recording_names)}
+        arrays.update({f"max_{ch_type}": values for ch_type, values in self.max_deltas.items()})
+        np.savez(path, recording_names=np.array(self.recording_names), recording=self.recording, trigger=self.trigger, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a table saved with save
+        '''
+        with np.load(path) as arrays:
+            recording_names = arrays["recording_names"].tolist()
+            deltas = {name: arrays[f"deltas_{index}"] for index, name in enumerate(recording_names)}
+            max_deltas = {key[len("max_"):]: arrays[key] for key in arrays.files if key.startswith("max_")}
+
+            return cls(recording_names, deltas, max_deltas, arrays["recording"], arrays["trigger"])
+
+    def keep(self, reject:dict):
+        '''
+        Boolean mask of the trials kept by reject (mne rejects epochs with a peak-to-peak amplitude above the threshold)
+        '''
+        keep = np.ones(len(self), dtype=bool)
+
+        for ch_type, threshold in reject.items():
+            keep &= self.max_deltas[ch_type] <= threshold
+
+        return keep
+
+    def sweep(self, **thresholds):
+        '''
+        Number of trials kept per recording and trigger for every combination of thresholds,
+        e.g. table.sweep(mag=[3e-12, 4e-12, 5e-12], grad=[3000e-13, 4000e-13])
+
+        Returns
+            counts (dict): {(threshold per ch_type, ...): {(recording_name, trigger): count}}, in the order of the keyword arguments
+        '''
+        ch_types = list(thresholds)
+        grids = np.meshgrid(*[np.asarray(thresholds[ch_type], dtype=float) for ch_type in ch_types], indexing="ij")
+        grids = [grid.ravel() for grid in grids]
+
+        # kept trials of all combinations at once (n_trials, n_combinations)
+        keep = np.ones((len(self), len(grids[0])), dtype=bool)
+        for ch_type, grid in zip(ch_types, grids):
+            keep &= self.max_deltas[ch_type][:, np.newaxis] <= grid[np.newaxis, :]
+
+        groups = np.unique(np.stack([self.recording, self.trigger], axis=1), axis=0)
+        group_counts = {(self.recording_names[recording], int(trigger)): keep[(self.recording == recording) & (self.trigger == trigger)].sum(axis=0)
+                        for recording, trigger in groups}
+
+        return {tuple(float(grid[combination]) for grid in grids): {group: int(counts[combination]) for group, counts in group_counts.items()}
+                for combination in range(len(grids[0]))}
+
+    def apply(self, epochs_dict:dict, reject:dict, copy=True):
+        '''
+        Drop the epochs exceeding reject from the epochs the table was computed from. The drop log lists the channels
+        exceeding their threshold, as when rejecting while epoching.
+
+        Args
+            epochs_dict (dict): epochs for each recording, as passed to from_epochs_dict
+            reject (dict): peak-to-peak rejection thresholds per channel type
+            copy (bool): drop from copies of the epochs (so that other thresholds can be applied later) instead of in place
+
+        Returns
+            rejected (dict): epochs for each recording without the rejected epochs
+        '''
+        rejected = {}
+
+        for recording_name, epochs in epochs_dict.items():
+            deltas = self.deltas[recording_name]
+            if len(deltas) != len(epochs):
+                raise ValueError(f"{recording_name} has {len(epochs)} epochs but the table has {len(deltas)}, "
+                                 "apply the table to the epochs it was computed from")
+
+            bad_log = rejection_log(deltas, epochs.info, reject)
+            bad = np.array([len(bad) > 0 for bad in bad_log], dtype=bool)
+
+            epochs = epochs.copy() if copy else epochs
+            selection = epochs.selection[bad]
+            epochs.drop(bad, reason="REJECT", verbose=False)
+
+            # the channels that exceeded the thresholds instead of the generic reason
+            drop_log = list(epochs.drop_log)
+            for index, bad_channels in zip(selection, [bad for bad in bad_log if bad]):
+                drop_log[index] = bad_channels
+            epochs.drop_log = tuple(drop_log)
+            epochs.reject = dict(reject)
+
+            rejected[recording_name] = epochs
+
+        return rejected
@@ -0,0 +1,230 @@
+'''
+Functions for source reconstruction shared by the classification and contrast scripts
+'''
+import hashlib, pathlib
+import numpy as np
+
+# MEG package for source reconstruction
+import mne
+
+from .cache import hash_file, hash_params, get_cached, write_cached, evict
+
+# inverse operators and noise covariances already built in this process (keyed as on disk)
+_memory_cache = {}
+
+def get_forward_path(subjects_dir, subject, recording_name):
+    '''
+    Path to the (oct-6) forward solution of a recording
+    '''
+    fwd_name = f"{recording_name[4:]}-oct-6-src-5120-fwd.fif"
+
+    return pathlib.Path(subjects_dir) / subject / 'bem' / fwd_name
+
+def hash_epochs(epochs):
+    '''
+    Hash everything the noise covariance and inverse operator depend on: the measurement info (channels, bads,
+    projections, sensor positions), the rejection settings and the epoched data itself
+    '''
+    info = epochs.info
+    digest = hashlib.blake2b(digest_size=16)
+
+    digest.update(hash_params(dict(
+        ch_names=info['ch_names'], bads=info['bads'], sfreq=info['sfreq'],
+        projs=[(proj['desc'], proj['active']) for proj in info['projs']],
+        reject=epochs.reject, flat=epochs.flat, baseline=epochs.baseline, times=[epochs.tmin, epochs.tmax],
+        )).encode())
+
+    digest.update(np.ascontiguousarray([ch['loc'] for ch in info['chs']]).tobytes())
+
+    if info['dev_head_t'] is not None:
+        digest.update(np.ascontiguousarray(info['dev_head_t']['trans']).tobytes())
+
+    for proj in info['projs']:
+        digest.update(np.ascontiguousarray(proj['data']['data']).tobytes())
+
+    # hash the loaded data buffer in place (get_data() and tobytes() would each copy all epochs)
+    digest.update(np.ascontiguousarray(epochs.get_data(copy=False)))
+
+    return digest.hexdigest()
+
+def get_noise_covariance(epochs, tmax=0.0, cache_dir=None, cache_max_bytes=5e9, epochs_hash=None):
+    '''
+    Compute the noise covariance from the baseline of the epochs (or load it from the cache)
+
+    Args
+        epochs (mne.Epochs): epochs of a single recording
+        tmax (float): end of the baseline used for the noise covariance
+        cache_dir (pathlib.Path): directory for cached covariances (None only caches in memory)
+        cache_max_bytes (float): size budget of the cache directory
+        epochs_hash (str): precomputed hash_epochs(epochs)
+
+    Returns
+        noise_cov (mne.Covariance): noise covariance
+    '''
+    if epochs_hash is None:
+        epochs_hash = hash_epochs(epochs)
+
+    key = hash_params(dict(stage="noise_cov", epochs=epochs_hash, tmax=tmax, mne=mne.__version__))
+
+    if key in _memory_cache:
+        return _memory_cache[key]
+
+    cached_path = get_cached(cache_dir, key, "-cov.fif") if cache_dir is not None else None
+
+    if cached_path is not None:
+        noise_cov = mne.read_cov(cached_path)
+    else:
+        noise_cov = mne.compute_covariance(epochs, tmax=tmax)
+
+        if cache_dir is not None:
+            cached_path = write_cached(cache_dir, key, "-cov.fif", lambda path: mne.write_cov(path, noise_cov, overwrite=True))
+            evict(cache_dir, cache_max_bytes, pattern="*.fif", keep=[cached_path])
+
+    _memory_cache[key] = noise_cov
+
+    return noise_cov
+
+def get_inverse_operator(epochs, recording_name, subjects_dir, subject="0108", cache_dir=None, cache_max_bytes=5e9):
+    '''
+    Build the inverse operator of a recording from its forward solution and the noise covariance of its epochs
+    (or load it from the cache, so that extraction after the first run skips straight to applying the operator).
+    Note that MNE stores inverse operators in single precision, so operators loaded from disk differ from freshly built ones at ~1e-7 (relative).
+
+    Args
+        epochs (mne.Epochs): epochs of a single recording
+        recording_name (str): recording name (used to find the forward solution)
+        subjects_dir (pathlib.Path): path to subjects_dir
+        subject (str): subject name
+        cache_dir (pathlib.Path): directory for cached inverse operators and covariances (None only caches in memory)
+        cache_max_bytes (float): size budget of the cache directory
+
+    Returns
+        inv (mne.minimum_norm.InverseOperator): inverse operator
+    '''
+    fwd_path = get_forward_path(subjects_dir, subject, recording_name)
+    epochs_hash = hash_epochs(epochs)
+
+    key = hash_params(dict(stage="inverse", epochs=epochs_hash, fwd=hash_file(fwd_path), mne=mne.__version__))
+
+    if key in _memory_cache:
+        return _memory_cache[key]
+
+    cached_path = get_cached(cache_dir, key, "-inv.fif") if cache_dir is not None else None
+
+    if cached_path is not None:
+        inv = mne.minimum_norm.read_inverse_operator(cached_path)
+    else:
+        # read forward solution
+        fwd = mne.read_forward_solution(fwd_path)
+
+        # source estimation!
+        noise_cov = get_noise_covariance(epochs, tmax=0.000, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes, epochs_hash=epochs_hash)
+
+        inv = mne.minimum_norm.make_inverse_operator(epochs.info, fwd, noise_cov)
+
+        if cache_dir is not None:
+            cached_path = write_cached(cache_dir, key, "-inv.fif",
+                                       lambda path: mne.minimum_norm.write_inverse_operator(path, inv, overwrite=True))
+            evict(cache_dir, cache_max_bytes, pattern="*.fif", keep=[cached_path])
+
+    _memory_cache[key] = inv
+
+    return inv
+
+def read_labels(subjects_dir, subject="0108", labels=None, annot=None):
+    '''
+    Read freesurfer labels from label files and/or all labels of an annotation (parcellation)
+
+    Args
+        subjects_dir (pathlib.Path): path to subjects_dir
+        subject (str): subject name
+        labels (list): label file names in subjects_dir/subject/label (e.g., "rh.bankssts.label")
+        annot (str): annotation whose labels are all read (e.g., "aparc")
+
+    Returns
+        label_dict (dict): label objects, keyed by the label file name (or the label name for annotation labels)
+    '''
+    label_dict = {}
+
+    for label in labels or []:
+        label_dict[label] = mne.read_label(pathlib.Path(subjects_dir) / subject / 'label' / label)
+
+    if annot is not None:
+        for label in mne.read_labels_from_annot(subject, parc=annot, subjects_dir=subjects_dir):
+            label_dict[label.name] = label
+
+    return label_dict
+
+def make_inverse_kernel(inv, info, label=None, method="dSPM", lambda2=1, prepared=False):
+    '''
+    Imaging kernel of the inverse operator restricted to a label, i.e. the matrix mapping sensor data to source time courses
+    (including projections, whitening and dSPM/sLORETA noise normalisation). Obtained by applying the inverse to an
+    identity matrix, which is exact for linear inverse solutions with fixed orientations (pick_ori="normal").
+
+    Args
+        inv (mne.minimum_norm.InverseOperator): inverse operator
+        info (mne.Info): info of the data the kernel is applied to (the columns of the kernel follow info['ch_names'])
+        label (mne.Label): label to restrict the kernel to (None for whole brain)
+        method (str): inverse method
+        lambda2 (float): regularisation parameter
+        prepared (bool): whether inv was already prepared (with nave=1)
+
+    Returns
+        kernel (array): shape (n_vertices, n_channels)
+        vertices (list): vertices of the rows of the kernel (as in SourceEstimate.vertices)
+    '''
+    # nave=1 as apply_inverse_epochs treats every epoch as a single trial
+    identity = mne.EvokedArray(np.eye(len(info['ch_names'])), info, tmin=0, nave=1, verbose=False)
+
+    stc = mne.minimum_norm.apply_inverse(identity, inv, lambda2=lambda2, method=method, label=label,
+                                         pick_ori="normal", prepared=prepared, verbose=False)
+
+    return stc.data, stc.vertices
+
+def apply_inverse_kernel(kernel, epochs, out=None, chunk_size=None):
+    '''
+    Apply an imaging kernel to all epochs at once (batched alternative to mne.minimum_norm.apply_inverse_epochs)
+
+    Args
+        kernel (array): shape (n_vertices, n_channels), see make_inverse_kernel
+        epochs (mne.Epochs): epochs (with the channels of the info the kernel was made for)
+        out (array): optional preallocated (or memory-mapped) output with shape (n_epochs, n_vertices, n_times) to write into
+        chunk_size (int): if given, vertices are processed in chunks of this size (bounds the memory of the multiplication)
+
+    Returns
+        X (array): source time courses with shape (n_epochs, n_vertices, n_times)
+    '''
+    data = epochs.get_data(copy=False)
+
+    if chunk_size is None:
+        return np.matmul(kernel, data, out=out)
+
+    if out is None:
+        out = np.empty((data.shape[0], kernel.shape[0], data.shape[2]))
+
+    for start in range(0, kernel.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        np.matmul(kernel[chunk], data, out=out[:, chunk])
+
+    return out
+
+def allocate_features(shape, store_dir=None, name=None, dtype=np.float64):
+    '''
+    Allocate the source space feature array for all trials up front, in memory or as a memory-mapped .npy file
+
+    Args
+        shape (tuple): (n_trials, n_vertices, n_times)
+        store_dir (pathlib.Path): directory of the memory-mapped feature store (None allocates in memory)
+        name (str): label name used for the file name (None for whole brain)
+        dtype (numpy dtype): dtype of the features (e.g., np.float32 halves the size)
+
+    Returns
+        X (array): uninitialised array (numpy.memmap if store_dir is given)
+    '''
+    if store_dir is None:
+        return np.empty(shape, dtype=dtype)
+
+    store_dir = pathlib.Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    return np.lib.format.open_memmap(store_dir / f"{name or 'whole_brain'}.npy", mode="w+", dtype=dtype, shape=shape)
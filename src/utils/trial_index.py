@@ -0,0 +1,148 @@
+'''
+Columnar index of the trials of all recordings (one numpy array per column) for vectorised trial selection
+'''
+import numpy as np
+
+# valence of each trigger (see README, Event Triggers)
+VALENCE = {11: "positive", 21: "positive", 12: "negative", 22: "negative", 23: "button"}
+
+COLUMNS = ["recording", "block", "condition", "valence", "trigger", "dropped", "onset", "epoch", "row"]
+
+class TrialIndex:
+    '''
+    Trial metadata as numpy columns (one row per trial, including dropped trials if the original events are known):
+        recording (int): position of the recording in recording_names
+        block (int): block number of the recording (e.g., 1 for '001.self_block1')
+        condition (str): "self" or "other"
+        valence (str): "positive", "negative" or "button"
+        trigger (int): trigger value
+        dropped (bool): whether the epoch was rejected (e.g., by the peak-to-peak criterion)
+        onset (int): onset sample of the event in the raw data
+        epoch (int): index of the epoch within its recording's epochs (-1 if dropped)
+        row (int): row of the trial in data stacked over recordings, e.g. X from get_source_space_data (-1 if dropped)
+    '''
+    def __init__(self, recording_names, **columns):
+        self.recording_names = list(recording_names)
+        self.columns = {name: np.asarray(columns[name]) for name in COLUMNS}
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get("columns", {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return len(self.columns["trigger"])
+
+    def __repr__(self):
+        return f"<TrialIndex | {len(self)} trials, {int(self.dropped.sum())} dropped, {len(self.recording_names)} recordings>"
+
+    @classmethod
+    def from_epochs_dict(cls, epochs_dict:dict, events_dict:dict=None):
+        '''
+        Build the index from the epochs of each recording
+
+        Args
+            epochs_dict (dict): epochs for each recording (keys are recording names, values are epochs objects)
+            events_dict (dict): the events each epochs object was created from (keys are recording names). Needed to include
+                                dropped trials, if None only the kept epochs are indexed.
+
+        Returns
+            trial_index (TrialIndex)
+        '''
+        columns = {name: [] for name in COLUMNS}
+        n_rows = 0
+
+        for recording_index, (recording_name, epochs) in enumerate(epochs_dict.items()):
+            if events_dict is not None:
+                # drop_log has one entry per original event, events not in event_id are marked as IGNORED
+                events = events_dict[recording_name]
+                used = np.array([log != ("IGNORED",) for log in epochs.drop_log])
+                dropped = np.array([len(log) > 0 for log in epochs.drop_log])[used]
+                events = events[used]
+            else:
+                events = epochs.events
+                dropped = np.zeros(len(events), dtype=bool)
+
+            n_trials = len(events)
+            epoch = np.full(n_trials, -1)
+            epoch[~dropped] = np.arange(np.sum(~dropped))
+            row = np.where(dropped, -1, epoch + n_rows)
+            n_rows += np.sum(~dropped)
+
+            columns["recording"].append(np.full(n_trials, recording_index))
+            columns["block"].append(np.full(n_trials, int(recording_name.split("block")[-1])))
+            columns["condition"].append(np.full(n_trials, "self" if "self" in recording_name else "other"))
+            columns["valence"].append(np.array([VALENCE.get(trigger, "") for trigger in events[:, 2]], dtype="<U8"))
+            columns["trigger"].append(events[:, 2])
+            columns["dropped"].append(dropped)
+            columns["onset"].append(events[:, 0])
+            columns["epoch"].append(epoch)
+            columns["row"].append(row)
+
+        columns = {name: np.concatenate(values) for name, values in columns.items()}
+
+        return cls(epochs_dict.keys(), **columns)
+
+    def mask(self, **criteria):
+        '''
+        Boolean mask of the trials matching all criteria, e.g. trial_index.mask(trigger=[11, 21], dropped=False).
+        A criterion is a single value or a list of accepted values for a column (recording also accepts recording names).
+        '''
+        mask = np.ones(len(self), dtype=bool)
+
+        for column, values in criteria.items():
+            values = np.atleast_1d(values)
+
+            if column == "recording" and values.dtype.kind in "US":
+                values = [self.recording_names.index(value) for value in values]
+
+            mask &= np.isin(self.columns[column], values)
+
+        return mask
+
+    def select(self, mask=None, **criteria):
+        '''
+        New index with the trials selected by a boolean mask (or index array) and/or criteria (see mask)
+        '''
+        selection = self.mask(**criteria)
+
+        if mask is not None:
+            mask = np.asarray(mask)
+            if mask.dtype != bool:
+                mask = np.isin(np.arange(len(self)), mask)
+            selection &= mask
+
+        return TrialIndex(self.recording_names, **{name: values[selection] for name, values in self.columns.items()})
+
+    def kept(self):
+        '''
+        Index of the trials that were not dropped (its rows line up with data stacked over recordings)
+        '''
+        return self.select(dropped=False)
+
+    def remap(self, column, mapping:dict, default=None):
+        '''
+        Map the values of a column to new labels, e.g. trial_index.remap("trigger", {11: 1121, 21: 1121, 12: 1222, 22: 1222}).
+        Values not in mapping keep their value (or are set to default if given).
+        '''
+        values = self.columns[column]
+        remapped = values.copy() if default is None else np.full(len(values), default)
+
+        for old, new in mapping.items():
+            remapped[values == old] = new
+
+        return remapped
+
+    def counts(self, *columns, **criteria):
+        '''
+        Number of trials per combination of columns, e.g. trial_index.counts("recording", "trigger", dropped=False)
+
+        Returns
+            counts (dict): {(value, ...): count}
+        '''
+        selection = self.mask(**criteria)
+        keys = np.rec.fromarrays([self.columns[column][selection] for column in columns])
+        unique, counts = np.unique(keys, return_counts=True)
+
+        return {tuple(key.tolist()): int(count) for key, count in zip(unique, counts)}